@@ -0,0 +1,302 @@
+""" Throughput and latency of the generated API on a synthetic dataset
+
+Generates a database with benchmarks/synthetic.py, then times list, single,
+relationship, create and bulk requests through the Flask test client and
+through a `quicksand serve` process driven by concurrent HTTP clients.
+Results are saved as JSON; pass an earlier file to --compare to see the
+change between commits.
+
+Run from the repository root, e.g.
+`python benchmarks/bench_api.py --rows 100000 --concurrency 8`.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from quicksand import create_app
+from synthetic import make_database, new_attributes
+
+
+PARENT = 'item0s'
+CHILD = 'item1s'
+SCENARIOS = ('list', 'single', 'relationship', 'create', 'bulk')
+EXPECTED_STATUS = {'list': 200, 'single': 200, 'relationship': 200,
+                   'create': 201, 'bulk': 200}
+
+
+def make_request(name, rng, args):
+    """ (method, path, JSON body) of one request of scenario name """
+    if name == 'list':
+        after = rng.randint(0, max(0, args.rows - args.page_size))
+        return 'GET', f'/api/{CHILD}?page[size]={args.page_size}&page[after]={after}', None
+
+    if name == 'single':
+        return 'GET', f'/api/{CHILD}/{rng.randint(1, args.rows)}', None
+
+    if name == 'relationship':
+        return 'GET', f'/api/{PARENT}/{rng.randint(1, args.rows)}/{CHILD}', None
+
+    if name == 'create':
+        return 'POST', f'/api/{CHILD}', {'data': {
+            'type': CHILD, 'attributes': new_attributes(rng)}}
+
+    operations = [{'op': 'add', 'data': {'type': CHILD, 'attributes': new_attributes(rng)}}
+                  for _ in range(args.bulk_size)]
+    return 'POST', '/api/_operations', {'atomic:operations': operations}
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        'requests': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(0.50), 3),
+        'p99_ms': round(percentile(0.99), 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+
+def check_status(name, status):
+    if status != EXPECTED_STATUS[name]:
+        raise RuntimeError(f'{name} request returned {status}')
+
+
+def run_client(app, name, args):
+    """ Sequential requests through the Flask test client """
+    client = app.test_client()
+    rng = random.Random(args.seed)
+
+    def send():
+        method, path, body = make_request(name, rng, args)
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        response.close()
+        check_status(name, response.status_code)
+
+    for _ in range(args.warmup):
+        send()
+
+    latencies = []
+    started = time.perf_counter()
+
+    for _ in range(args.requests):
+        request_started = time.perf_counter()
+        send()
+        latencies.append(time.perf_counter() - request_started)
+
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def run_http(port, name, args):
+    """ Requests from args.concurrency threads, each on its own connection """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_thread = max(1, args.requests // args.concurrency)
+
+    def worker(seed, count, record):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        own = []
+
+        try:
+            for _ in range(count):
+                method, path, body = make_request(name, rng, args)
+                payload = None if body is None else json.dumps(body)
+                headers = {} if body is None else {'Content-Type': 'application/vnd.api+json'}
+                request_started = time.perf_counter()
+                conn.request(method, path, payload, headers)
+                response = conn.getresponse()
+                response.read()
+                own.append(time.perf_counter() - request_started)
+                check_status(name, response.status)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+        if record:
+            with lock:
+                latencies.extend(own)
+
+    warmups = [threading.Thread(target=worker, args=(args.seed + i, args.warmup, False))
+               for i in range(args.concurrency)]
+    threads = [threading.Thread(target=worker, args=(args.seed + i, per_thread, True))
+               for i in range(args.concurrency)]
+
+    for group in (warmups, threads):
+        started = time.perf_counter()
+        for thread in group:
+            thread.start()
+        for thread in group:
+            thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(db_path, args):
+    port = free_port()
+    command = [sys.executable, '-m', 'quicksand.cli', 'serve', db_path,
+               '--port', str(port), '--workers', str(args.workers),
+               '--pool-size', str(args.pool_size), '--pragma', 'journal_mode=wal']
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('quicksand serve exited during startup')
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError('quicksand serve did not start within 60 seconds')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_path):
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+
+    print(f'\nChange from {previous.get("commit") or previous_path}:')
+
+    for mode, scenarios in results['results'].items():
+        for name, summary in scenarios.items():
+            before = previous['results'].get(mode, {}).get(name)
+            if before is None:
+                continue
+
+            throughput = (summary['throughput'] / before['throughput'] - 1) * 100
+            p99 = (summary['p99_ms'] / before['p99_ms'] - 1) * 100
+            print(f'{mode:7} {name:13} throughput {throughput:+7.1f}%   p99 {p99:+7.1f}%')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tables', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=10000, help='rows per table')
+    parser.add_argument('--links', type=int, default=1,
+                        help='_id relationships from each table to earlier ones')
+    parser.add_argument('--requests', type=int, default=500, help='per scenario')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--bulk-size', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--pool-size', type=int, default=5)
+    parser.add_argument('--mode', choices=['client', 'server', 'both'], default='both')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='run only these scenarios')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='results file, by default '
+                        'benchmarks/results/<time>-<commit>.json')
+    parser.add_argument('--compare', metavar='RESULTS', help='earlier results file')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.tables < 2:
+        raise SystemExit('--tables must be at least 2')
+
+    scenarios = args.scenario or list(SCENARIOS)
+    results = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'compare')},
+        'results': {},
+    }
+
+    work_dir = tempfile.mkdtemp()
+    db_path = os.path.join(work_dir, 'bench.db')
+
+    try:
+        make_database(db_path, args.tables, args.rows, args.links, args.seed)
+
+        if args.mode in ('client', 'both'):
+            app = create_app(db_path, pool_size=args.pool_size,
+                             pragmas={'journal_mode': 'wal'})
+            results['results']['client'] = {name: run_client(app, name, args)
+                                            for name in scenarios}
+            app.config['POOL'].close()
+            app.config['WRITER'].close()
+
+        if args.mode in ('server', 'both'):
+            process, port = start_server(db_path, args)
+            try:
+                results['results']['server'] = {name: run_http(port, name, args)
+                                                for name in scenarios}
+            finally:
+                process.terminate()
+                process.wait(30)
+    finally:
+        for name in os.listdir(work_dir):
+            os.unlink(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+
+    print(f'{args.tables} tables x {args.rows} rows, {args.links} link(s) per table')
+    print(f'{"mode":7} {"scenario":13} {"req/s":>10} {"p50 ms":>9} {"p99 ms":>9}')
+    for mode, summaries in results['results'].items():
+        for name, summary in summaries.items():
+            print(f'{mode:7} {name:13} {summary["throughput"]:10.1f} '
+                  f'{summary["p50_ms"]:9.3f} {summary["p99_ms"]:9.3f}')
+
+    output = args.output
+
+    if output is None:
+        results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+        os.makedirs(results_dir, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(results_dir, f'{stamp}-{results["commit"] or "nogit"}.json')
+
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print(f'\nSaved {output}')
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+""" Peak memory of reading a whole large table through the API
+
+Each scenario runs in its own interpreter over the same generated table and
+reports the peak of Python allocations (tracemalloc), the process's peak
+RSS and the time taken:
+
+  rows      sqlite3.Row records, the per-row key formatter and json.dumps,
+            as collection responses were first built
+  fetchall  tuple records fetched at once, serialize_many and one encode
+  buffered  GET /api/item0s, built from fetchmany batches
+  stream    GET /api/item0s?stream=1, read chunk by chunk
+
+Run from the repository root with `python benchmarks/bench_memory.py`;
+--rows defaults to a million.
+"""
+import argparse
+import json
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic import make_database, table_name
+
+
+SCENARIOS = ('rows', 'fetchall', 'buffered', 'stream')
+TABLE = table_name(0)
+URL_ROOT = 'http://localhost/'
+
+
+def run_rows(db_path):
+    from bench_serializer import legacy_format_resource_object
+
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    records = conn.execute(f'SELECT * FROM {TABLE}').fetchall()
+    obj = legacy_format_resource_object(records, TABLE, URL_ROOT, [])
+    return len(json.dumps(obj).encode('utf-8'))
+
+
+def run_fetchall(db_path):
+    from quicksand.jsonapi import load_json_encoder
+    from quicksand.serializers import ResourceSerializer
+
+    conn = sqlite3.connect(db_path)
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({TABLE})')]
+    serializer = ResourceSerializer(TABLE, columns, [])
+    records = conn.execute(f'SELECT * FROM {TABLE} ORDER BY id').fetchall()
+    obj = {'data': serializer.serialize_many(records, URL_ROOT)}
+    return len(load_json_encoder()(obj))
+
+
+def run_buffered(db_path):
+    client = make_client(db_path)
+    return len(client.get(f'/api/{TABLE}').get_data())
+
+
+def run_stream(db_path):
+    client = make_client(db_path)
+    response = client.get(f'/api/{TABLE}?stream=1')
+    size = sum(len(chunk) for chunk in response.response)
+    response.close()
+    return size
+
+
+def make_client(db_path):
+    from quicksand import create_app
+    return create_app(db_path).test_client()
+
+
+def measure(scenario, db_path):
+    """ Runs scenario in this process and returns its measurements """
+    run = globals()[f'run_{scenario}']
+    # Import everything before measuring, so only the request is counted
+    if scenario in ('buffered', 'stream'):
+        make_client(db_path)
+    else:
+        import bench_serializer
+        import quicksand.serializers
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = run(db_path)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'bytes': size,
+        'seconds': round(elapsed, 2),
+        'peak_python_mb': round(peak / 2 ** 20, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'baseline_rss_mb': round(baseline_rss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser.add_argument('--run', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(json.dumps(measure(args.run, args.db)))
+        return
+
+    work_dir = tempfile.mkdtemp()
+    db_path = os.path.join(work_dir, 'memory.db')
+
+    try:
+        make_database(db_path, tables=1, rows=args.rows)
+        print(f'{args.rows:,} rows in {TABLE}')
+        print(f'{"scenario":9} {"python MB":>10} {"RSS MB":>8} {"seconds":>8} {"body MB":>8}')
+
+        for scenario in args.scenario or SCENARIOS:
+            output = subprocess.run([sys.executable, __file__, '--run', scenario,
+                                     '--db', db_path], check=True,
+                                    capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f'{scenario:9} {result["peak_python_mb"]:10.1f} '
+                  f'{result["peak_rss_mb"] - result["baseline_rss_mb"]:8.1f} '
+                  f'{result["seconds"]:8.2f} {result["bytes"] / 2 ** 20:8.1f}')
+    finally:
+        for name in os.listdir(work_dir):
+            os.unlink(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+""" Rows/sec of the old per-row formatter against ResourceSerializer
+
+Run from the repository root with `python benchmarks/bench_serializer.py`.
+"""
+import sqlite3
+import sys
+import time
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from quicksand import BelongsTo
+from quicksand.serializers import ResourceSerializer
+
+
+ROWS = 10000
+REPEAT = 5
+URL_ROOT = 'http://localhost/'
+
+
+def legacy_format_resource_object(record, resource, url_root, relationships):
+    """ format_resource_object as it was before serializers were compiled """
+    if isinstance(record, list):
+        records = record
+        data = [legacy_format_resource_object(record, resource, url_root,
+                                              relationships)['data']
+                for record in records]
+        return {'data': data}
+
+    data = {
+        'type': resource,
+        'id': record['id']
+    }
+
+    data['attributes'] = {}
+
+    for key in [key for key in record.keys() if key != 'id' and not key.endswith('_id')]:
+        data['attributes'][key] = record[key]
+
+    data['links'] = {
+        'self': f'{url_root}api/{resource}/{record["id"]}'
+    }
+
+    if len(relationships) > 0:
+        id = record['id']
+        data['relationships'] = {
+            rel.name: {
+                'links': {
+                    'related': f'{url_root}api/{resource}/{id}/{rel.name}'
+                }
+            }
+            for rel in relationships
+        }
+
+    return {
+        'data': data
+    }
+
+
+def make_connection():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE articles (id INTEGER PRIMARY KEY, title TEXT, '
+                 'body TEXT, views INTEGER, author_id INTEGER)')
+    conn.executemany('INSERT INTO articles VALUES (?, ?, ?, ?, ?)',
+                     [(i, f'Article {i}', f'Body {i}' * 4, i * 3, i % 50)
+                      for i in range(1, ROWS + 1)])
+    return conn
+
+
+def best_rate(fn):
+    best = None
+
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return ROWS / best
+
+
+def main():
+    conn = make_connection()
+    relationships = [BelongsTo('articles', 'author')]
+    sql = 'SELECT * FROM articles'
+
+    def legacy():
+        conn.row_factory = sqlite3.Row
+        records = conn.execute(sql).fetchall()
+        legacy_format_resource_object(records, 'articles', URL_ROOT, relationships)
+
+    columns = ['id', 'title', 'body', 'views', 'author_id']
+    serializer = ResourceSerializer('articles', columns, relationships)
+
+    def compiled():
+        conn.row_factory = None
+        records = conn.execute(sql).fetchall()
+        serializer.serialize_many(records, URL_ROOT)
+
+    before = best_rate(legacy)
+    after = best_rate(compiled)
+    print(f'{ROWS} rows, best of {REPEAT}')
+    print(f'format_resource_object: {before:12,.0f} rows/sec')
+    print(f'ResourceSerializer:     {after:12,.0f} rows/sec ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
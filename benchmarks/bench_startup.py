@@ -0,0 +1,142 @@
+""" Startup time over a generated 500-table schema
+
+Compares relationship inference with an inflect engine per relationship, as
+it was, against the shared memoized inflector, and times create_app in a
+fresh interpreter with and without a relationship cache file.
+
+Run from the repository root with `python benchmarks/bench_startup.py`.
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from quicksand import Db
+from quicksand import relationships
+from quicksand.relationships import infer_relationships
+
+
+TABLES = 500
+REPEAT = 3
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+def make_schema(path):
+    """ Tables item0s..item499s, each belonging to up to three earlier ones """
+    statements = []
+
+    for i in range(TABLES):
+        columns = ['id INTEGER PRIMARY KEY', 'name TEXT', 'created TEXT']
+        columns += [f'item{j}_id INTEGER' for j in range(max(0, i - 3), i)]
+        statements.append(f'CREATE TABLE item{i}s ({", ".join(columns)});')
+        statements += [f'CREATE INDEX item{i}s_item{j}_id_idx ON item{i}s (item{j}_id);'
+                       for j in range(max(0, i - 3), i)]
+
+    conn = sqlite3.connect(path)
+    conn.executescript('\n'.join(statements))
+    conn.close()
+
+
+def legacy_infer_relationships(db):
+    """ infer_relationships as it was, with an engine per relationship """
+    import inflect
+
+    class LegacyBelongsTo:
+        def __init__(self, resource, relationship_name):
+            self.name = relationship_name
+            self.related_resource = inflect.engine().plural(relationship_name)
+            self.lookup_table = inflect.engine().plural(relationship_name)
+            self.lookup_id = 'id'
+
+    class LegacyHasMany:
+        def __init__(self, resource, relationship_name):
+            self.name = relationship_name
+            self.related_resource = relationship_name
+            self.lookup_table = relationship_name
+            self.lookup_id = inflect.engine().singular_noun(resource) + '_id'
+
+    p = inflect.engine()
+    resources = {table: [] for table in db.table_names}
+
+    for resource in db.table_names:
+        for column in db.table_columns(resource):
+            if column.endswith('_id'):
+                belongs_to = column[:-3]
+                belongs_to_resource = p.plural(belongs_to)
+                resources[resource].append(LegacyBelongsTo(resource, belongs_to))
+                resources[belongs_to_resource].append(
+                    LegacyHasMany(belongs_to_resource, resource))
+
+    return resources
+
+
+def best_time(fn, setup=None):
+    best = None
+
+    for _ in range(REPEAT):
+        if setup is not None:
+            setup()
+
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def clear_inflections():
+    relationships.plural.cache_clear()
+    relationships.singular.cache_clear()
+
+
+def cold_create_app(db_path, cache_path=None):
+    """ Seconds for imports plus create_app in a new interpreter """
+    script = ('import time; started = time.perf_counter(); '
+              'from quicksand import create_app; '
+              f'create_app({db_path!r}, relationship_cache={cache_path!r}); '
+              'print(time.perf_counter() - started)')
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT,
+                            check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    db_fd, db_path = tempfile.mkstemp()
+    cache_path = db_path + '.relationships.json'
+
+    try:
+        make_schema(db_path)
+        db = Db(db_path)
+        # Import inflect up front so it is not counted against either side
+        relationships.inflector()
+
+        before = best_time(lambda: legacy_infer_relationships(db))
+        after = best_time(lambda: infer_relationships(db), clear_inflections)
+
+        print(f'{TABLES} tables, best of {REPEAT}')
+        print(f'inference, engine per relationship: {before * 1000:9.1f} ms')
+        print(f'inference, shared inflector:        {after * 1000:9.1f} ms '
+              f'({before / after:.1f}x)')
+
+        uncached = min(cold_create_app(db_path) for _ in range(REPEAT))
+        cold_create_app(db_path, cache_path)
+        cached = min(cold_create_app(db_path, cache_path) for _ in range(REPEAT))
+
+        print(f'create_app, new interpreter:        {uncached * 1000:9.1f} ms')
+        print(f'create_app, relationship cache hit: {cached * 1000:9.1f} ms '
+              f'({uncached / cached:.1f}x)')
+    finally:
+        os.close(db_fd)
+        os.unlink(db_path)
+
+        if os.path.exists(cache_path):
+            os.unlink(cache_path)
+
+
+if __name__ == '__main__':
+    main()
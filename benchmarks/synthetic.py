@@ -0,0 +1,54 @@
+""" Synthetic schemas and datasets for the benchmarks
+
+Tables are named item0s, item1s, ... so relationship inference pluralizes
+them back. Each table after the first belongs to up to `links` earlier
+tables through indexed `item<j>_id` columns, with parent ids drawn at
+random so every parent has about rows / parents children.
+"""
+import random
+import sqlite3
+
+
+def table_name(i):
+    return f'item{i}s'
+
+
+def parent_tables(i, links):
+    return list(range(max(0, i - links), i))
+
+
+def make_database(path, tables=3, rows=10000, links=1, seed=0):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=wal')
+
+    for i in range(tables):
+        parents = parent_tables(i, links)
+        columns = ['id INTEGER PRIMARY KEY', 'name TEXT', 'body TEXT',
+                   'score INTEGER', 'created TEXT']
+        columns += [f'item{j}_id INTEGER' for j in parents]
+        conn.execute(f'CREATE TABLE {table_name(i)} ({", ".join(columns)})')
+
+        for j in parents:
+            conn.execute(f'CREATE INDEX {table_name(i)}_item{j}_id_idx '
+                         f'ON {table_name(i)} (item{j}_id)')
+
+        placeholders = ','.join('?' * (5 + len(parents)))
+        conn.executemany(f'INSERT INTO {table_name(i)} VALUES ({placeholders})', (
+            [id, f'Item {i}.{id}', 'lorem ipsum ' * rng.randint(1, 8),
+             rng.randint(0, 1000), f'2020-01-{rng.randint(1, 28):02d}'] +
+            [rng.randint(1, rows) for _ in parents]
+            for id in range(1, rows + 1)
+        ))
+
+    conn.commit()
+    conn.close()
+
+
+def new_attributes(rng):
+    return {
+        'name': f'New {rng.randint(0, 10 ** 9)}',
+        'body': 'lorem ipsum ' * rng.randint(1, 8),
+        'score': rng.randint(0, 1000),
+        'created': '2021-06-01',
+    }
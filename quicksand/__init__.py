@@ -1,3 +1,4 @@
 from .server import create_app
+from .asgi import create_asgi_app
 from .sqlite_db import SqliteDb as Db
 from .relationships import HasMany, BelongsTo
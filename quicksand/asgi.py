@@ -0,0 +1,321 @@
+import asyncio
+import contextvars
+import io
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from .server import create_app
+from .changes import ChangesExpired, parse_changes_args, wants_event_stream
+from .changes import changes_document, format_event, format_reset, KEEP_ALIVE
+
+
+# Response bytes pulled from the WSGI iterator per trip to a worker thread
+CHUNK_BYTES = 64 * 1024
+
+CHANGES_PATH = re.compile(r'^/api/([^/]+)/changes$')
+
+
+class BodyTooLarge(Exception):
+    """ The request body is longer than the app's MAX_CONTENT_LENGTH """
+
+
+class AsgiApp:
+    """ Serves a quicksand Flask app to an ASGI server
+
+    Connections are owned by the event loop. Each request is read completely
+    before it runs on one of max_threads worker threads, and its response is
+    written back by the loop, so slow or idle keep-alive clients never hold a
+    thread or a database connection. Change feed requests are served on the
+    loop itself, so waiting subscribers hold no thread either.
+    """
+    def __init__(self, app, max_threads=None):
+        self.app = app
+        self.max_threads = max_threads or app.config['POOL'].size
+        self.executor = ThreadPoolExecutor(self.max_threads,
+                                           thread_name_prefix='quicksand')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+
+    async def run(self, context, fn, *args):
+        # Every step of a request runs in the same context, since a streamed
+        # response pops the request context Flask pushed in an earlier step
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, context.run, fn, *args)
+
+    async def handle_http(self, scope, receive, send):
+        max_size = self.app.config['MAX_CONTENT_LENGTH']
+
+        try:
+            body = await read_body(receive, max_size)
+        except BodyTooLarge:
+            await self.send_json(send, 413, {'errors': [{
+                'title': 'Request too large',
+                'detail': f'Request bodies are limited to {max_size} bytes',
+            }]})
+            return
+
+        if body is None:
+            return
+
+        resource = self.changes_resource(scope)
+
+        if resource is not None:
+            await self.handle_changes(scope, receive, send, resource)
+            return
+
+        environ = build_environ(scope, body)
+        context = contextvars.copy_context()
+        status, headers, app_iter, iterator, chunks, done = \
+            await self.run(context, self.start, environ)
+
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': headers,
+            })
+
+            while True:
+                for chunk in chunks:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+
+                if done:
+                    break
+
+                chunks, done = await self.run(context, pull_chunks, iterator)
+
+            await send({'type': 'http.response.body', 'body': b'',
+                        'more_body': False})
+        finally:
+            if hasattr(app_iter, 'close'):
+                await self.run(context, app_iter.close)
+
+    def start(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'),
+                                    value.encode('latin-1'))
+                                   for name, value in headers]
+
+        app_iter = self.app(environ, start_response)
+        iterator = iter(app_iter)
+        chunks, done = pull_chunks(iterator)
+
+        return (response['status'], response['headers'], app_iter, iterator,
+                chunks, done)
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def changes_resource(self, scope):
+        match = CHANGES_PATH.match(build_environ(scope, b'')['PATH_INFO'])
+
+        if scope['method'] != 'GET' or match is None or self.app.config['CHANGES'] is None:
+            return None
+
+        if match.group(1) not in self.app.config['SCHEMA']:
+            return None
+
+        return match.group(1)
+
+    async def handle_changes(self, scope, receive, send, resource):
+        """ The changes route of the Flask app, without a worker thread """
+        feed = self.app.config['CHANGES']
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                   for name, value in scope.get('headers', [])}
+        args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+
+        try:
+            after, timeout = parse_changes_args(args, headers.get('last-event-id'))
+        except ValueError as e:
+            await self.send_json(send, 400, {'errors': [{
+                'title': 'Bad request', 'detail': str(e)}]})
+            return
+
+        if after is None:
+            after = feed.last
+
+        if not wants_event_stream(headers.get('accept')):
+            try:
+                changes, last = await feed.wait_async(resource, after, timeout)
+            except ChangesExpired as e:
+                await self.send_json(send, 410, {'errors': [{
+                    'title': 'Changes expired', 'detail': str(e)}]})
+                return
+
+            await self.send_json(send, 200, changes_document(changes, last))
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 2000\n\n',
+                    'more_body': True})
+
+        heartbeat = self.app.config['CHANGES_HEARTBEAT']
+        disconnect = asyncio.ensure_future(receive())
+
+        try:
+            while not feed.closed:
+                waiting = asyncio.ensure_future(feed.wait_async(resource, after, heartbeat))
+                await asyncio.wait({waiting, disconnect},
+                                   return_when=asyncio.FIRST_COMPLETED)
+
+                if disconnect.done():
+                    waiting.cancel()
+                    return
+
+                try:
+                    changes, after = waiting.result()
+                    chunk = b''.join(format_event(change) for change in changes) \
+                        or KEEP_ALIVE
+                except ChangesExpired:
+                    after = feed.last
+                    chunk = format_reset(after)
+
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+
+            await send({'type': 'http.response.body', 'body': b'',
+                        'more_body': False})
+        finally:
+            disconnect.cancel()
+
+    async def send_json(self, send, status, obj):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/vnd.api+json')],
+        })
+        await send({'type': 'http.response.body',
+                    'body': self.app.config['JSON_ENCODER'](obj), 'more_body': False})
+
+    def close(self):
+        if self.app.config['CHANGES'] is not None:
+            self.app.config['CHANGES'].close()
+        self.executor.shutdown(wait=True)
+        self.app.config['POOL'].close()
+        self.app.config['WRITER'].close()
+        if self.app.config['REPLICAS'] is not None:
+            self.app.config['REPLICAS'].close()
+
+
+def pull_chunks(iterator):
+    """ Next non-empty chunks up to about CHUNK_BYTES, and whether that was all """
+    chunks = []
+    size = 0
+
+    while size < CHUNK_BYTES:
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return chunks, True
+
+        if len(chunk) > 0:
+            chunks.append(chunk)
+            size += len(chunk)
+
+    return chunks, False
+
+
+async def read_body(receive, max_size=None):
+    """ The full request body, or None if the client went away first
+
+    Raises BodyTooLarge as soon as more than max_size bytes have arrived,
+    so an oversized body is never held in memory whole.
+    """
+    parts = []
+    size = 0
+
+    while True:
+        message = await receive()
+
+        if message['type'] == 'http.disconnect':
+            return None
+
+        part = message.get('body', b'')
+        size += len(part)
+
+        if max_size is not None and size > max_size:
+            raise BodyTooLarge()
+
+        parts.append(part)
+
+        if not message.get('more_body', False):
+            return b''.join(parts)
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    path = scope.get('raw_path') or scope['path'].encode('utf-8')
+    path = path.split(b'?', 1)[0].decode('latin-1')
+    root_path = scope.get('root_path', '')
+
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+
+        if name == 'CONTENT_LENGTH':
+            continue
+
+        key = 'HTTP_' + name
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+    return environ
+
+
+def create_asgi_app(database='app.db', max_threads=None, **kwargs):
+    """ ASGI entry point serving the same routes as create_app
+
+    Run it with any ASGI server, e.g.
+    `uvicorn --factory 'quicksand.asgi:create_asgi_app'`. Other keyword
+    arguments go to create_app. max_threads defaults to the pool size.
+    """
+    return AsgiApp(create_app(database, **kwargs), max_threads)
@@ -0,0 +1,125 @@
+import threading
+from collections import OrderedDict
+
+
+# Rough per-entry bookkeeping cost on top of the key and body bytes
+ENTRY_OVERHEAD = 200
+
+
+class CachedResponse:
+    def __init__(self, etag, body, content_type, tables, bodies=None):
+        self.etag = etag
+        self.body = body
+        self.content_type = content_type
+        self.tables = frozenset(tables)
+        # Compressed copies of body, by content coding
+        self.bodies = dict(bodies or {})
+        self.size = len(body) + sum(map(len, self.bodies.values())) + ENTRY_OVERHEAD
+
+
+class ResponseCache:
+    """ LRU cache of encoded GET responses bounded by total body bytes
+
+    Entries are keyed by URL and only served while their ETag still matches,
+    so a write that bumps a table version makes them unreachable even before
+    invalidate drops them.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._by_table = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry.etag != etag:
+                self.stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, key, entry):
+        size = entry.size + len(key)
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(key)
+
+            while self.bytes + size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats['evictions'] += 1
+
+            self._entries[key] = entry
+            self.bytes += size
+
+            for table in entry.tables:
+                self._by_table.setdefault(table, set()).add(key)
+
+    def add_body(self, key, entry, encoding, body):
+        """ Keeps body, entry's body compressed with encoding, for later hits """
+        with self._lock:
+            if self._entries.get(key) is not entry or encoding in entry.bodies:
+                return
+
+            entry.bodies[encoding] = body
+            entry.size += len(body)
+            self.bytes += len(body)
+
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, tables):
+        with self._lock:
+            keys = set()
+            for table in tables:
+                keys.update(self._by_table.get(table, ()))
+
+            for key in keys:
+                self._remove(key)
+
+            self.stats['invalidations'] += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_table.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return
+
+        self.bytes -= entry.size + len(key)
+
+        for table in entry.tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._by_table[table]
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self.bytes,
+                        max_bytes=self.max_bytes)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import threading
+import time
+
+
+# Longest a long-poll request or a quiet SSE interval may wait, in seconds
+MAX_WAIT = 60
+
+
+class ChangesExpired(Exception):
+    """ The requested position is older than the oldest buffered change """
+
+
+class Change:
+    def __init__(self, sequence, resource, action, id, timestamp):
+        self.sequence = sequence
+        self.resource = resource
+        self.action = action
+        self.id = id
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        return {
+            'sequence': self.sequence,
+            'action': self.action,
+            'time': self.timestamp,
+            'data': {'type': self.resource, 'id': self.id},
+        }
+
+
+class ChangeFeed:
+    """ Ring buffer of create, update and delete events with sequence ids
+
+    Writers publish after committing. Subscribers read the events after the
+    last sequence id they saw, so a reconnecting client resumes where it left
+    off as long as its position is still buffered. Waiting subscribers are
+    woken by publish, from threads or from asyncio event loops, and never
+    touch the database.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.slots = [None] * size
+        self.last = 0
+        self.closed = False
+        self._condition = threading.Condition()
+        self._waiters = set()
+
+    @property
+    def first(self):
+        """ Sequence id of the oldest buffered change """
+        return max(1, self.last - self.size + 1)
+
+    def publish(self, resource, action, ids):
+        now = time.time()
+
+        with self._condition:
+            for id in ids:
+                self.last += 1
+                self.slots[self.last % self.size] = Change(self.last, resource, action,
+                                                           id, now)
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, set()
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake, future)
+
+    def read(self, resource, after):
+        """ Buffered changes of resource after the sequence id after
+
+        Returns them with the sequence id to resume from, which is past any
+        changes of other resources that were skipped.
+        """
+        with self._condition:
+            return self._read(resource, after)
+
+    def _read(self, resource, after):
+        if after < self.first - 1:
+            raise ChangesExpired(f'Changes after {after} are no longer buffered; '
+                                 f'the oldest is {self.first}')
+
+        # e.g. a position from before the server restarted
+        if after > self.last:
+            raise ChangesExpired(f'Unknown position {after}; the newest is {self.last}')
+
+        changes = []
+
+        for sequence in range(max(after + 1, self.first), self.last + 1):
+            change = self.slots[sequence % self.size]
+            if change.resource == resource:
+                changes.append(change)
+
+        return changes, max(after, self.last)
+
+    def wait(self, resource, after, timeout):
+        """ read, waiting up to timeout seconds for changes to arrive """
+        deadline = time.monotonic() + timeout
+
+        with self._condition:
+            while True:
+                changes, after = self._read(resource, after)
+                remaining = deadline - time.monotonic()
+
+                if len(changes) > 0 or remaining <= 0 or self.closed:
+                    return changes, after
+
+                self._condition.wait(remaining)
+
+    async def wait_async(self, resource, after, timeout):
+        """ wait for coroutines, which suspends instead of holding a thread """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while True:
+            with self._condition:
+                changes, after = self._read(resource, after)
+                remaining = deadline - loop.time()
+
+                if len(changes) > 0 or remaining <= 0 or self.closed:
+                    return changes, after
+
+                future = loop.create_future()
+                waiter = (loop, future)
+                self._waiters.add(waiter)
+
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condition:
+                    self._waiters.discard(waiter)
+
+    def close(self):
+        """ Ends waits, so open streams finish and servers can shut down """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, set()
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake, future)
+
+
+def wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def parse_changes_args(args, last_event_id=None, default_timeout=25):
+    """ Position and wait time from after=, timeout= and Last-Event-ID
+
+    Without a position the client starts from the newest change. Raises
+    ValueError for malformed values.
+    """
+    after = args.get('after', last_event_id)
+
+    try:
+        after = None if after is None else int(after)
+        timeout = float(args.get('timeout', default_timeout))
+    except ValueError:
+        raise ValueError('after must be an integer and timeout a number')
+
+    if (after is not None and after < 0) or timeout < 0:
+        raise ValueError('after and timeout cannot be negative')
+
+    return after, min(timeout, MAX_WAIT)
+
+
+def wants_event_stream(accept):
+    return 'text/event-stream' in (accept or '')
+
+
+def changes_document(changes, last):
+    return {
+        'data': [change.to_dict() for change in changes],
+        'meta': {'last': last},
+    }
+
+
+def format_event(change):
+    return (f'id: {change.sequence}\nevent: {change.action}\n'
+            f'data: {json.dumps(change.to_dict())}\n\n').encode('utf-8')
+
+
+def format_reset(last):
+    """ Tells an SSE client that it missed changes and should refetch """
+    return f'id: {last}\nevent: reset\ndata: {{"last": {last}}}\n\n'.encode('utf-8')
+
+
+KEEP_ALIVE = b': keep-alive\n\n'
+
+
+def stream_changes(feed, resource, after, heartbeat):
+    """ SSE body for a thread-per-connection server, until the feed closes """
+    yield b'retry: 2000\n\n'
+
+    while not feed.closed:
+        try:
+            changes, after = feed.wait(resource, after, heartbeat)
+        except ChangesExpired:
+            after = feed.last
+            yield format_reset(after)
+            continue
+
+        if len(changes) == 0:
+            yield KEEP_ALIVE
+            continue
+
+        for change in changes:
+            yield format_event(change)
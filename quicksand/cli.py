@@ -0,0 +1,107 @@
+import argparse
+from .server import create_app
+from .prefork import PreforkServer
+from .replicas import snapshot
+
+
+def parse_pragma(value):
+    name, sep, setting = value.partition('=')
+
+    if sep == '':
+        raise argparse.ArgumentTypeError(f'Expected name=value, got "{value}"')
+
+    return name, setting
+
+
+def parse_search(value):
+    table, sep, columns = value.partition('=')
+
+    if sep == '' or columns == '':
+        raise argparse.ArgumentTypeError(f'Expected table=column,..., got "{value}"')
+
+    return table, columns.split(',')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='quicksand')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='Serve the API for a database')
+    serve.add_argument('database', nargs='?', default='app.db')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=5000)
+    serve.add_argument('--workers', type=int, default=1,
+                       help='worker processes forked after the app is built')
+    serve.add_argument('--pool-size', type=int, default=5)
+    serve.add_argument('--cache-size', type=int, default=0,
+                       help='response cache budget in bytes per worker')
+    serve.add_argument('--pragma', type=parse_pragma, action='append', default=[],
+                       metavar='NAME=VALUE', help='e.g. --pragma journal_mode=wal')
+    serve.add_argument('--relationship-cache', metavar='PATH',
+                       help='file to keep inferred relationships in between starts')
+    serve.add_argument('--profile-sample-rate', type=float, default=0.0,
+                       help='fraction of requests profiled for /_debug/profile')
+    serve.add_argument('--debug-endpoints', action='store_true',
+                       help='serve /metrics and /_debug/profile, which show SQL text')
+    serve.add_argument('--slow-query-ms', type=float, default=100)
+    serve.add_argument('--slow-request-ms', type=float, default=500)
+    serve.add_argument('--replica', action='append', default=[], metavar='PATH',
+                       help='read-only snapshot of the database for GET requests')
+    serve.add_argument('--replica-interval', type=float, default=0,
+                       help='seconds between snapshots taken by the server; '
+                       '0 when replicas are copied in by other means')
+    serve.add_argument('--search', type=parse_search, action='append', default=[],
+                       metavar='TABLE=COLUMN,...',
+                       help='full-text index for filter[search], e.g. articles=title,body')
+    serve.add_argument('--schema-poll-interval', type=float, default=1.0,
+                       help='seconds between checks for schema changes; 0 to disable')
+    serve.add_argument('--compress-min-size', type=int, default=1024,
+                       help='smallest response body in bytes to compress')
+    serve.add_argument('--no-compress', action='store_true',
+                       help='send responses uncompressed whatever Accept-Encoding says')
+
+    copy = commands.add_parser('snapshot', help='Copy a database to replica files')
+    copy.add_argument('database')
+    copy.add_argument('replicas', nargs='+')
+
+    return parser
+
+
+def serve(args):
+    def app_factory():
+        return create_app(args.database, pool_size=args.pool_size,
+                          cache_size=args.cache_size, pragmas=dict(args.pragma),
+                          relationship_cache=args.relationship_cache,
+                          profile_sample_rate=args.profile_sample_rate,
+                          slow_query_ms=args.slow_query_ms,
+                          slow_request_ms=args.slow_request_ms,
+                          replicas=args.replica,
+                          replica_interval=args.replica_interval,
+                          schema_poll_interval=args.schema_poll_interval,
+                          search=dict(args.search),
+                          compress_min_size=None if args.no_compress
+                          else args.compress_min_size,
+                          debug_endpoints=args.debug_endpoints,
+                          # Each worker would only see its own writes
+                          changes_buffer=1024 if args.workers <= 1 else 0)
+
+    if args.workers <= 1:
+        app_factory().run(host=args.host, port=args.port, threaded=True)
+        return
+
+    PreforkServer(app_factory, args.host, args.port, args.workers).run()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == 'serve':
+        serve(args)
+
+    if args.command == 'snapshot':
+        for replica in args.replicas:
+            snapshot(args.database, replica)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Levels that favor speed, since most bodies are compressed per request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+
+def available_encodings():
+    """ Content codings this install can produce, in order of preference
+
+    zstd and br need the zstandard and brotli packages. gzip is always there.
+    """
+    encodings = []
+
+    if zstandard is not None:
+        encodings.append('zstd')
+
+    if brotli is not None:
+        encodings.append('br')
+
+    encodings.append('gzip')
+    return encodings
+
+
+def negotiate(accept_encodings, encodings):
+    """ The one of encodings an Accept-Encoding header prefers, or None
+
+    Among encodings of the same quality, the first of encodings wins.
+    """
+    return accept_encodings.best_match(encodings)
+
+
+def compress(body, encoding):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, wbits=31)
+        return compressor.compress(body) + compressor.flush()
+
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+
+    raise ValueError(f'Unknown content coding "{encoding}"')
+
+
+def stream_compressor(encoding):
+    """ (compress, finish) functions compressing a body one chunk at a time
+
+    compress flushes after every chunk, so what a chunk holds reaches the
+    client as soon as it is produced.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, wbits=31)
+        return (lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH),
+                compressor.flush)
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return (lambda data: compressor.process(data) + compressor.flush(),
+                compressor.finish)
+
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return (lambda data: compressor.compress(data) +
+                compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                compressor.flush)
+
+    raise ValueError(f'Unknown content coding "{encoding}"')
+
+
+def compress_stream(chunks, encoding):
+    """ Compressed chunks of an iterable of body chunks
+
+    Closing the result closes chunks, which may hold a database cursor.
+    """
+    step, finish = stream_compressor(encoding)
+
+    try:
+        for chunk in chunks:
+            data = step(chunk)
+            if len(data) > 0:
+                yield data
+
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
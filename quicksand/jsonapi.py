@@ -1,22 +1,71 @@
-from flask import make_response
+import json
+from flask import Response, current_app
+from .profiling import measure
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_stdlib(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def encode_orjson(obj):
+    return orjson.dumps(obj)
+
+
+def load_json_encoder(encoder='auto'):
+    """ Returns a function that encodes an object to JSON bytes
+
+    encoder is 'auto' (orjson when installed, else stdlib), 'orjson', 'json'
+    or a callable returning bytes.
+    """
+    if callable(encoder):
+        return encoder
+
+    if encoder == 'auto':
+        return encode_stdlib if orjson is None else encode_orjson
+
+    if encoder == 'orjson':
+        if orjson is None:
+            raise ValueError('The orjson encoder requires the orjson package')
+        return encode_orjson
+
+    if encoder == 'json':
+        return encode_stdlib
+
+    raise ValueError(f'Unknown JSON encoder "{encoder}"')
+
+
+def encode_json(obj):
+    with measure('encode'):
+        return current_app.config['JSON_ENCODER'](obj)
 
 
 def make_null_relationship_response():
-    response = make_response({'data': None})
-    response.status_code = 200
+    return make_jsonapi_response({'data': None})
+
+
+def make_empty_relationship_response():
+    return make_jsonapi_response({'data': []})
+
+
+def make_jsonapi_response(data, status_code=200):
+    response = Response(encode_json(data), status=status_code)
     response.headers['Content-Type'] = 'application/vnd.api+json'
     return response
 
 
-def make_empty_relationship_response():
-    response = make_response({'data': []})
-    response.status_code = 200
+def make_jsonapi_body_response(body, status_code=200):
+    """ Response for a document that is already encoded """
+    response = Response(body, status=status_code)
     response.headers['Content-Type'] = 'application/vnd.api+json'
     return response
 
 
-def make_jsonapi_response(data, status_code=200):
-    response = make_response(data)
+def make_jsonapi_stream_response(chunks, status_code=200):
+    response = Response(chunks, status=status_code)
     response.headers['Content-Type'] = 'application/vnd.api+json'
-    response.status_code = status_code
     return response
@@ -0,0 +1,211 @@
+import sqlite3
+from .relationships import BelongsTo, HasMany
+
+
+class OperationError(Exception):
+    def __init__(self, status, title, detail, index=None):
+        super().__init__(detail)
+        self.status = status
+        self.title = title
+        self.detail = detail
+        self.index = index
+
+    def to_error_object(self, pointer='/atomic:operations'):
+        """ JSON:API error object, pointing at item index of the array at pointer """
+        error = {
+            'status': str(self.status),
+            'title': self.title,
+            'detail': self.detail,
+        }
+
+        if self.index is not None:
+            error['source'] = {'pointer': f'{pointer}/{self.index}'}
+
+        return error
+
+
+class Operation:
+    def __init__(self, op, resource, index, id=None, values=None, links=None):
+        self.op = op
+        self.resource = resource
+        self.index = index
+        self.id = id
+        self.values = values if values is not None else {}
+        self.links = links if links is not None else []
+
+    def group_key(self):
+        return self.op, self.resource, tuple(self.values.keys())
+
+
+def parse_resource_object(data, relationships):
+    """ Splits a resource object into column values and HasMany linkage
+
+    BelongsTo linkage becomes a value for the `<name>_id` column. HasMany
+    linkage is returned as (relationship, [related ids]) pairs, since it is
+    stored in the related table.
+    """
+    values = dict(data.get('attributes', {}))
+    links = []
+
+    for relationship in relationships:
+        try:
+            rel_data = data['relationships'][relationship.name]['data']
+        except (KeyError, TypeError):
+            continue
+
+        if isinstance(relationship, BelongsTo):
+            try:
+                rel_resource_type = rel_data['type']
+                rel_id = rel_data['id']
+            except (KeyError, TypeError):
+                continue
+
+            if rel_resource_type != relationship.related_resource:
+                continue
+
+            values[relationship.name + '_id'] = rel_id
+
+        elif isinstance(relationship, HasMany):
+            try:
+                links.append((relationship, [item['id'] for item in rel_data]))
+            except (KeyError, TypeError):
+                continue
+
+    return values, links
+
+
+def parse_operations(body, all_relationships):
+    """ Operations from a JSON:API atomic:operations document """
+    try:
+        items = body['atomic:operations']
+    except (KeyError, TypeError):
+        raise OperationError(400, 'Bad request', 'Missing "atomic:operations"')
+
+    if not isinstance(items, list):
+        raise OperationError(400, 'Bad request', '"atomic:operations" must be a list')
+
+    return [parse_operation(item, index, all_relationships)
+            for index, item in enumerate(items)]
+
+
+def parse_operation(item, index, all_relationships):
+    try:
+        op = item['op']
+
+        if op == 'add':
+            data = item['data']
+            resource = data['type']
+            check_resource(resource, index, all_relationships)
+            values, links = parse_resource_object(data, all_relationships[resource])
+            return Operation('add', resource, index, values=values, links=links)
+
+        if op == 'update':
+            data = item['data']
+            resource = data['type']
+            id = data['id'] if 'id' in data else item['ref']['id']
+            check_resource(resource, index, all_relationships)
+            values, links = parse_resource_object(data, all_relationships[resource])
+            return Operation('update', resource, index, id, values, links)
+
+        if op == 'remove':
+            ref = item['ref']
+            check_resource(ref['type'], index, all_relationships)
+            return Operation('remove', ref['type'], index, ref['id'])
+
+    except (KeyError, TypeError) as e:
+        raise OperationError(400, 'Bad request',
+                             f'Malformed operation, missing {e}', index)
+
+    raise OperationError(400, 'Bad request', f'Unknown op "{op}"', index)
+
+
+def check_resource(resource, index, all_relationships):
+    if resource not in all_relationships:
+        raise OperationError(400, 'Bad request', f'Unknown type "{resource}"', index)
+
+
+def group_operations(operations):
+    """ Splits operations into runs that can share one executemany """
+    groups = []
+
+    for operation in operations:
+        if len(groups) > 0 and groups[-1][0].group_key() == operation.group_key():
+            groups[-1].append(operation)
+        else:
+            groups.append([operation])
+
+    return groups
+
+
+def run_operations(db, operations, serializers):
+    """ Runs operations in one transaction, rolling all back if any fails
+
+    Returns the set of touched tables and the rows of added or updated
+    resources keyed by (resource, str(id)).
+    """
+    touched = set()
+    rows = {}
+
+    with db.transaction():
+        for group in group_operations(operations):
+            try:
+                run_group(db, group)
+            except (sqlite3.Error, ValueError) as e:
+                status = 409 if isinstance(e, sqlite3.IntegrityError) else 400
+                raise OperationError(status, 'Operation failed', str(e),
+                                     group[0].index)
+
+            touched.add(group[0].resource)
+            touched.update(rel.lookup_table for op in group for rel, _ in op.links)
+
+        for resource in dict.fromkeys(op.resource for op in operations
+                                      if op.op != 'remove'):
+            serializer = serializers[resource]
+            ids = [op.id for op in operations
+                   if op.op != 'remove' and op.resource == resource]
+            for row in db.find_by_ids(resource, ids):
+                rows[(resource, str(serializer.id(row)))] = row
+
+    return touched, rows
+
+
+def run_group(db, group):
+    first = group[0]
+    columns = list(first.values.keys())
+
+    if first.op == 'add':
+        ids = db.insert_many(first.resource, columns,
+                             [tuple(op.values.values()) for op in group])
+        for op, id in zip(group, ids):
+            op.id = id
+
+    elif first.op == 'update':
+        check_exists(db, group)
+        if len(columns) > 0:
+            db.update_many(first.resource, columns,
+                           [list(op.values.values()) + [op.id] for op in group])
+
+    elif first.op == 'remove':
+        check_exists(db, group)
+        db.delete_many(first.resource, [op.id for op in group])
+
+    link_updates = {}
+    for op in group:
+        for relationship, related_ids in op.links:
+            key = (relationship.lookup_table, relationship.lookup_id)
+            link_updates.setdefault(key, []).extend(
+                [op.id, related_id] for related_id in related_ids)
+
+    for (table, column), link_rows in link_updates.items():
+        db.update_many(table, [column], link_rows)
+
+
+def check_exists(db, group):
+    found = db.existing_ids(group[0].resource, [op.id for op in group])
+    found = {str(id) for id in found}
+
+    for op in group:
+        if str(op.id) not in found:
+            raise OperationError(404, 'Resource not found',
+                                 f'Resource "{op.resource}" with id "{op.id}" not found',
+                                 op.index)
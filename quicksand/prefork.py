@@ -0,0 +1,182 @@
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from werkzeug.serving import make_server
+from .server import reset_after_fork
+
+
+class PreforkServer:
+    """ Runs several worker processes accepting on one shared socket
+
+    The app, and with it the schema catalog, relationship map and compiled
+    serializers, is built once in the master before forking, so workers share
+    those pages copy-on-write instead of each introspecting the database.
+    Each worker then takes its own ETag token, connections and cache. A
+    change feed would only see the writes of its own worker, so the app must
+    be built without one.
+    Workers that die are replaced. SIGHUP rebuilds the app and replaces the
+    workers one at a time. SIGTERM and SIGINT drain in-flight requests and
+    stop.
+    """
+    def __init__(self, app_factory, host='127.0.0.1', port=5000, workers=2,
+                 graceful_timeout=30):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Multiple workers need os.fork')
+
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.pids = set()
+        self.stopping = False
+        self.reload_requested = False
+        self.socket = None
+        self.app = None
+
+    def bind(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(128)
+        self.socket.set_inheritable(True)
+        self.port = self.socket.getsockname()[1]
+
+    def run(self):
+        if self.socket is None:
+            self.bind()
+
+        self.app = self.check_app(self.app_factory())
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        print(f'Serving on http://{self.host}:{self.port} with '
+              f'{self.workers} workers', file=sys.stderr)
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+
+            self.reap()
+
+            while len(self.pids) < self.workers and not self.stopping:
+                self.spawn()
+
+            time.sleep(0.2)
+
+        self.stop_workers(self.pids)
+        self.socket.close()
+
+    def spawn(self):
+        pid = os.fork()
+
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                reset_after_fork(self.app)
+                run_worker(self.app, self.socket)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+
+        self.pids.add(pid)
+        return pid
+
+    def reap(self):
+        for pid in list(self.pids):
+            try:
+                finished, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                finished = pid
+
+            if finished == pid:
+                self.pids.discard(pid)
+
+    def check_app(self, app):
+        if self.workers > 1 and app.config['CHANGES'] is not None:
+            raise ValueError('The change feed is kept per process and cannot be '
+                             'served by several workers; build the app with '
+                             'changes_buffer=0')
+
+        return app
+
+    def reload(self):
+        """ Rebuilds the app and rolls the workers over to it one by one """
+        old, self.app = self.app, self.check_app(self.app_factory())
+
+        # Stop the old app's replica refreshes, which run in the master
+        if old.config['REPLICAS'] is not None:
+            old.config['REPLICAS'].close()
+
+        for old in list(self.pids):
+            self.spawn()
+            self.stop_workers([old])
+
+    def stop_workers(self, pids):
+        pids = set(pids)
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + self.graceful_timeout
+
+        while len(pids) > 0 and time.monotonic() < deadline:
+            for pid in list(pids):
+                try:
+                    finished, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    finished = pid
+
+                if finished == pid:
+                    pids.discard(pid)
+                    self.pids.discard(pid)
+
+            time.sleep(0.05)
+
+        for pid in pids:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.pids.discard(pid)
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+
+def run_worker(app, listening_socket):
+    """ Serves app with request threads until SIGTERM, then drains them """
+    host, port = listening_socket.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True,
+                         fd=listening_socket.fileno())
+    # Let server_close wait for requests that are still running
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    server.serve_forever()
+    server.server_close()
+    app.config['POOL'].close()
+    app.config['WRITER'].close()
+    if app.config['REPLICAS'] is not None:
+        app.config['REPLICAS'].close()
@@ -0,0 +1,250 @@
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from flask import g
+
+
+# Upper bounds in seconds of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Fields of RequestProfile summed per route for sampled requests
+PROFILE_FIELDS = ('db_time', 'queries', 'rows', 'serialize_time', 'encode_time')
+
+
+class RequestProfile:
+    """ Time spent by one sampled request in SQL, serialization and encoding """
+    def __init__(self, slow_query_time=None):
+        self.started = time.perf_counter()
+        self.slow_query_time = slow_query_time
+        self.db_time = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.serialize_time = 0.0
+        self.encode_time = 0.0
+        self.slow_queries = []
+
+    def query(self, sql, elapsed, rows):
+        self.db_time += elapsed
+        self.queries += 1
+        self.rows += rows
+
+        if self.slow_query_time is not None and elapsed >= self.slow_query_time:
+            self.slow_queries.append((sql, elapsed, rows))
+
+    @contextmanager
+    def measure(self, kind):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            setattr(self, f'{kind}_time', getattr(self, f'{kind}_time') + elapsed)
+
+    def to_dict(self):
+        return {
+            'db_ms': round(self.db_time * 1000, 3),
+            'queries': self.queries,
+            'rows': self.rows,
+            'serialize_ms': round(self.serialize_time * 1000, 3),
+            'encode_ms': round(self.encode_time * 1000, 3),
+        }
+
+
+def measure(kind):
+    """ Adds the time of the enclosed block to the request's profile, if sampled """
+    profile = g.get('profile')
+
+    if profile is None:
+        return nullcontext()
+
+    return profile.measure(kind)
+
+
+class Profiler:
+    """ Request metrics, with a timing breakdown for a sample of requests
+
+    Every request is counted in a duration histogram per route. A
+    sample_rate fraction of them also record SQL, serialization and encode
+    time. Sampled queries slower than slow_query_ms and sampled requests
+    slower than slow_request_ms are kept in bounded logs.
+    """
+    def __init__(self, sample_rate=0.0, slow_query_ms=100, slow_request_ms=500,
+                 log_size=100):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError('sample_rate must be between 0 and 1')
+
+        self.sample_rate = sample_rate
+        self.slow_query_time = slow_query_ms / 1000
+        self.slow_request_time = slow_request_ms / 1000
+        self.requests = {}
+        self.sampled = {}
+        self.slow_queries = deque(maxlen=log_size)
+        self.slow_requests = deque(maxlen=log_size)
+        self.slow_query_count = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ A profile for the request if it is sampled, otherwise None """
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return RequestProfile(self.slow_query_time)
+
+        return None
+
+    def record(self, method, route, status, elapsed, profile=None):
+        key = (method, route, str(status))
+        now = time.time()
+
+        with self._lock:
+            counts = self.requests.get(key)
+
+            if counts is None:
+                counts = self.requests[key] = {
+                    'count': 0,
+                    'sum': 0.0,
+                    'buckets': [0] * len(DURATION_BUCKETS),
+                }
+
+            counts['count'] += 1
+            counts['sum'] += elapsed
+
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if elapsed <= bound:
+                    counts['buckets'][i] += 1
+
+            if profile is None:
+                return
+
+            totals = self.sampled.setdefault(route, dict.fromkeys(PROFILE_FIELDS, 0))
+            totals['count'] = totals.get('count', 0) + 1
+
+            for field in PROFILE_FIELDS:
+                totals[field] += getattr(profile, field)
+
+            for sql, query_time, rows in profile.slow_queries:
+                self.slow_query_count += 1
+                self.slow_queries.append({
+                    'sql': sql,
+                    'ms': round(query_time * 1000, 3),
+                    'rows': rows,
+                    'route': route,
+                    'time': now,
+                })
+
+            if elapsed >= self.slow_request_time:
+                self.slow_requests.append(dict(profile.to_dict(), **{
+                    'method': method,
+                    'route': route,
+                    'status': status,
+                    'ms': round(elapsed * 1000, 3),
+                    'time': now,
+                }))
+
+    def report(self):
+        with self._lock:
+            routes = {}
+
+            for (method, route, status), counts in sorted(self.requests.items()):
+                summary = routes.setdefault(route, {'count': 0, 'total_ms': 0.0,
+                                                    'status': {}})
+                summary['count'] += counts['count']
+                summary['total_ms'] += counts['sum'] * 1000
+                summary['status'][status] = summary['status'].get(status, 0) + counts['count']
+
+            for route, totals in self.sampled.items():
+                count = totals['count']
+                routes[route]['sampled'] = {
+                    'count': count,
+                    'avg_db_ms': round(totals['db_time'] * 1000 / count, 3),
+                    'avg_queries': round(totals['queries'] / count, 2),
+                    'avg_rows': round(totals['rows'] / count, 2),
+                    'avg_serialize_ms': round(totals['serialize_time'] * 1000 / count, 3),
+                    'avg_encode_ms': round(totals['encode_time'] * 1000 / count, 3),
+                }
+
+            for summary in routes.values():
+                summary['avg_ms'] = round(summary.pop('total_ms') / summary['count'], 3)
+
+            return {
+                'sample_rate': self.sample_rate,
+                'slow_query_ms': self.slow_query_time * 1000,
+                'slow_request_ms': self.slow_request_time * 1000,
+                'routes': routes,
+                'slow_queries': list(self.slow_queries),
+                'slow_requests': list(self.slow_requests),
+            }
+
+    def render_metrics(self, extra=()):
+        """ Prometheus text exposition of the request metrics
+
+        extra holds more (name, type, help, [(labels, value)]) metrics to add.
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+        with self._lock:
+            requests = [(key, dict(counts, buckets=list(counts['buckets'])))
+                        for key, counts in sorted(self.requests.items())]
+            sampled = [(route, dict(totals)) for route, totals in sorted(self.sampled.items())]
+            slow_query_count = self.slow_query_count
+
+        metric('quicksand_requests_total', 'counter', 'Requests handled',
+               [({'method': m, 'route': r, 'status': s}, c['count'])
+                for (m, r, s), c in requests])
+
+        lines.append('# HELP quicksand_request_duration_seconds Request duration')
+        lines.append('# TYPE quicksand_request_duration_seconds histogram')
+
+        for (method, route, status), counts in requests:
+            labels = {'method': method, 'route': route, 'status': status}
+
+            for bound, count in zip(DURATION_BUCKETS, counts['buckets']):
+                bucket = format_labels(dict(labels, le=str(bound)))
+                lines.append(f'quicksand_request_duration_seconds_bucket{bucket} {count}')
+
+            bucket = format_labels(dict(labels, le='+Inf'))
+            lines.append(f'quicksand_request_duration_seconds_bucket{bucket} {counts["count"]}')
+            lines.append(f'quicksand_request_duration_seconds_sum{format_labels(labels)} '
+                         f'{counts["sum"]}')
+            lines.append(f'quicksand_request_duration_seconds_count{format_labels(labels)} '
+                         f'{counts["count"]}')
+
+        for name, field, help in [
+            ('quicksand_sampled_requests_total', 'count', 'Requests profiled'),
+            ('quicksand_db_seconds_total', 'db_time', 'SQL time of profiled requests'),
+            ('quicksand_db_queries_total', 'queries', 'SQL statements of profiled requests'),
+            ('quicksand_db_rows_total', 'rows', 'Rows read or written by profiled requests'),
+            ('quicksand_serialize_seconds_total', 'serialize_time',
+             'Serialization time of profiled requests'),
+            ('quicksand_encode_seconds_total', 'encode_time',
+             'JSON encoding time of profiled requests'),
+        ]:
+            metric(name, 'counter', help,
+                   [({'route': route}, totals[field]) for route, totals in sampled])
+
+        metric('quicksand_slow_queries_total', 'counter',
+               'Profiled SQL statements slower than the threshold',
+               [({}, slow_query_count)])
+
+        for name, kind, help, samples in extra:
+            metric(name, kind, help, samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,314 @@
+import re
+import threading
+from .sqlite_db import MAX_IN_PARAMETERS
+from .search import parse_search
+
+
+FILTER_KEY = re.compile(r'^filter\[([A-Za-z0-9_]+)\](?:\[([a-z]+)\])?$')
+FIELDS_KEY = re.compile(r'^fields\[([A-Za-z0-9_]+)\]$')
+
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'min', 'max', 'avg')
+
+FILTER_OPERATORS = {
+    'eq': '=',
+    'ne': '!=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<=',
+}
+
+
+class Query:
+    """ Validated filter and sort clauses for one table
+
+    Column names are checked against the table's columns, so they can be
+    written into the SQL. Values always go through parameters. search is
+    an (index table, FTS5 query) pair; matching rows are ordered by rank
+    unless sorted otherwise.
+    """
+    def __init__(self, filters=(), sort=(), search=None):
+        self.filters = list(filters)
+        self.sort = list(sort)
+        self.search = search
+
+        conditions = []
+        self.parameters = [] if search is None else [search[1]]
+
+        for column, op, value in self.filters:
+            if op == 'in':
+                conditions.append(f'{column} IN ({",".join("?" * len(value))})')
+                self.parameters.extend(value)
+            elif op == 'null':
+                conditions.append(f'{column} IS {"" if value else "NOT "}NULL')
+            else:
+                conditions.append(f'{column}{FILTER_OPERATORS[op]}?')
+                self.parameters.append(value)
+
+        self.where = ' AND '.join(conditions)
+
+        order = [f'{column} DESC' if descending else column
+                 for column, descending in self.sort]
+        if len(order) == 0 and search is not None:
+            order.append('search_rank')
+        if 'id' not in [column for column, _ in self.sort]:
+            order.append('id')
+        self.order_by = ','.join(order)
+
+    @property
+    def is_empty(self):
+        return len(self.filters) == 0 and len(self.sort) == 0 and self.search is None
+
+    @property
+    def columns(self):
+        return [column for column, _, _ in self.filters] + \
+               [column for column, _ in self.sort]
+
+    def select(self, table, columns, condition=None, order_by=None, limit=False):
+        conditions = [c for c in [self.where, condition] if c]
+        sql = f'SELECT {columns} FROM {self.source(table)}'
+
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        sql += f' ORDER BY {order_by or self.order_by}'
+
+        if limit:
+            sql += ' LIMIT ?'
+
+        return sql
+
+    def source(self, table):
+        """ The FROM clause: table, joined to its search matches if searching """
+        if self.search is None:
+            return table
+
+        index = self.search[0]
+        return (f'{table} JOIN (SELECT rowid AS search_id, rank AS search_rank '
+                f'FROM {index} WHERE {index} MATCH ?) AS search ON search_id={table}.id')
+
+    def aggregate(self, table, expressions, group_by=(), limit=False):
+        """ SELECT of the group_by columns and expressions over matching rows
+
+        Groups come back ordered by their columns.
+        """
+        sql = f'SELECT {",".join(list(group_by) + list(expressions))} FROM {self.source(table)}'
+
+        if self.where:
+            sql += ' WHERE ' + self.where
+
+        if len(group_by) > 0:
+            sql += f' GROUP BY {",".join(group_by)} ORDER BY {",".join(group_by)}'
+
+        if limit:
+            sql += ' LIMIT ?'
+
+        return sql
+
+    def seek(self, direction, id):
+        """ Condition, parameters and order of the rows past id, for paging
+
+        direction is '>' for the rows after id and '<' for the rows before
+        it. Rows are paged by id, and search results by rank, then id.
+        """
+        descending = ' DESC' if direction == '<' else ''
+
+        if self.search is None:
+            return f'id{direction}?', [id], f'id{descending}'
+
+        index, match = self.search
+        condition = (f'(search_rank,id){direction}(SELECT rank,rowid FROM {index} '
+                     f'WHERE {index} MATCH ? AND rowid=?)')
+        return condition, [match, id], f'search_rank{descending},id{descending}'
+
+
+def parse_query_args(args, columns, search_index=None):
+    """ Query for filter[column][op]=value and sort=-a,b query arguments
+
+    With a search_index, filter[search]=terms matches rows through it.
+    """
+    filters = []
+    search = None
+
+    for key, value in args.items():
+        if not key.startswith('filter['):
+            continue
+
+        match = FILTER_KEY.match(key)
+        if match is None:
+            raise ValueError(f'Invalid filter "{key}"')
+
+        column, op = match.group(1), match.group(2) or 'eq'
+
+        if column == 'search' and search_index is not None:
+            if match.group(2) is not None:
+                raise ValueError('filter[search] takes no operator')
+            search = (search_index, parse_search(value))
+            continue
+
+        check_column(column, columns, 'filter')
+
+        if op == 'in':
+            value = [item for item in value.split(',') if item != '']
+            if len(value) == 0 or len(value) > MAX_IN_PARAMETERS:
+                raise ValueError(f'{key} needs 1 to {MAX_IN_PARAMETERS} values')
+        elif op == 'null':
+            if value not in ('true', 'false'):
+                raise ValueError(f'{key} must be true or false')
+            value = value == 'true'
+        elif op not in FILTER_OPERATORS:
+            raise ValueError(f'Unknown filter operator "{op}"')
+
+        filters.append((column, op, value))
+
+    sort = []
+
+    for name in args.get('sort', '').split(','):
+        name = name.strip()
+        if name == '':
+            continue
+
+        descending = name.startswith('-')
+        column = name[1:] if descending else name
+        check_column(column, columns, 'sort')
+        sort.append((column, descending))
+
+    return Query(filters, sort, search)
+
+
+def parse_aggregate_args(args, columns):
+    """ (function, column) pairs and group columns from an aggregate query
+
+    aggregate=count,sum:score,avg:score names the functions, count by
+    default, and group_by=a,b the columns to group on. count may take a
+    column to count its non-null values.
+    """
+    aggregates = []
+
+    for name in args.get('aggregate', 'count').split(','):
+        name = name.strip()
+        if name == '':
+            continue
+
+        function, _, column = name.partition(':')
+
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError(f'Unknown aggregate function "{function}"')
+
+        if column == '':
+            if function != 'count':
+                raise ValueError(f'{function} needs a column, as {function}:column')
+            column = None
+        else:
+            check_column(column, columns, function)
+
+        aggregates.append((function, column))
+
+    if len(aggregates) == 0:
+        raise ValueError('aggregate needs at least one function')
+
+    group_by = [name.strip() for name in args.get('group_by', '').split(',')
+                if name.strip() != '']
+
+    for column in group_by:
+        check_column(column, columns, 'group by')
+
+    return list(dict.fromkeys(aggregates)), list(dict.fromkeys(group_by))
+
+
+def aggregate_name(function, column):
+    return function if column is None else f'{function}:{column}'
+
+
+def aggregate_sql(function, column):
+    return f'{function}({"*" if column is None else column})'
+
+
+def parse_fields_args(args):
+    """ Sparse fieldsets from fields[type]=a,b as {type: [names]} """
+    fields = {}
+
+    for key, value in args.items():
+        match = FIELDS_KEY.match(key)
+        if match is None:
+            continue
+
+        fields[match.group(1)] = [name.strip() for name in value.split(',')
+                                  if name.strip() != '']
+
+    return fields
+
+
+def check_column(column, columns, purpose):
+    if column not in columns:
+        raise ValueError(f'Cannot {purpose} on unknown column "{column}"')
+
+
+class IndexAdvisor:
+    """ Flags columns used for lookups that SQLite has no index for
+
+    HasMany lookups go through `<name>_id` columns, which are checked at
+    startup. Filter and sort columns are recorded as requests use them.
+    """
+    def __init__(self, schema, logger=None):
+        self.schema = schema
+        self.logger = logger
+        self.unindexed = {}
+        self._lock = threading.Lock()
+
+        for table in schema.table_names:
+            for column in schema[table].columns:
+                if column.endswith('_id'):
+                    self.check(table, column, 'relationship')
+
+    def check(self, table, column, usage):
+        if column in self.schema[table].indexed_columns:
+            return
+
+        key = (table, column)
+
+        with self._lock:
+            if key in self.unindexed:
+                self.unindexed[key].add(usage)
+                return
+
+            self.unindexed[key] = {usage}
+
+        if self.logger is not None:
+            self.logger.warning(f'No index on {table}.{column} used for {usage}; '
+                                f'consider: {create_index_sql(table, column)}')
+
+    def recheck(self):
+        """ Forgets columns that are now indexed or gone, after a schema reload """
+        with self._lock:
+            self.unindexed = {
+                (table, column): usages
+                for (table, column), usages in self.unindexed.items()
+                if table in self.schema and column in self.schema[table].columns
+                and column not in self.schema[table].indexed_columns
+            }
+
+        for table in self.schema.table_names:
+            for column in self.schema[table].columns:
+                if column.endswith('_id'):
+                    self.check(table, column, 'relationship')
+
+    def observe(self, table, query):
+        for column, _, _ in query.filters:
+            self.check(table, column, 'filter')
+
+        for column, _ in query.sort:
+            self.check(table, column, 'sort')
+
+    def report(self):
+        with self._lock:
+            return [{
+                'table': table,
+                'column': column,
+                'usage': sorted(usages),
+                'suggestion': create_index_sql(table, column),
+            } for (table, column), usages in sorted(self.unindexed.items())]
+
+
+def create_index_sql(table, column):
+    return f'CREATE INDEX {table}_{column}_idx ON {table} ({column});'
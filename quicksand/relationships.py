@@ -1,32 +1,140 @@
-import inflect
+import functools
+import hashlib
+import importlib.metadata
+import json
+import os
 
 
-def infer_relationships(db):
-    resources = {table: [] for table in db.table_names}
+_engine = None
+
+# Bump when inference or the cached fields change, so old cache files are
+# ignored instead of being read as current
+CACHE_FORMAT = 1
+
+
+def inflector():
+    """ The shared inflect engine, imported and built on first use """
+    global _engine
+
+    if _engine is None:
+        import inflect
+        _engine = inflect.engine()
+
+    return _engine
+
+
+@functools.lru_cache(maxsize=None)
+def plural(word):
+    return inflector().plural(word)
+
+
+@functools.lru_cache(maxsize=None)
+def singular(word):
+    return inflector().singular_noun(word)
+
+
+@functools.lru_cache(maxsize=None)
+def inflect_version():
+    """ Version of the inflect package, whose plurals decide related tables """
+    try:
+        return importlib.metadata.version('inflect')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def schema_hash(db):
+    """ Hash of the table and column names that relationships are inferred from """
+    tables = sorted((name, db.table_columns(name)) for name in db.table_names)
+    return hashlib.sha256(json.dumps(tables).encode('utf-8')).hexdigest()
+
+
+def infer_relationships(db, cache_path=None):
+    """ Relationships of every table, keyed by table name
+
+    With cache_path, the result is stored in that file along with the schema
+    hash and reused on later calls while the schema, CACHE_FORMAT and the
+    inflect version are unchanged.
+    """
+    if cache_path is not None:
+        digest = schema_hash(db)
+        resources = load_relationships(cache_path, digest)
+
+        if resources is not None:
+            return resources
 
-    p = inflect.engine()
+    resources = {table: [] for table in db.table_names}
 
     for resource in db.table_names:
         for column in db.table_columns(resource):
             if column.endswith('_id'):
                 belongs_to = column[:-3]
-                belongs_to_resource = p.plural(belongs_to)
+                belongs_to_resource = plural(belongs_to)
                 # resources[resource].append(('belongs_to', belongs_to))
                 # resources[belongs_to_resouce].append(('has_many', resource))
                 resources[resource].append(BelongsTo(resource, belongs_to))
                 resources[belongs_to_resource].append(HasMany(belongs_to_resource, resource))
 
+    if cache_path is not None:
+        save_relationships(cache_path, digest, resources)
 
     return resources
 
 
-class BelongsTo:
-    def __init__(self, resource, relationship_name):
-        p = inflect.engine()
-        self.name = relationship_name
-        self.related_resource = p.plural(relationship_name)
-        self.lookup_table = p.plural(relationship_name)
-        self.lookup_id = 'id'
+def load_relationships(cache_path, digest):
+    try:
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    if (cached.get('format') != CACHE_FORMAT or cached.get('inflect') != inflect_version()
+            or cached.get('schema_hash') != digest):
+        return None
+
+    kinds = {'belongs_to': BelongsTo, 'has_many': HasMany}
+
+    return {table: [kinds[item['kind']].from_dict(item) for item in items]
+            for table, items in cached['relationships'].items()}
+
+
+def save_relationships(cache_path, digest, resources):
+    cached = {
+        'format': CACHE_FORMAT,
+        'inflect': inflect_version(),
+        'schema_hash': digest,
+        'relationships': {table: [rel.to_dict() for rel in rels]
+                          for table, rels in resources.items()},
+    }
+
+    # Write then rename, so concurrent readers never see a partial file
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+
+    with open(temp_path, 'w') as cache_file:
+        json.dump(cached, cache_file)
+
+    os.replace(temp_path, cache_path)
+
+
+class Relationship:
+    kind = None
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'name': self.name,
+            'related_resource': self.related_resource,
+            'lookup_table': self.lookup_table,
+            'lookup_id': self.lookup_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        relationship = cls.__new__(cls)
+        relationship.name = data['name']
+        relationship.related_resource = data['related_resource']
+        relationship.lookup_table = data['lookup_table']
+        relationship.lookup_id = data['lookup_id']
+        return relationship
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
@@ -36,25 +144,97 @@ class BelongsTo:
                self.lookup_table == other.lookup_table and \
                self.lookup_id == other.lookup_id
 
+
+class BelongsTo(Relationship):
+    kind = 'belongs_to'
+
+    def __init__(self, resource, relationship_name):
+        self.name = relationship_name
+        self.related_resource = plural(relationship_name)
+        self.lookup_table = plural(relationship_name)
+        self.lookup_id = 'id'
+
     def __repr__(self):
         return f'<BelongsTo name={self.name}, lookup_table={self.lookup_table}, lookup_id={self.lookup_id}>'
 
 
-class HasMany:
+class HasMany(Relationship):
+    kind = 'has_many'
+
     def __init__(self, resource, relationship_name):
-        p = inflect.engine()
         self.name = relationship_name
         self.related_resource = relationship_name
         self.lookup_table = relationship_name
-        self.lookup_id = p.singular_noun(resource) + '_id'
-
-    def __eq__(self, other):
-        if not isinstance(other, self.__class__):
-            return NotImplemented
-
-        return self.name == other.name and \
-               self.lookup_table == other.lookup_table and \
-               self.lookup_id == other.lookup_id
+        self.lookup_id = singular(resource) + '_id'
 
     def __repr__(self):
         return f'<HasMany name={self.name}, lookup_table={self.lookup_table}, lookup_id={self.lookup_id}>'
+
+
+class RowBudgetExceeded(Exception):
+    pass
+
+
+class RowBudget:
+    """ Related rows a request may still load, across every hop """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    @property
+    def remaining(self):
+        return self.limit - self.used
+
+    def spend(self, rows):
+        self.used += rows
+
+        if self.used > self.limit:
+            raise RowBudgetExceeded(f'More than {self.limit} related resources requested')
+
+
+def resolve_path(relationships, resource, names):
+    """ Relationships along names, a path of relationship names from resource
+
+    Raises KeyError for a name that resource at that point does not have.
+    """
+    path = []
+
+    for name in names:
+        by_name = {rel.name: rel for rel in relationships.get(resource, [])}
+        path.append(by_name[name])
+        resource = by_name[name].related_resource
+
+    return path
+
+
+def parse_include_paths(value, relationships, resource, max_depth):
+    """ Tree of (relationship, children) pairs for include=a,b.c paths
+
+    Children are pairs of the same form, in request order and without
+    duplicates, so b.c,b.d loads b once.
+    """
+    tree = []
+
+    for path in [path.strip() for path in value.split(',') if path.strip() != '']:
+        names = path.split('.')
+
+        if len(names) > max_depth:
+            raise ValueError(f'Include "{path}" is deeper than {max_depth} relationships')
+
+        try:
+            hops = resolve_path(relationships, resource, names)
+        except KeyError as e:
+            raise ValueError(f'Unknown relationship "{e.args[0]}" in include')
+
+        level = tree
+        for relationship in hops:
+            children = next((children for rel, children in level if rel == relationship), None)
+
+            if children is None:
+                children = []
+                level.append((relationship, children))
+
+            level = children
+
+    return tree
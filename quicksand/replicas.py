@@ -0,0 +1,200 @@
+import itertools
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from .sqlite_db import ConnectionPool
+
+
+def snapshot(source, target):
+    """ Copies the database source to target with SQLite's online backup API
+
+    The copy is written next to target and renamed over it, so readers of
+    target see either the previous snapshot or the new one, never a partial
+    copy. Its modification time is set to when the copy started, so every
+    write committed before that time is in it. Returns that time in
+    nanoseconds.
+    """
+    started = time.time_ns()
+    directory, name = os.path.split(os.path.abspath(target))
+    fd, temp_path = tempfile.mkstemp(prefix=f'.{name}.', dir=directory)
+    os.close(fd)
+
+    try:
+        source_conn = sqlite3.connect(source)
+        target_conn = sqlite3.connect(temp_path)
+
+        try:
+            # In one step: a source written to during a stepped backup restarts it
+            source_conn.backup(target_conn)
+            # Readers of a rollback journal file never write next to it
+            target_conn.execute('PRAGMA journal_mode=delete').fetchall()
+        finally:
+            target_conn.close()
+            source_conn.close()
+
+        os.utime(temp_path, ns=(started, started))
+        os.replace(temp_path, target)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    return started
+
+
+class Replica:
+    """ A snapshot file of the primary database and the read pool over it
+
+    The snapshot time is the file's modification time, so any process can
+    tell how fresh a replica is, whoever copied it there.
+    """
+    def __init__(self, path, pool):
+        self.path = path
+        self.pool = pool
+        self.inode = None
+        self.synced_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """ Reads the snapshot time, reopening the pool if the file was replaced """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.synced_at = None
+            return
+
+        with self._lock:
+            if stat.st_ino != self.inode:
+                self.pool.reset()
+                self.inode = stat.st_ino
+
+            self.synced_at = stat.st_mtime_ns
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self.pool.reset()
+
+
+class ReplicaSet:
+    """ Read-only snapshot copies of the primary database for GET handlers
+
+    Reads are spread over the replicas in turn. A read that must see writes
+    made at or after a given time, such as those of the client making it,
+    only goes to a replica snapshotted after that time, and to the primary
+    when there is none. Replicas are refreshed by refresh(), by the thread
+    started with start(), or by copying files in from outside, e.g. with
+    `quicksand snapshot` on another machine.
+    """
+    def __init__(self, primary, paths, pool_size=5, pool_timeout=None, schema=None,
+                 versions=None, pragmas=None, logger=None):
+        self.primary = primary
+        self.logger = logger
+        self.replicas = [
+            Replica(path, ConnectionPool(path, pool_size, pool_timeout, schema,
+                                         versions, read_only=True, pragmas=pragmas))
+            for path in paths
+        ]
+        self.stats = {
+            'refreshes': 0,
+            'refresh_time': 0.0,
+            'refresh_errors': 0,
+            'primary_reads': 0,
+            'replica_reads': 0,
+        }
+        self._turn = itertools.count()
+        self._refresh_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """ Snapshots the primary into every replica """
+        with self._refresh_lock:
+            started = time.perf_counter()
+
+            for replica in self.replicas:
+                snapshot(self.primary, replica.path)
+
+            self.stats['refreshes'] += 1
+            self.stats['refresh_time'] += time.perf_counter() - started
+
+    def start(self, interval):
+        """ Refreshes the replicas every interval seconds in a daemon thread """
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.refresh()
+                except (OSError, sqlite3.Error) as e:
+                    self.stats['refresh_errors'] += 1
+                    if self.logger is not None:
+                        self.logger.error(f'Replica refresh failed: {e}')
+
+        self._thread = threading.Thread(target=run, name='quicksand-replicas',
+                                        daemon=True)
+        self._thread.start()
+
+    @property
+    def refreshing(self):
+        """ Whether this process runs the refresh thread """
+        return self._thread is not None
+
+    def after_fork(self):
+        """ Leaves refreshes to the parent, in a forked child process
+
+        Only the forking thread survives fork, so a lock the refresh thread
+        or a request thread held would never be released in the child.
+        """
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+        for replica in self.replicas:
+            replica.after_fork()
+
+    def pool_for(self, written=None):
+        """ Read pool of a replica holding writes made before written
+
+        written is a time.time_ns() value. Returns None when no replica is
+        recent enough, and reads should go to the primary.
+        """
+        count = len(self.replicas)
+        first = next(self._turn)
+
+        for i in range(count):
+            replica = self.replicas[(first + i) % count]
+            replica.check()
+
+            if replica.synced_at is None:
+                continue
+
+            if written is None or replica.synced_at > written:
+                self.stats['replica_reads'] += 1
+                return replica.pool
+
+        self.stats['primary_reads'] += 1
+        return None
+
+    def lag(self):
+        """ Seconds since each replica's snapshot, None for missing files """
+        now = time.time_ns()
+        lags = {}
+
+        for replica in self.replicas:
+            replica.check()
+            lags[replica.path] = (None if replica.synced_at is None
+                                  else (now - replica.synced_at) / 1e9)
+
+        return lags
+
+    def info(self):
+        return dict(self.stats, lag=self.lag(), pools={
+            replica.path: replica.pool.info() for replica in self.replicas})
+
+    def close(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        for replica in self.replicas:
+            replica.pool.close()
@@ -0,0 +1,252 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.request import pathname2url
+from .search import hidden_tables
+
+
+# Insert and update statements cached per table, one per column list
+MAX_CACHED_STATEMENTS = 64
+
+
+class TableStatements:
+    """ SQL text for the operations SqliteDb runs against one table
+
+    Queries name the columns they select instead of using *, so their rows
+    are laid out like the serializer compiled from the same columns, even
+    when the table has changed since and the catalog is not reloaded yet.
+    """
+    def __init__(self, table, columns):
+        self.table = table
+        self.column_names = frozenset(columns)
+        self.columns = ','.join(f'{table}.{column}' for column in columns)
+        select = f'SELECT {self.columns} FROM {table}'
+        self.find_all = select
+        self.find_all_ordered = f'{select} ORDER BY id'
+        self.find_by_id = f'{select} WHERE id=?'
+        self.find_first_page = f'{select} ORDER BY id LIMIT ?'
+        self.find_page_after = f'{select} WHERE id>? ORDER BY id LIMIT ?'
+        self.find_page_before = f'{select} WHERE id<? ORDER BY id DESC LIMIT ?'
+        self.has_id_before = f'SELECT 1 FROM {table} WHERE id<? LIMIT 1'
+        self.has_id_after = f'SELECT 1 FROM {table} WHERE id>? LIMIT 1'
+        self.delete_by_id = f'DELETE from {table} WHERE id=?;'
+        self._insert = OrderedDict()
+        self._update = OrderedDict()
+        self._find_by_field = {}
+        self._lock = threading.Lock()
+
+    def check_columns(self, columns):
+        """ Raises ValueError for a column the table does not have
+
+        Column names come from request bodies, so they are checked before
+        they reach any SQL text.
+        """
+        for column in columns:
+            if column not in self.column_names:
+                raise ValueError(f'Unknown attribute "{column}" for "{self.table}"')
+
+    def insert(self, columns):
+        columns = tuple(columns)
+        self.check_columns(columns)
+
+        def build():
+            templates = ','.join('?' * len(columns))
+            return f'INSERT INTO {self.table} ({",".join(columns)}) VALUES ({templates});'
+
+        return self._cached(self._insert, columns, build)
+
+    def update(self, columns):
+        columns = tuple(columns)
+        self.check_columns(columns)
+
+        def build():
+            assignments = ','.join([column + '=?' for column in columns])
+            return f'UPDATE {self.table} SET {assignments} WHERE id=?;'
+
+        return self._cached(self._update, columns, build)
+
+    def _cached(self, statements, columns, build):
+        # Any subset of columns in any order is valid, so the cache is bounded
+        with self._lock:
+            sql = statements.get(columns)
+
+            if sql is not None:
+                statements.move_to_end(columns)
+                return sql
+
+            sql = build()
+            statements[columns] = sql
+
+            if len(statements) > MAX_CACHED_STATEMENTS:
+                statements.popitem(last=False)
+
+            return sql
+
+    def find_by_field(self, field):
+        sql = self._find_by_field.get(field)
+
+        if sql is None:
+            sql = f'SELECT {self.columns} FROM {self.table} WHERE {field}=?'
+            self._find_by_field[field] = sql
+
+        return sql
+
+
+class TableSchema:
+    def __init__(self, name, table_info, foreign_key_list, index_columns=()):
+        self.name = name
+        self.columns = [row['name'] for row in table_info]
+        self.types = {row['name']: row['type'] for row in table_info}
+        self.primary_key = [row['name'] for row in
+                            sorted(table_info, key=lambda row: row['pk'])
+                            if row['pk'] > 0]
+        self.foreign_keys = [{
+            'column': row['from'],
+            'table': row['table'],
+            'to': row['to'],
+        } for row in foreign_key_list]
+        # Columns that lead an index, so lookups on them avoid a full scan.
+        # A single-column INTEGER PRIMARY KEY is the rowid and needs no index.
+        self.indexed_columns = set(index_columns)
+        if len(self.primary_key) == 1 and \
+                self.types[self.primary_key[0]].upper() == 'INTEGER':
+            self.indexed_columns.add(self.primary_key[0])
+        self.statements = TableStatements(name, self.columns)
+
+    def same_shape(self, other):
+        """ Whether other has the same columns, types and keys, ignoring indexes """
+        return (self.columns == other.columns and self.types == other.types and
+                self.primary_key == other.primary_key and
+                self.foreign_keys == other.foreign_keys)
+
+    def __repr__(self):
+        return f'<TableSchema name={self.name}, columns={self.columns}>'
+
+
+class SchemaCatalog:
+    """ Introspected tables of a database, built once and shared by connections
+
+    Call reload after changing the schema. The table map is swapped as a
+    whole, so readers never see a partially rebuilt catalog. Tables whose
+    columns and keys did not change keep their TableSchema, and with it
+    their cached statements.
+    """
+    def __init__(self, db=None):
+        self.tables = {}
+
+        if db is not None:
+            self.reload(db)
+
+    def reload(self, db):
+        cursor = db.conn.cursor()
+        cursor.row_factory = sqlite3.Row
+
+        sql = "SELECT name, sql FROM sqlite_master WHERE type='table';"
+        rows = [tuple(row) for row in cursor.execute(sql).fetchall()]
+        hidden = hidden_tables(rows)
+        names = [name for name, _ in rows if name not in hidden]
+        tables = {}
+
+        for name in names:
+            table_info = cursor.execute(f'PRAGMA table_info({name})').fetchall()
+            foreign_keys = cursor.execute(f'PRAGMA foreign_key_list({name})').fetchall()
+            index_columns = []
+            for index in cursor.execute(f'PRAGMA index_list({name})').fetchall():
+                info = cursor.execute(f'PRAGMA index_info({index["name"]})').fetchall()
+                index_columns.extend(row['name'] for row in info if row['seqno'] == 0)
+            tables[name] = TableSchema(name, table_info, foreign_keys, index_columns)
+
+        cursor.close()
+        changed = set(self.tables) ^ set(tables)
+
+        for name, table in tables.items():
+            old = self.tables.get(name)
+
+            if old is None:
+                continue
+
+            if old.same_shape(table):
+                old.indexed_columns = table.indexed_columns
+                tables[name] = old
+            else:
+                changed.add(name)
+
+        self.tables = tables
+        return changed
+
+    @property
+    def table_names(self):
+        return list(self.tables.keys())
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.tables
+
+
+def schema_version(path):
+    """ PRAGMA schema_version of the database at path, which DDL increments """
+    uri = f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+    conn = sqlite3.connect(uri, uri=True)
+
+    try:
+        return conn.execute('PRAGMA schema_version').fetchone()[0]
+    finally:
+        conn.close()
+
+
+class SchemaWatcher:
+    """ Calls on_change when the schema_version of the database moves
+
+    poll checks at most every interval seconds, from whichever thread calls
+    it. Each check opens its own short-lived connection, so a watcher built
+    before forking works in the children. One thread runs on_change at a
+    time while the others carry on. A change is only taken as seen once
+    on_change returns, so a failed reload is retried on later polls.
+    """
+    def __init__(self, path, on_change, interval=1.0, logger=None):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.logger = logger
+        self.version = schema_version(path)
+        self.checked = time.monotonic()
+        self._lock = threading.Lock()
+
+    def poll(self, force=False):
+        """ Checks for a schema change if due; returns whether there was one """
+        now = time.monotonic()
+
+        if not force and now - self.checked < self.interval:
+            return False
+
+        if not self._lock.acquire(blocking=force):
+            return False
+
+        try:
+            self.checked = now
+
+            try:
+                version = schema_version(self.path)
+            except sqlite3.Error:
+                return False
+
+            if version == self.version:
+                return False
+
+            try:
+                self.on_change()
+            except Exception as e:
+                if self.logger is None:
+                    raise
+                # The version stays behind, so the next poll tries again
+                self.logger.error(f'Schema reload failed: {e!r}')
+            else:
+                self.version = version
+
+            return True
+        finally:
+            self._lock.release()
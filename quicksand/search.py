@@ -0,0 +1,118 @@
+import re
+
+
+# Tables FTS5 creates to store an index named <index>
+SHADOW_SUFFIXES = ('_data', '_idx', '_content', '_docsize', '_config')
+
+NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# The CREATE VIRTUAL TABLE statement of search_index_sql
+INDEX_SQL = re.compile(r"^CREATE VIRTUAL TABLE (\w+) USING fts5\([\w, ]+, "
+                       r"content='(\w+)', content_rowid='id'\)$")
+
+
+def index_name(table):
+    return f'{table}_search'
+
+
+def search_index_sql(table, columns):
+    """ Statements creating the FTS5 index of columns and its sync triggers
+
+    The index is external content: it stores no copy of the text and reads
+    it from table. Triggers keep it in step with every write to table,
+    through the API or not. Updates that leave columns alone skip it.
+    """
+    index = index_name(table)
+    names = ', '.join(columns)
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    remove = f"INSERT INTO {index}({index}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    add = f'INSERT INTO {index}(rowid, {names}) VALUES (new.id, {new});'
+
+    return [
+        f"CREATE VIRTUAL TABLE {index} USING fts5({names}, content='{table}', "
+        f"content_rowid='id')",
+        f'CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN {add} END',
+        f'CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN {remove} END',
+        f'CREATE TRIGGER {index}_update AFTER UPDATE OF {names} ON {table} '
+        f'BEGIN {remove} {add} END',
+    ]
+
+
+def create_search_index(db, table, columns):
+    """ Creates or updates the search index of table's columns
+
+    Does nothing when the index already covers these columns, so it is safe
+    to call on every start. Returns the index's table name.
+    """
+    index = index_name(table)
+
+    for name in [table] + list(columns):
+        if not NAME.match(name):
+            raise ValueError(f'Invalid name "{name}" for a search index')
+
+    if table not in db.table_names:
+        raise ValueError(f'Cannot index unknown table "{table}"')
+
+    for column in columns:
+        if column not in db.table_columns(table):
+            raise ValueError(f'Cannot index unknown column "{table}.{column}"')
+
+    statements = search_index_sql(table, columns)
+    existing = db.fetch_one("SELECT sql FROM sqlite_master WHERE type='table' AND name=?",
+                            [index])
+
+    if existing is not None and existing[0] == statements[0]:
+        return index
+
+    with db.transaction():
+        for suffix in ('_insert', '_delete', '_update'):
+            db.execute(f'DROP TRIGGER IF EXISTS {index}{suffix}')
+        db.execute(f'DROP TABLE IF EXISTS {index}')
+
+        for sql in statements:
+            db.execute(sql)
+
+        db.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+
+    return index
+
+
+def is_search_index(name, sql):
+    """ Whether a sqlite_master row is an index made by create_search_index """
+    match = INDEX_SQL.match(sql or '')
+    return match is not None and match.group(1) == name == index_name(match.group(2))
+
+
+def hidden_tables(rows):
+    """ Names among (name, sql) rows of sqlite_master that are not resources
+
+    These are the search indexes and the shadow tables SQLite stores any
+    virtual table in. Other virtual tables are left to be served.
+    """
+    virtual = {name for name, sql in rows
+               if sql is not None and sql.upper().startswith('CREATE VIRTUAL TABLE')}
+    shadow = {name + suffix for name in virtual for suffix in SHADOW_SUFFIXES}
+    indexes = {name for name, sql in rows if is_search_index(name, sql)}
+    return indexes | shadow
+
+
+def parse_search(text):
+    """ FTS5 query matching rows that contain every term of text
+
+    Terms are quoted, so FTS5 operators and punctuation in them are taken
+    literally. A term ending in * matches words starting with it.
+    """
+    terms = []
+
+    for term in text.split():
+        prefix = len(term) > 1 and term.endswith('*')
+        term = term.rstrip('*')
+
+        if term != '':
+            terms.append('"' + term.replace('"', '""') + '"' + ('*' if prefix else ''))
+
+    if len(terms) == 0:
+        raise ValueError('filter[search] needs at least one search term')
+
+    return ' '.join(terms)
@@ -0,0 +1,98 @@
+class ResourceSerializer:
+    """ Formats rows of one table into JSON:API resource objects
+
+    Compiled once per resource from the table's column order, so rows can be
+    plain tuples selecting those columns and no per-row key filtering is needed.
+    statements are the TableStatements selecting exactly those columns, so
+    rows fetched with them always match this serializer, even while the
+    schema is being reloaded.
+    """
+    def __init__(self, resource, columns, relationships, fields=None, statements=None):
+        self.resource = resource
+        self.columns = list(columns)
+        self.statements = statements
+        self.relationships = list(relationships)
+        self.id_index = self.columns.index('id') if 'id' in self.columns else None
+        self.attributes = [(index, column)
+                           for index, column in enumerate(self.columns)
+                           if column != 'id' and not column.endswith('_id')]
+        self.relationship_names = [rel.name for rel in relationships]
+
+        if fields is not None:
+            self.attributes = [(index, column) for index, column in self.attributes
+                               if column in fields]
+            self.relationship_names = [name for name in self.relationship_names
+                                       if name in fields]
+
+        self.self_template = f'api/{resource}/'
+        self._restricted = {}
+
+    @property
+    def field_names(self):
+        return [column for _, column in self.attributes] + self.relationship_names
+
+    def restrict(self, fields):
+        """ Serializer for a sparse fieldset, compiled once per set of fields """
+        key = frozenset(fields)
+        serializer = self._restricted.get(key)
+
+        if serializer is None:
+            for name in fields:
+                if name not in self.field_names:
+                    raise ValueError(f'Unknown field "{name}" for type "{self.resource}"')
+
+            serializer = ResourceSerializer(self.resource, self.columns,
+                                            self.relationships, key, self.statements)
+            self._restricted[key] = serializer
+
+        return serializer
+
+    def index(self, column):
+        return self.columns.index(column)
+
+    def id(self, row):
+        return row[self.id_index]
+
+    def serialize(self, row, url_root):
+        """ Resource object for a single row """
+        return self._serialize(row, url_root + self.self_template)
+
+    def serialize_many(self, rows, url_root):
+        prefix = url_root + self.self_template
+        serialize = self._serialize
+        return [serialize(row, prefix) for row in rows]
+
+    def _serialize(self, row, prefix):
+        id = row[self.id_index]
+        self_link = f'{prefix}{id}'
+
+        data = {
+            'type': self.resource,
+            'id': id,
+            'attributes': {column: row[index] for index, column in self.attributes},
+            'links': {
+                'self': self_link
+            },
+        }
+
+        if len(self.relationship_names) > 0:
+            data['relationships'] = {
+                name: {
+                    'links': {
+                        'related': f'{self_link}/{name}'
+                    }
+                }
+                for name in self.relationship_names
+            }
+
+        return data
+
+
+def compile_serializers(schema, relationships, tables=None):
+    """ Serializers of tables, by default of every table in schema """
+    if tables is None:
+        tables = schema.table_names
+
+    return {name: ResourceSerializer(name, schema[name].columns, relationships[name],
+                                     statements=schema[name].statements)
+            for name in tables}
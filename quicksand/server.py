@@ -1,37 +1,770 @@
 #!/usr/bin/python3
 import flask
-from flask import Flask, Response, request
+from flask import Flask, Response, request, g
 from flask_restful import Api, Resource
+import io
 import json
-import inflect
-from .sqlite_db import SqliteDb as Db
+import time
+from .sqlite_db import SqliteDb as Db, ConnectionPool, TableVersions
+from .schema import SchemaCatalog, SchemaWatcher
+from .cache import ResponseCache, CachedResponse
+from .operations import OperationError, parse_operations, parse_resource_object
+from .operations import run_operations
+from .query import IndexAdvisor, parse_query_args, parse_fields_args
+from .query import parse_aggregate_args, aggregate_name, aggregate_sql
+from .profiling import Profiler, measure
+from .changes import ChangeFeed, ChangesExpired, parse_changes_args, wants_event_stream
+from .changes import changes_document, stream_changes
+from .replicas import ReplicaSet
+from .search import create_search_index
+from .compression import available_encodings, negotiate, compress, compress_stream
+from .serializers import compile_serializers
 from .relationships import infer_relationships
 from .url_map_display import render_url_map
-from .relationships import BelongsTo, HasMany
+from .relationships import BelongsTo, HasMany, RowBudget, RowBudgetExceeded
+from .relationships import parse_include_paths, resolve_path
 from .jsonapi import make_null_relationship_response, make_empty_relationship_response
-from .jsonapi import make_jsonapi_response
+from .jsonapi import make_jsonapi_response, make_jsonapi_stream_response
+from .jsonapi import make_jsonapi_body_response
+from .jsonapi import load_json_encoder
+from urllib.parse import urlencode
+
+
+# Cookie holding the time of a client's last write, for read-your-writes
+WRITTEN_COOKIE = 'quicksand_written'
+
+
+class Handler(Resource):
+    """ Resource whose request reads every table through one set of serializers
+
+    A schema reload replaces serializers while requests are running. The
+    handler's own serializer and the app's others are taken once, when the
+    request is dispatched, and connections fetch rows with their statements.
+    """
+    def dispatch_request(self, *args, **kwargs):
+        serializers = self.__class__.app.config['SERIALIZERS']
+        serializer = getattr(self.__class__, 'serializer', None)
+
+        if serializer is not None and serializers.get(self.__class__.resource) is not serializer:
+            serializers = dict(serializers, **{self.__class__.resource: serializer})
+
+        g.serializers = serializers
+        return super().dispatch_request(*args, **kwargs)
+
+
+def request_serializers(app):
+    """ The serializers the current request was dispatched with """
+    return g.get('serializers', app.config['SERIALIZERS'])
+
+
+def get_db(app):
+    """ Read-only connection for the current app context
+
+    It comes from the read pool of the primary database, or of a replica
+    when there are replicas and the client has not written since the
+    replica's snapshot was taken.
+    """
+    if 'db' not in g:
+        pool = app.config['POOL']
+        replicas = app.config['REPLICAS']
+
+        if replicas is not None:
+            pool = replicas.pool_for(written_at()) or pool
+
+        g.db = pool.acquire()
+        g.db_pool = pool
+        g.db.profile = g.get('profile')
+        g.db.serializers = g.get('serializers')
+
+    return g.db
+
+
+def written_at():
+    try:
+        return int(request.cookies[WRITTEN_COOKIE])
+    except (KeyError, ValueError):
+        return None
+
+
+def mark_written(response):
+    """ Has a client that wrote read from the primary until replicas catch up """
+    if 'writer' in g and response.status_code < 400:
+        response.set_cookie(WRITTEN_COOKIE, str(time.time_ns()), httponly=True,
+                            samesite='Lax')
+
+    return response
+
+
+def get_writer(app):
+    """ The app's single writer connection, held for the current app context """
+    if 'writer' not in g:
+        g.writer = app.config['WRITER'].acquire()
+        g.writer.profile = g.get('profile')
+        g.writer.serializers = g.get('serializers')
+
+    return g.writer
+
+
+def check_etag(app, db, tables):
+    """ ETag for a GET that reads tables, and a response if one is ready
+
+    The response is a 304 when If-None-Match matches, or the cached body
+    when the response cache holds this URL at the current ETag.
+    """
+    versions = app.config['VERSIONS']
+    versions.observe(db)
+    # Replicas may lag the primary, so each database, and each snapshot a
+    # replica pool has opened, tags its own responses
+    etag = versions.etag(tables, f'{db.path}:{db.generation} {request.url}')
+    tags = [etag] + [f'{etag}-{encoding}' for encoding in app.config['COMPRESS_ENCODINGS']]
+
+    for tag in tags:
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+            response.set_etag(tag)
+            return etag, response
+
+    cache = app.config['RESPONSE_CACHE']
+
+    if cache is not None:
+        entry = cache.get(request.url, etag)
+
+        if entry is not None:
+            response = Response(entry.body, status=200)
+            response.headers['Content-Type'] = entry.content_type
+            response.headers['X-Cache'] = 'HIT'
+            response.set_etag(etag)
+            encoding = body_encoding(app, entry.body)
+
+            if encoding is not None:
+                body = entry.bodies.get(encoding)
+
+                if body is None:
+                    with measure('encode'):
+                        body = compress(entry.body, encoding)
+                    cache.add_body(request.url, entry, encoding, body)
+
+                set_encoded_body(response, encoding, body)
+
+            return etag, response
+
+    return etag, None
+
+
+def finish_get(app, response, etag, tables):
+    """ Tags a GET response with its ETag and stores it in the response cache
+
+    The cache keeps the body compressed for this client, if it accepts a
+    compressed response, so later hits are not compressed again.
+    """
+    response.set_etag(etag)
+    cache = app.config['RESPONSE_CACHE']
+
+    if cache is not None and not response.is_streamed:
+        body = response.get_data()
+        encoding = body_encoding(app, body)
+        bodies = {}
+
+        if encoding is not None:
+            with measure('encode'):
+                bodies[encoding] = compress(body, encoding)
+
+        cache.put(request.url, CachedResponse(etag, body, response.headers['Content-Type'],
+                                              tables, bodies))
+        response.headers['X-Cache'] = 'MISS'
+
+        if encoding is not None:
+            set_encoded_body(response, encoding, bodies[encoding])
+
+    return response
+
+
+def body_encoding(app, body):
+    """ Content coding to compress body with for this request, or None """
+    min_size = app.config['COMPRESS_MIN_SIZE']
+
+    if min_size is None or len(body) < min_size:
+        return None
+
+    return negotiate(request.accept_encodings, app.config['COMPRESS_ENCODINGS'])
+
+
+def set_encoded_body(response, encoding, body):
+    """ Replaces response's body with body, compressed with encoding """
+    response.set_data(body)
+    tag_encoding(response, encoding)
+
+
+def tag_encoding(response, encoding):
+    """ Marks response as compressed with encoding
+
+    Each encoding is its own representation, so its ETag gets the encoding
+    appended.
+    """
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+
+    if etag is not None:
+        response.set_etag(f'{etag}-{encoding}', weak)
+
+
+def compress_response(response):
+    """ Compresses JSON:API responses for clients that accept it
+
+    Bodies smaller than COMPRESS_MIN_SIZE bytes go out as they are. Streamed
+    bodies are compressed a chunk at a time, as they are produced.
+    """
+    app = flask.current_app
+
+    if response.mimetype != 'application/vnd.api+json' or \
+            'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if not response.is_streamed:
+        body = response.get_data()
+        encoding = body_encoding(app, body)
+
+        if encoding is not None:
+            with measure('encode'):
+                set_encoded_body(response, encoding, compress(body, encoding))
+
+        return response
+
+    encoding = negotiate(request.accept_encodings, app.config['COMPRESS_ENCODINGS'])
+
+    if encoding is not None:
+        response.response = compress_stream(response.response, encoding)
+        tag_encoding(response, encoding)
+
+    return response
+
+
+def invalidate_cache(app, resource):
+    """ Drops cached responses that read resource or its related tables """
+    cache = app.config['RESPONSE_CACHE']
+
+    if cache is None:
+        return
+
+    tables = {resource}
+    tables.update(rel.lookup_table for rel in app.config['RELATIONSHIPS'][resource])
+    cache.invalidate(tables)
+
+
+def publish_changes(app, resource, action, ids):
+    """ Adds changes to the app's change feed, if it has one """
+    changes = app.config['CHANGES']
+
+    if changes is not None:
+        changes.publish(resource, action, ids)
+
+
+def release_db(exception=None):
+    db = g.pop('db', None)
+
+    if db is not None:
+        db.profile = None
+        db.serializers = None
+        g.pop('db_pool').release(db)
+
+    writer = g.pop('writer', None)
+
+    if writer is not None:
+        writer.profile = None
+        writer.serializers = None
+        flask.current_app.config['WRITER'].release(writer)
+
+
+def start_profile():
+    g.request_started = time.perf_counter()
+    g.profile = flask.current_app.config['PROFILER'].start()
+
+
+def note_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+def finish_profile(exception=None):
+    # Streamed responses are recorded when they close
+    if 'request_started' not in g or g.get('streaming'):
+        return
+
+    elapsed = time.perf_counter() - g.request_started
+    status = g.get('response_status', 500)
+    flask.current_app.config['PROFILER'].record(request.method, request_route(),
+                                                status, elapsed, g.get('profile'))
+
+
+def request_route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def detach_for_stream(app, response):
+    """ Hands the read connection and profile over to a streamed response
+
+    The request context is torn down before the body is sent, so the
+    connection goes back to the pool, and the request is recorded, only once
+    the response is closed.
+    """
+    db, pool = g.pop('db'), g.pop('db_pool')
+    g.streaming = True
+    method, route, status = request.method, request_route(), response.status_code
+    started, profile = g.request_started, g.get('profile')
+
+    def close():
+        db.profile = None
+        db.serializers = None
+        pool.release(db)
+        app.config['PROFILER'].record(method, route, status,
+                                      time.perf_counter() - started, profile)
+
+    response.call_on_close(close)
 
 
 def fetch_resources(self):
     resource = self.__class__.resource
     relationships = self.__class__.relationships
-    db = Db(self.__class__.app.config['DATABASE'])
-    records = db.find_all(resource)
-    obj = format_resource_object(records, resource, request.url_root, relationships)
-    return make_jsonapi_response(obj)
+    app = self.__class__.app
+    stream = request.args.get('stream') in ('1', 'true')
+
+    try:
+        includes = parse_include_args(request.args, app, resource)
+        query = parse_query_args(request.args, self.__class__.serializer.columns,
+                                 app.config['SEARCH'].get(resource))
+        fields = parse_fields_args(request.args)
+        serializer = select_serializer(app, resource, fields)
+        page = parse_page_args(request.args, app.config['MAX_PAGE_SIZE'])
+        linkage = parse_linkage_args(request.args)
+
+        if stream and len(includes) > 0:
+            raise ValueError('include cannot be combined with stream')
+
+        if stream and linkage is not None:
+            raise ValueError('linkage cannot be combined with stream')
+
+        if page is not None and len(query.sort) > 0:
+            raise ValueError('sort cannot be combined with page, which is ordered by id')
+    except ValueError as e:
+        return response_bad_request(str(e))
+
+    if not query.is_empty:
+        app.config['INDEX_ADVISOR'].observe(resource, query)
+
+    db = get_db(app)
+    tables = [resource] + include_tables(includes)
+    if linkage is not None:
+        tables += [rel.lookup_table for rel in relationships if isinstance(rel, HasMany)]
+    etag, ready = check_etag(app, db, tables)
+
+    if ready is not None:
+        return ready
+
+    if stream:
+        chunks = stream_resources(app, db, resource, request.url_root, serializer,
+                                  query)
+        chunks = flask.stream_with_context(chunks)
+        response = make_jsonapi_stream_response(chunks)
+        detach_for_stream(app, response)
+        return finish_get(app, response, etag, tables)
+
+    if page is None and len(includes) == 0 and linkage is None:
+        # Built a batch at a time, so only the encoded body grows with the
+        # table. BytesIO hands over its buffer without the copy join makes.
+        body = io.BytesIO()
+        for chunk in stream_resources(app, db, resource, request.url_root,
+                                      serializer, query):
+            body.write(chunk)
+        response = make_jsonapi_body_response(body.getvalue())
+        return finish_get(app, response, etag, tables)
+
+    if page is None:
+        records = db.find_all(resource, query)
+        with measure('serialize'):
+            obj = {'data': serializer.serialize_many(records, request.url_root)}
+    else:
+        size, after, before = page
+        records, has_more = db.find_page(resource, size, after, before, query)
+        with measure('serialize'):
+            obj = {'data': serializer.serialize_many(records, request.url_root)}
+        obj['links'] = format_page_links(db, resource, serializer, records,
+                                         size, after, before, has_more, query)
+
+    if len(includes) > 0:
+        try:
+            obj['included'] = load_included(app, db, serializer, records,
+                                            obj['data'], includes, fields)
+        except RowBudgetExceeded as e:
+            return response_bad_request(str(e))
+
+    if linkage is not None:
+        load_linkage(db, serializer, records, obj['data'], linkage, includes)
+
+    response = make_jsonapi_response(obj)
+    return finish_get(app, response, etag, tables)
+
+
+def parse_include_args(args, app, resource):
+    """ Tree of (relationship, children) pairs named by an include=a,b.c query """
+    return parse_include_paths(args.get('include', ''), app.config['RELATIONSHIPS'],
+                               resource, app.config['MAX_RELATIONSHIP_DEPTH'])
+
+
+def include_tables(includes):
+    """ Tables read to load an include tree """
+    return [table for relationship, children in includes
+            for table in [relationship.lookup_table] + include_tables(children)]
+
+
+def select_serializer(app, resource, fields):
+    """ The resource's serializer, restricted to its sparse fieldset if any """
+    serializer = request_serializers(app)[resource]
+
+    if resource in fields:
+        return serializer.restrict(fields[resource])
+
+    return serializer
+
+
+def set_linkage(data, name, linkage):
+    # Sparse fieldsets may leave the relationship out of the resource object
+    relationship = data.get('relationships', {}).get(name)
+
+    if relationship is not None:
+        relationship['data'] = linkage
+
+
+def parse_linkage_args(args):
+    """ linkage=data for resource identifiers and counts, linkage=count for counts """
+    value = args.get('linkage')
+
+    if value is not None and value not in ('data', 'count'):
+        raise ValueError('linkage must be data or count')
+
+    return value
+
+
+def load_linkage(db, serializer, records, datas, mode, includes=()):
+    """ Adds relationship data and HasMany meta.count to resource objects
+
+    Each HasMany relationship takes one grouped query for all records.
+    BelongsTo linkage comes from the records' own _id columns. Included
+    relationships already carry their data and only get counts.
+    """
+    included = {rel.name for rel, children in includes}
+    ids = [serializer.id(record) for record in records]
+
+    for relationship in serializer.relationships:
+        name = relationship.name
+
+        if name not in serializer.relationship_names:
+            continue
+
+        if isinstance(relationship, BelongsTo):
+            if mode != 'data' or name in included:
+                continue
+
+            column = serializer.index(name + '_id')
+            for record, data in zip(records, datas):
+                related_id = record[column]
+                set_linkage(data, name, None if related_id is None else
+                            {'type': relationship.related_resource, 'id': related_id})
+
+        elif name in included:
+            for data in datas:
+                relationship_object = data['relationships'][name]
+                relationship_object['meta'] = {'count': len(relationship_object['data'])}
+
+        elif mode == 'data':
+            children = db.ids_by_field_in(relationship.lookup_table,
+                                          relationship.lookup_id, ids)
+            for id, data in zip(ids, datas):
+                child_ids = children.get(id, [])
+                set_linkage(data, name, [{'type': relationship.related_resource, 'id': child_id}
+                                         for child_id in child_ids])
+                data['relationships'][name]['meta'] = {'count': len(child_ids)}
+
+        else:
+            counts = db.count_by_field_in(relationship.lookup_table,
+                                          relationship.lookup_id, ids)
+            for id, data in zip(ids, datas):
+                data['relationships'][name]['meta'] = {'count': counts.get(id, 0)}
+
+
+def load_related(db, serializer, records, relationship, budget):
+    """ Records related to any of records, in one IN (...) query per batch
+
+    Raises RowBudgetExceeded when there are more than budget has left.
+    """
+    if isinstance(relationship, BelongsTo):
+        column = serializer.index(relationship.name + '_id')
+        related = db.find_by_ids(relationship.lookup_table,
+                                 [record[column] for record in records],
+                                 budget.remaining + 1)
+    else:
+        related = db.find_by_field_in(relationship.lookup_table, relationship.lookup_id,
+                                      [serializer.id(record) for record in records],
+                                      budget.remaining + 1)
+
+    budget.spend(len(related))
+    return related
+
+
+def load_included(app, db, serializer, records, datas, includes, fields=None):
+    """ Loads an include tree for all records, one query per relationship and level
+
+    Adds resource linkage to the relationships of the primary data, and of
+    included resources that an include path goes through, and returns the
+    de-duplicated list of included resource objects. Raises
+    RowBudgetExceeded past MAX_RELATED_ROWS related records.
+    """
+    url_root = request.url_root
+    fields = fields or {}
+    objects = {(serializer.resource, serializer.id(record)): data
+               for record, data in zip(records, datas)}
+    budget = RowBudget(app.config['MAX_RELATED_ROWS'])
+    included = []
+
+    def include(serializer, records, datas, includes):
+        for relationship, children in includes:
+            related_serializer = select_serializer(app, relationship.related_resource, fields)
+            related = load_related(db, serializer, records, relationship, budget)
+            link_related(serializer, records, datas, relationship, related_serializer, related)
+            related_datas = []
+
+            for row in related:
+                key = (relationship.related_resource, related_serializer.id(row))
+
+                if key not in objects:
+                    with measure('serialize'):
+                        objects[key] = related_serializer.serialize(row, url_root)
+                    included.append(objects[key])
+
+                related_datas.append(objects[key])
+
+            include(related_serializer, related, related_datas, children)
+
+    include(serializer, records, datas, includes)
+    return included
+
+
+def link_related(serializer, records, datas, relationship, related_serializer, related):
+    """ Sets the linkage of relationship in datas to the related records loaded for it """
+    related_resource = relationship.related_resource
+
+    if isinstance(relationship, BelongsTo):
+        column = serializer.index(relationship.name + '_id')
+        found_ids = {related_serializer.id(row) for row in related}
+
+        for record, data in zip(records, datas):
+            related_id = record[column]
+            linkage = None
+            if related_id in found_ids:
+                linkage = {'type': related_resource, 'id': related_id}
+            set_linkage(data, relationship.name, linkage)
+
+    elif isinstance(relationship, HasMany):
+        column = related_serializer.index(relationship.lookup_id)
+        children = {}
+        for row in related:
+            children.setdefault(row[column], []).append(row)
+
+        for record, data in zip(records, datas):
+            set_linkage(data, relationship.name, [
+                {'type': related_resource, 'id': related_serializer.id(row)}
+                for row in children.get(serializer.id(record), [])
+            ])
+
+
+def parse_page_args(args, max_size):
+    """ Returns (size, after, before) for a page[...] query, or None """
+    if not any(key.startswith('page[') for key in args):
+        return None
+
+    try:
+        size = int(args.get('page[size]', max_size))
+        after = args.get('page[after]')
+        after = None if after is None else int(after)
+        before = args.get('page[before]')
+        before = None if before is None else int(before)
+    except ValueError:
+        raise ValueError('Page parameters must be integers')
+
+    if size < 1 or size > max_size:
+        raise ValueError(f'page[size] must be between 1 and {max_size}')
+
+    if after is not None and before is not None:
+        raise ValueError('page[after] and page[before] cannot be combined')
+
+    return size, after, before
+
+
+def format_page_links(db, resource, serializer, records, size, after, before,
+                      has_more, query=None):
+    args = {key: value for key, value in request.args.items()
+            if key not in ('page[after]', 'page[before]')}
+    args['page[size]'] = size
+
+    def page_url(**cursor):
+        return request.base_url + '?' + urlencode(dict(args, **cursor))
+
+    links = {'self': request.url}
+
+    if len(records) == 0:
+        if after is not None and db.has_id_before(resource, after + 1, query):
+            links['prev'] = page_url(**{'page[before]': after + 1})
+        if before is not None and db.has_id_after(resource, before - 1, query):
+            links['next'] = page_url(**{'page[after]': before - 1})
+        return links
+
+    first_id = serializer.id(records[0])
+    last_id = serializer.id(records[-1])
+
+    if before is None:
+        has_next = has_more
+        has_prev = db.has_id_before(resource, first_id, query)
+    else:
+        has_next = db.has_id_after(resource, last_id, query)
+        has_prev = has_more
+
+    if has_next:
+        links['next'] = page_url(**{'page[after]': last_id})
+
+    if has_prev:
+        links['prev'] = page_url(**{'page[before]': first_id})
+
+    return links
+
+
+def stream_resources(app, db, resource, url_root, serializer, query=None):
+    """ Yields the collection document in chunks, one batch of rows each
+
+    Only one batch of rows and resource objects is alive at a time, and each
+    batch is encoded with a single encoder call.
+    """
+    encode = app.config['JSON_ENCODER']
+    batch_size = app.config['STREAM_BATCH_SIZE']
+    profile = g.get('profile')
+    separator = b''
+
+    yield b'{"data":['
+
+    for records in db.iter_batches(resource, batch_size, query):
+        if profile is None:
+            chunk = encode(serializer.serialize_many(records, url_root))
+        else:
+            with profile.measure('serialize'):
+                datas = serializer.serialize_many(records, url_root)
+            with profile.measure('encode'):
+                chunk = encode(datas)
+
+        # Splice the encoded list's items into the document's data array
+        yield separator + chunk.strip()[1:-1]
+        separator = b','
+
+    yield b']}'
+
+
+def fetch_aggregate(self):
+    """ count, sum, min, max and avg over the collection, in one statement
+
+    aggregate=count,sum:score picks the functions, group_by=author_id the
+    columns to group on and filter[...] the rows. The results are in meta.
+    """
+    resource = self.__class__.resource
+    app = self.__class__.app
+    columns = self.__class__.serializer.columns
+
+    try:
+        query = parse_query_args(request.args, columns, app.config['SEARCH'].get(resource))
+        aggregates, group_by = parse_aggregate_args(request.args, columns)
+
+        if len(query.sort) > 0:
+            raise ValueError('sort cannot be combined with aggregates, '
+                             'which are ordered by their groups')
+    except ValueError as e:
+        return response_bad_request(str(e))
+
+    advisor = app.config['INDEX_ADVISOR']
+    if not query.is_empty:
+        advisor.observe(resource, query)
+    for column in group_by:
+        advisor.check(resource, column, 'group')
+
+    db = get_db(app)
+    tables = [resource]
+    etag, ready = check_etag(app, db, tables)
+
+    if ready is not None:
+        return ready
+
+    names = [aggregate_name(function, column) for function, column in aggregates]
+    expressions = [aggregate_sql(function, column) for function, column in aggregates]
+    max_groups = app.config['MAX_GROUPS']
+    rows = db.aggregate(resource, expressions, group_by, query,
+                        max_groups + 1 if len(group_by) > 0 else None)
+
+    if len(group_by) == 0:
+        meta = {'aggregates': dict(zip(names, rows[0]))}
+    elif len(rows) > max_groups:
+        return response_bad_request(f'More than {max_groups} groups; filter the rows '
+                                    'or group by fewer columns')
+    else:
+        count = len(group_by)
+        meta = {'groups': [{
+            'group': dict(zip(group_by, row[:count])),
+            'aggregates': dict(zip(names, row[count:])),
+        } for row in rows]}
+
+    response = make_jsonapi_response({'meta': meta})
+    return finish_get(app, response, etag, tables)
 
 
 def fetch_resource(self, id):
     resource = self.__class__.resource
     relationships = self.__class__.relationships
-    db = Db(self.__class__.app.config['DATABASE'])
+    app = self.__class__.app
+
+    try:
+        includes = parse_include_args(request.args, app, resource)
+        fields = parse_fields_args(request.args)
+        serializer = select_serializer(app, resource, fields)
+        linkage = parse_linkage_args(request.args)
+    except ValueError as e:
+        return response_bad_request(str(e))
+
+    db = get_db(app)
+    tables = [resource] + include_tables(includes)
+    if linkage is not None:
+        tables += [rel.lookup_table for rel in relationships if isinstance(rel, HasMany)]
+    etag, ready = check_etag(app, db, tables)
+
+    if ready is not None:
+        return ready
+
     result = db.find_by_id(resource, id)
 
     if result is None:
         return response_not_found(resource, id)
 
-    obj = format_resource_object(result, resource, request.url_root, relationships)
-    return make_jsonapi_response(obj)
+    with measure('serialize'):
+        obj = {'data': serializer.serialize(result, request.url_root)}
+
+    if len(includes) > 0:
+        try:
+            obj['included'] = load_included(app, db, serializer, [result],
+                                            [obj['data']], includes, fields)
+        except RowBudgetExceeded as e:
+            return response_bad_request(str(e))
+
+    if linkage is not None:
+        load_linkage(db, serializer, [result], [obj['data']], linkage, includes)
+
+    response = make_jsonapi_response(obj)
+    return finish_get(app, response, etag, tables)
 
 
 def response_not_found(resource, id):
@@ -44,168 +777,713 @@ def response_not_found(resource, id):
     return make_jsonapi_response(obj, 404)
 
 
+def response_gone(detail):
+    obj = {
+        'errors': [{
+            'title': 'Changes expired',
+            'detail': detail
+        }]
+    }
+    return make_jsonapi_response(obj, 410)
+
+
+def response_bad_request(detail):
+    obj = {
+        'errors': [{
+            'title': 'Bad request',
+            'detail': detail
+        }]
+    }
+    return make_jsonapi_response(obj, 400)
+
+
 def create_resource(self):
     resource = self.__class__.resource
     relationships = self.__class__.relationships
-    db = Db(self.__class__.app.config['DATABASE'])
+    app = self.__class__.app
+    db = get_writer(app)
 
     request_data = request.get_json()['data']
-    record_data = request_data['attributes']
 
-    # Modify the created resource's table
-    belongs_to_rels = [r for r in relationships if isinstance(r, BelongsTo)]
-    for relationship in belongs_to_rels:
-        try:
-            rel_data = request_data['relationships'][relationship.name]['data']
-            rel_resource_type = rel_data['type']
-            rel_id = rel_data['id']
-        except KeyError:
-            continue
+    if isinstance(request_data, list):
+        return create_resources(app, db, resource, request_data)
 
-        if rel_resource_type != relationship.related_resource:
-            continue
+    record_data, links = parse_resource_object(request_data, relationships)
 
-        record_data[relationship.name + '_id'] = rel_id
-
-    id = db.insert_into(resource, record_data)
+    try:
+        id = db.insert_into(resource, record_data)
+    except ValueError as e:
+        return response_bad_request(str(e))
 
     # Modify fields in related tables
-    has_many_rels = [r for r in relationships if isinstance(r, HasMany)]
-    for relationship in has_many_rels:
-        try:
-            rel_datas = request_data['relationships'][relationship.name]['data']
-            for rel_data in rel_datas:
-                db.update_by_id(relationship.lookup_table, rel_data['id'], {
-                    relationship.lookup_id: id
-                })
-        except KeyError:
-            continue
+    for relationship, related_ids in links:
+        for related_id in related_ids:
+            db.update_by_id(relationship.lookup_table, related_id, {
+                relationship.lookup_id: id
+            })
+
+    invalidate_cache(app, resource)
+    publish_changes(app, resource, 'create', [id])
 
+    for relationship, related_ids in links:
+        publish_changes(app, relationship.lookup_table, 'update', related_ids)
 
     result = db.find_by_id(resource, id)
-    obj = format_resource_object(result, resource, request.url_root, relationships)
+    with measure('serialize'):
+        obj = {'data': self.__class__.serializer.serialize(result, request.url_root)}
     return make_jsonapi_response(obj, 201)
 
 
+def create_resources(app, db, resource, request_datas):
+    """ Creates an array of resources atomically, as a batch of add operations """
+    for index, data in enumerate(request_datas):
+        if not isinstance(data, dict):
+            error = OperationError(400, 'Bad request', 'Resource objects must be objects',
+                                   index)
+            return response_operation_error(error, '/data')
+
+    body = {'atomic:operations': [{'op': 'add', 'data': dict(data, type=resource)}
+                                  for data in request_datas]}
+
+    try:
+        results = perform_operations(app, db, body)
+    except OperationError as e:
+        # Operations are numbered like the items of the data array
+        return response_operation_error(e, '/data')
+
+    obj = {'data': [result['data'] for result in results]}
+    return make_jsonapi_response(obj, 201)
+
+
+def post_operations(self):
+    app = self.__class__.app
+    db = get_writer(app)
+
+    try:
+        results = perform_operations(app, db, request.get_json())
+    except OperationError as e:
+        return response_operation_error(e)
+
+    return make_jsonapi_response({'atomic:results': results})
+
+
+def perform_operations(app, db, body):
+    """ Runs a JSON:API atomic:operations document, returning its results """
+    operations = parse_operations(body, app.config['RELATIONSHIPS'])
+    serializers = request_serializers(app)
+    touched, rows = run_operations(db, operations, serializers)
+
+    for table in touched:
+        invalidate_cache(app, table)
+
+    results = []
+
+    for operation in operations:
+        row = rows.get((operation.resource, str(operation.id)))
+
+        if row is None:
+            results.append({})
+        else:
+            with measure('serialize'):
+                results.append({'data': serializers[operation.resource].serialize(
+                    row, request.url_root)})
+
+        publish_changes(app, operation.resource, OPERATION_ACTIONS[operation.op], [
+            operation.id if row is None else serializers[operation.resource].id(row)
+        ])
+
+        for relationship, related_ids in operation.links:
+            publish_changes(app, relationship.lookup_table, 'update', related_ids)
+
+    return results
+
+
+OPERATION_ACTIONS = {'add': 'create', 'update': 'update', 'remove': 'delete'}
+
+
+def response_operation_error(error, pointer='/atomic:operations'):
+    return make_jsonapi_response({'errors': [error.to_error_object(pointer)]},
+                                 error.status)
+
+
 def delete_resource(self, id):
     resource = self.__class__.resource
-    db = Db(self.__class__.app.config['DATABASE'])
+    db = get_writer(self.__class__.app)
     db.delete_by_id(resource, id)
+    invalidate_cache(self.__class__.app, resource)
+    publish_changes(self.__class__.app, resource, 'delete', [id])
     return None, 204
 
 
 def update_resource(self, id):
     resource = self.__class__.resource
-    db = Db(self.__class__.app.config['DATABASE'])
-    db.update_by_id(resource, id, request.get_json()['data']['attributes'])
+    db = get_writer(self.__class__.app)
+
+    try:
+        db.update_by_id(resource, id, request.get_json()['data']['attributes'])
+    except ValueError as e:
+        return response_bad_request(str(e))
+
+    invalidate_cache(self.__class__.app, resource)
+    publish_changes(self.__class__.app, resource, 'update', [id])
     return None, 204
 
 
+def fetch_changes(self):
+    """ Changes to the resource as server-sent events or by long-polling
+
+    Clients pass the last sequence id they saw as after= or Last-Event-ID.
+    With Accept: text/event-stream the response is an endless event stream,
+    otherwise the changes so far are returned, waiting up to timeout=
+    seconds for the first one.
+    """
+    resource = self.__class__.resource
+    feed = self.__class__.app.config['CHANGES']
+    stream = wants_event_stream(request.headers.get('Accept'))
+
+    try:
+        after, timeout = parse_changes_args(request.args,
+                                            request.headers.get('Last-Event-ID'))
+    except ValueError as e:
+        return response_bad_request(str(e))
+
+    if after is None:
+        after = feed.last
+
+    if stream:
+        heartbeat = self.__class__.app.config['CHANGES_HEARTBEAT']
+        response = Response(stream_changes(feed, resource, after, heartbeat),
+                            content_type='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    try:
+        changes, last = feed.wait(resource, after, timeout)
+    except ChangesExpired as e:
+        return response_gone(str(e))
+
+    return make_jsonapi_response(changes_document(changes, last))
+
+
 def fetch_resource_relationship(self, id):
     resource = self.__class__.resource
     relationship = self.__class__.relationship
     related_resource = relationship.related_resource
-    db = Db(self.__class__.app.config['DATABASE'])
+    app = self.__class__.app
+    related_serializer = request_serializers(app)[related_resource]
+    db = get_db(app)
+    tables = [resource, relationship.lookup_table]
+    etag, ready = check_etag(app, db, tables)
+
+    if ready is not None:
+        return ready
 
     if isinstance(relationship, BelongsTo):
-        relationship_column = relationship.name + '_id'
-        related_id = db.find_by_id(resource, id)[relationship_column]
-        result = db.find_by_id(relationship.lookup_table, related_id)
+        record = db.find_by_id(resource, id)
+
+        if record is None:
+            return response_not_found(resource, id)
+
+        relationship_column = self.__class__.serializer.index(relationship.name + '_id')
+        result = db.find_by_id(relationship.lookup_table, record[relationship_column])
 
         if result is None:
-            return make_null_relationship_response()
+            response = make_null_relationship_response()
+            return finish_get(app, response, etag, tables)
+
+        with measure('serialize'):
+            obj = {'data': related_serializer.serialize(result, request.url_root)}
 
     elif isinstance(relationship, HasMany):
         result = db.find_by_field(related_resource, relationship.lookup_id, id)
 
         if len(result) == 0:
-            return make_empty_relationship_response()
+            # Only an empty result needs to tell a childless parent from none
+            if len(db.existing_ids(resource, [id])) == 0:
+                return response_not_found(resource, id)
 
-    relationships = self.__class__.app.config['RELATIONSHIPS'][related_resource]
-    obj = format_resource_object(result, related_resource, request.url_root, relationships)
-    return make_jsonapi_response(obj)
+            response = make_empty_relationship_response()
+            return finish_get(app, response, etag, tables)
 
+        with measure('serialize'):
+            obj = {'data': related_serializer.serialize_many(result, request.url_root)}
 
-def format_resource_object(record, resource, url_root, relationships):
-    """ Formats a single or list of records into a resource object """
-    if isinstance(record, list):
-        records = record
-        data = [format_resource_object(record, resource, url_root,
-                                       relationships)['data']
-                for record in records]
-        return {'data': data}
+    response = make_jsonapi_response(obj)
+    return finish_get(app, response, etag, tables)
 
-    data = {
-        'type': resource,
-        'id': record['id']
-    }
 
-    data['attributes'] = {}
+def fetch_related_path(self, id, path):
+    """ Resources reached from a record through a path of relationships
 
-    for key in [key for key in record.keys() if key != 'id' and not key.endswith('_id')]:
-        data['attributes'][key] = record[key]
+    /api/authors/1/articles/comments loads the comments of every article of
+    author 1 with one query per hop. A path of BelongsTo relationships
+    leads to a single resource, any other to an array of them.
+    """
+    resource = self.__class__.resource
+    app = self.__class__.app
+    names = path.strip('/').split('/')
+    max_depth = app.config['MAX_RELATIONSHIP_DEPTH']
 
-    data['links'] = {
-        'self': f'{url_root}api/{resource}/{record["id"]}'
-    }
+    if len(names) > max_depth:
+        return response_bad_request(f'Relationship paths are limited to {max_depth} hops')
 
-    if len(relationships) > 0:
-        id = record['id']
-        data['relationships'] = {
-            rel.name: {
-                'links': {
-                    'related': f'{url_root}api/{resource}/{id}/{rel.name}'
-                }
-            }
-            for rel in relationships
-        }
-
-    return {
-        'data': data
-    }
+    try:
+        hops = resolve_path(app.config['RELATIONSHIPS'], resource, names)
+    except KeyError:
+        return response_not_found(resource, f'{id}/{path}')
 
+    db = get_db(app)
+    tables = [resource] + [hop.lookup_table for hop in hops]
+    etag, ready = check_etag(app, db, tables)
 
-def create_app(database='app.db'):
-    app = Flask(__name__)
-    app.config['DATABASE'] = database
-    app.config['RELATIONSHIPS'] = infer_relationships(Db(database))
+    if ready is not None:
+        return ready
 
-    api = Api(app)
+    record = db.find_by_id(resource, id)
 
-    @app.route('/')
-    def index():
-        return render_url_map(app.url_map)
+    if record is None:
+        return response_not_found(resource, id)
+
+    serializer = self.__class__.serializer
+    records = [record]
+    budget = RowBudget(app.config['MAX_RELATED_ROWS'])
+
+    try:
+        for hop in hops:
+            records = load_related(db, serializer, records, hop, budget)
+            serializer = request_serializers(app)[hop.related_resource]
+    except RowBudgetExceeded as e:
+        return response_bad_request(str(e))
+
+    if all(isinstance(hop, BelongsTo) for hop in hops):
+        if len(records) == 0:
+            response = make_null_relationship_response()
+            return finish_get(app, response, etag, tables)
+
+        with measure('serialize'):
+            obj = {'data': serializer.serialize(records[0], request.url_root)}
+    else:
+        if len(records) == 0:
+            response = make_empty_relationship_response()
+            return finish_get(app, response, etag, tables)
 
-    for name in Db(app.config['DATABASE']).table_names:
-        klass = type(f'HandlerList{name}', (Resource,), {
-            'get': fetch_resources,
-            'post': create_resource,
+        records.sort(key=serializer.id)
+        with measure('serialize'):
+            obj = {'data': serializer.serialize_many(records, request.url_root)}
+
+    response = make_jsonapi_response(obj)
+    return finish_get(app, response, etag, tables)
+
+
+def index_report(app):
+    """ Columns used for relationships, filters or sorts that have no index """
+    return app.config['INDEX_ADVISOR'].report()
+
+
+def profile_report(app):
+    """ Request timings, slow logs and pool, cache and index statistics """
+    cache = app.config['RESPONSE_CACHE']
+    replicas = app.config['REPLICAS']
+
+    return dict(app.config['PROFILER'].report(), **{
+        'pools': {
+            'read': app.config['POOL'].info(),
+            'write': app.config['WRITER'].info(),
+        },
+        'cache': cache.info() if cache is not None else None,
+        'replicas': replicas.info() if replicas is not None else None,
+        'unindexed': index_report(app),
+    })
+
+
+def render_metrics(app):
+    """ Prometheus metrics of requests, connection pools and the response cache """
+    extra = []
+    pools = [('read', app.config['POOL'].info()), ('write', app.config['WRITER'].info())]
+    replicas = app.config['REPLICAS']
+
+    if replicas is not None:
+        pools += [(f'replica{i}', replica.pool.info())
+                  for i, replica in enumerate(replicas.replicas)]
+
+    for name, field, kind, help in [
+        ('quicksand_pool_hits_total', 'hits', 'counter', 'Connections reused from the pool'),
+        ('quicksand_pool_misses_total', 'misses', 'counter', 'Connections opened by the pool'),
+        ('quicksand_pool_waits_total', 'waits', 'counter',
+         'Acquires that waited for a connection'),
+        ('quicksand_pool_wait_seconds_total', 'wait_time', 'counter',
+         'Seconds spent waiting for a connection'),
+        ('quicksand_pool_open_connections', 'open', 'gauge', 'Open connections'),
+        ('quicksand_pool_idle_connections', 'idle', 'gauge', 'Idle connections'),
+        ('quicksand_pool_max_connections', 'size', 'gauge', 'Maximum connections'),
+    ]:
+        extra.append((name, kind, help,
+                      [({'pool': pool}, info[field]) for pool, info in pools]))
+
+    cache = app.config['RESPONSE_CACHE']
+
+    if cache is not None:
+        info = cache.info()
+        for field, kind, help in [
+            ('hits', 'counter', 'Responses served from the cache'),
+            ('misses', 'counter', 'Cache lookups without a current entry'),
+            ('evictions', 'counter', 'Entries evicted for space'),
+            ('invalidations', 'counter', 'Entries dropped by writes'),
+            ('entries', 'gauge', 'Cached responses'),
+            ('bytes', 'gauge', 'Bytes held by the cache'),
+        ]:
+            suffix = '_total' if kind == 'counter' else ''
+            extra.append((f'quicksand_cache_{field}{suffix}', kind, help,
+                          [({}, info[field])]))
+
+    if replicas is not None:
+        stats = replicas.info()
+        extra.append(('quicksand_replica_reads_total', 'counter',
+                      'Reads routed to replicas or, for clients that wrote, the primary',
+                      [({'target': 'replica'}, stats['replica_reads']),
+                       ({'target': 'primary'}, stats['primary_reads'])]))
+        extra.append(('quicksand_replica_refreshes_total', 'counter',
+                      'Snapshots of the primary taken by this process',
+                      [({}, stats['refreshes'])]))
+        extra.append(('quicksand_replica_lag_seconds', 'gauge',
+                      'Age of each replica snapshot',
+                      [({'pool': f'replica{i}'}, lag)
+                       for i, lag in enumerate(stats['lag'].values()) if lag is not None]))
+
+    extra.append(('quicksand_unindexed_columns', 'gauge',
+                  'Lookup columns without an index', [({}, len(index_report(app)))]))
+
+    return app.config['PROFILER'].render_metrics(extra)
+
+
+def table_resources(app, name):
+    """ (handler class, path) pairs serving the table name """
+    resources = []
+    klass = type(f'HandlerList{name}', (Handler,), {
+        'get': fetch_resources,
+        'post': create_resource,
+        'resource': name,
+        'app': app,
+        'relationships': app.config['RELATIONSHIPS'][name],
+        'serializer': app.config['SERIALIZERS'][name],
+    })
+
+    resources.append((klass, f'/api/{name}'))
+
+    if app.config['CHANGES'] is not None:
+        klass = type(f'HandlerChanges{name}', (Handler,), {
+            'get': fetch_changes,
             'resource': name,
             'app': app,
-            'relationships': app.config['RELATIONSHIPS'][name],
         })
 
-        api.add_resource(klass, f'/api/{name}')
+        resources.append((klass, f'/api/{name}/changes'))
+
+    klass = type(f'HandlerAggregate{name}', (Handler,), {
+        'get': fetch_aggregate,
+        'resource': name,
+        'app': app,
+        'serializer': app.config['SERIALIZERS'][name],
+    })
+
+    resources.append((klass, f'/api/{name}/_aggregate'))
+
+    klass = type(f'HandlerSingle{name}', (Handler,), {
+        'get':  fetch_resource,
+        'delete': delete_resource,
+        'patch': update_resource,
+        'resource': name,
+        'app': app,
+        'relationships': app.config['RELATIONSHIPS'][name],
+        'serializer': app.config['SERIALIZERS'][name],
+    })
 
-        klass = type(f'HandlerSingle{name}', (Resource,), {
-            'get':  fetch_resource,
-            'delete': delete_resource,
-            'patch': update_resource,
+    resources.append((klass, f'/api/{name}/<int:id>'))
+
+    for relationship in app.config['RELATIONSHIPS'][name]:
+        klass = type(f'HandlerSingle{name}_{relationship.name}', (Handler,), {
+            'get':  fetch_resource_relationship,
             'resource': name,
             'app': app,
             'relationships': app.config['RELATIONSHIPS'][name],
+            'serializer': app.config['SERIALIZERS'][name],
+            'relationship': relationship,
         })
+        resources.append((klass, f'/api/{name}/<int:id>/{relationship.name}'))
 
-        api.add_resource(klass, f'/api/{name}/<int:id>')
+    # Single relationships match the rules above, which have no converter
+    klass = type(f'HandlerPath{name}', (Handler,), {
+        'get': fetch_related_path,
+        'resource': name,
+        'app': app,
+        'serializer': app.config['SERIALIZERS'][name],
+    })
 
-        for relationship in app.config['RELATIONSHIPS'][name]:
-            klass = type(f'HandlerSingle{name}_{relationship.name}', (Resource,), {
-                'get':  fetch_resource_relationship,
-                'resource': name,
-                'app': app,
-                'relationships': app.config['RELATIONSHIPS'][name],
-                'relationship': relationship,
-            })
-            api.add_resource(klass, f'/api/{name}/<int:id>/{relationship.name}')
+    resources.append((klass, f'/api/{name}/<int:id>/<path:path>'))
+
+    return resources
+
+
+def reset_after_fork(app):
+    """ Gives a forked worker its own ETags, connections and cached responses """
+    app.config['VERSIONS'].reseed()
+    app.config['POOL'].reset()
+    app.config['WRITER'].reset()
+
+    if app.config['REPLICAS'] is not None:
+        app.config['REPLICAS'].after_fork()
+
+    if app.config['RESPONSE_CACHE'] is not None:
+        app.config['RESPONSE_CACHE'].clear()
+
+
+def reload_schema(app):
+    """ Re-introspects the database after a schema change
+
+    Only tables whose columns or relationships changed get new serializers
+    and handlers. Returns the names of those tables.
+    """
+    db = Db(app.config['DATABASE'], pragmas=app.config['PRAGMAS'])
+    changed = app.config['SCHEMA'].reload(db)
+    relationships = infer_relationships(db, app.config['RELATIONSHIP_CACHE'])
+    db.close()
+
+    old_relationships = app.config['RELATIONSHIPS']
+    changed.update(name for name in relationships
+                   if relationships[name] != old_relationships.get(name))
+    app.config['INDEX_ADVISOR'].recheck()
+
+    if len(changed) == 0:
+        return changed
+
+    app.config['RELATIONSHIPS'] = {
+        name: relationships[name] if name in changed else old_relationships[name]
+        for name in relationships
+    }
+    serializers = {name: serializer for name, serializer in app.config['SERIALIZERS'].items()
+                   if name not in changed}
+    serializers.update(compile_serializers(app.config['SCHEMA'], app.config['RELATIONSHIPS'],
+                                           changed & set(relationships)))
+    app.config['SERIALIZERS'] = serializers
+    swap_routes(app, changed)
+
+    # Responses of changed tables may have a different shape now
+    for name in changed:
+        app.config['VERSIONS'].bump(name)
+
+    if app.config['RESPONSE_CACHE'] is not None:
+        app.config['RESPONSE_CACHE'].invalidate(changed)
+
+    # Workers leave snapshots to the process running the refresh thread
+    if app.config['REPLICAS'] is not None and app.config['REPLICAS'].refreshing:
+        app.config['REPLICAS'].refresh()
+
+    return changed
+
+
+def watch_schema(app, wsgi_app):
+    """ Wraps wsgi_app to check for schema changes before requests are routed """
+    def watched_wsgi_app(environ, start_response):
+        app.config['SCHEMA_WATCHER'].poll()
+        return wsgi_app(environ, start_response)
+
+    return watched_wsgi_app
+
+
+def swap_routes(app, tables):
+    """ Replaces the routes of tables with new handlers under live traffic
+
+    The new URL map is built and compiled on the side, then replaces the
+    app's map in one assignment. Requests that matched a route before the
+    swap finish on the handler they matched.
+    """
+    staging = Flask(__name__)
+    staging_api = Api(staging)
+    endpoints = dict(app.config['ENDPOINTS'])
+
+    for name in tables:
+        endpoints.pop(name, None)
+
+        if name not in app.config['SCHEMA']:
+            continue
+
+        resources = table_resources(app, name)
+
+        for klass, path in resources:
+            staging_api.add_resource(klass, path)
+
+        endpoints[name] = [klass.endpoint for klass, _ in resources]
+
+    stale = {endpoint for name in tables for endpoint in app.config['ENDPOINTS'].get(name, ())}
+    rules = [rule.empty() for rule in app.url_map.iter_rules() if rule.endpoint not in stale]
+    rules += [rule.empty() for rule in staging.url_map.iter_rules()
+              if rule.endpoint in staging_api.endpoints]
+    url_map = app.url_map_class(rules, host_matching=app.url_map.host_matching,
+                                converters=app.url_map.converters)
+    url_map.update()
+
+    # Handlers of dropped tables stay for requests that already matched them
+    for endpoint in staging_api.endpoints:
+        app.view_functions[endpoint] = staging.view_functions[endpoint]
+
+    app.config['API'].endpoints.update(staging_api.endpoints)
+    app.url_map = url_map
+    app.config['ENDPOINTS'] = endpoints
+
+
+DEFAULT_PRAGMAS = {
+    'busy_timeout': 5000,
+}
+
+
+def create_app(database='app.db', pool_size=5, pool_timeout=None,
+               json_encoder='auto', cache_size=0, pragmas=None,
+               relationship_cache=None, profile_sample_rate=0.0,
+               slow_query_ms=100, slow_request_ms=500, changes_buffer=1024,
+               replicas=None, replica_interval=0, schema_poll_interval=1.0,
+               search=None, compress_min_size=1024, debug_endpoints=False):
+    """ Builds the API app for an SQLite database
+
+    pragmas are applied to every connection on top of DEFAULT_PRAGMAS, e.g.
+    {'journal_mode': 'wal', 'synchronous': 'normal', 'mmap_size': 268435456}.
+    GET handlers read through a pool of pool_size read-only connections and
+    mutations go through a single writer connection. relationship_cache is
+    an optional file path where inferred relationships are kept between
+    starts while the schema is unchanged.
+
+    replicas are paths of read-only snapshot copies of the database. GET
+    handlers read from them, except for clients that wrote after the newest
+    snapshot, which read from the database itself. With replica_interval
+    seconds the app takes the snapshots, at startup and on that schedule;
+    otherwise they are expected to be copied in by other means.
+
+    The schema is checked for changes at most every schema_poll_interval
+    seconds, before a request is routed, and the handlers of changed tables
+    are rebuilt without a restart. 0 turns the check off.
+
+    search maps tables to the text columns to index for full-text search,
+    e.g. {'articles': ['title', 'body']}. Their collections then take
+    filter[search]=terms and return matches ranked by relevance.
+
+    JSON:API responses of compress_min_size bytes or more are compressed
+    with zstd, br or gzip, as Accept-Encoding prefers, and streamed ones
+    whatever their size. zstd and br need the zstandard and brotli packages.
+    None turns compression off.
+
+    Every request is counted in request metrics. A profile_sample_rate
+    fraction of requests also record SQL, serialization and encode time, and
+    log queries and requests slower than slow_query_ms and slow_request_ms.
+    With debug_endpoints, /metrics serves the metrics and /_debug/profile
+    the logs. These show SQL text and server internals, so they are off
+    unless asked for.
+
+    /api/<resource>/changes serves the last changes_buffer creates, updates
+    and deletes made through this app. The feed lives in the process, so
+    apps served by several worker processes need changes_buffer=0, which
+    turns it off.
+    """
+    app = Flask(__name__)
+    app.config['DATABASE'] = database
+    app.config['PRAGMAS'] = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+    app.config['RESPONSE_CACHE'] = ResponseCache(cache_size) if cache_size > 0 else None
+    app.config['JSON_ENCODER'] = load_json_encoder(json_encoder)
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+    app.config['MAX_PAGE_SIZE'] = 1000
+    app.config['MAX_GROUPS'] = 1000
+    app.config['MAX_RELATIONSHIP_DEPTH'] = 3
+    app.config['MAX_RELATED_ROWS'] = 10000
+    app.config['STREAM_BATCH_SIZE'] = 500
+    app.config['PROFILER'] = Profiler(profile_sample_rate, slow_query_ms,
+                                      slow_request_ms)
+    app.config['CHANGES'] = ChangeFeed(changes_buffer) if changes_buffer > 0 else None
+    app.config['CHANGES_HEARTBEAT'] = 15
+    app.config['RELATIONSHIP_CACHE'] = relationship_cache
+    app.config['REPLICA_INTERVAL'] = replica_interval
+    app.config['COMPRESS_MIN_SIZE'] = compress_min_size
+    app.config['COMPRESS_ENCODINGS'] = available_encodings()
+
+    db = Db(database, pragmas=app.config['PRAGMAS'])
+    app.config['SEARCH'] = {table: create_search_index(db, table, columns)
+                            for table, columns in (search or {}).items()}
+    # Read before introspecting, so a change made meanwhile is caught later
+    app.config['SCHEMA_WATCHER'] = SchemaWatcher(database, lambda: reload_schema(app),
+                                                 schema_poll_interval, app.logger)
+    app.config['SCHEMA'] = SchemaCatalog(db)
+    db.schema = app.config['SCHEMA']
+    app.config['RELATIONSHIPS'] = infer_relationships(db, relationship_cache)
+    app.config['SERIALIZERS'] = compile_serializers(app.config['SCHEMA'],
+                                                    app.config['RELATIONSHIPS'])
+    app.config['INDEX_ADVISOR'] = IndexAdvisor(app.config['SCHEMA'], app.logger)
+    table_names = db.table_names
+    db.close()
+
+    app.config['VERSIONS'] = TableVersions()
+    app.config['POOL'] = ConnectionPool(database, pool_size, pool_timeout,
+                                        app.config['SCHEMA'],
+                                        app.config['VERSIONS'],
+                                        read_only=True,
+                                        pragmas=app.config['PRAGMAS'])
+    app.config['WRITER'] = ConnectionPool(database, 1, pool_timeout,
+                                          app.config['SCHEMA'],
+                                          app.config['VERSIONS'],
+                                          pragmas=app.config['PRAGMAS'])
+    app.config['VERSIONS'].writer = app.config['WRITER']
+    app.config['REPLICAS'] = None
+
+    if replicas:
+        app.config['REPLICAS'] = ReplicaSet(database, replicas, pool_size, pool_timeout,
+                                            app.config['SCHEMA'],
+                                            app.config['VERSIONS'],
+                                            app.config['PRAGMAS'], app.logger)
+        app.after_request(mark_written)
+
+        if replica_interval > 0:
+            app.config['REPLICAS'].refresh()
+            app.config['REPLICAS'].start(replica_interval)
+    app.teardown_appcontext(release_db)
+    app.before_request(start_profile)
+    app.after_request(note_status)
+
+    if compress_min_size is not None:
+        app.after_request(compress_response)
+    app.teardown_request(finish_profile)
+
+    if schema_poll_interval > 0:
+        app.wsgi_app = watch_schema(app, app.wsgi_app)
+
+    api = Api(app)
+
+    @app.route('/')
+    def index():
+        return render_url_map(app.url_map)
+
+    if debug_endpoints:
+        @app.route('/metrics')
+        def metrics():
+            return Response(render_metrics(app),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+        @app.route('/_debug/profile')
+        def debug_profile():
+            return make_jsonapi_response({'meta': profile_report(app)})
+
+    klass = type('HandlerOperations', (Handler,), {
+        'post': post_operations,
+        'app': app,
+    })
+
+    api.add_resource(klass, '/api/_operations')
+
+    app.config['API'] = api
+    app.config['ENDPOINTS'] = {}
+
+    for name in table_names:
+        resources = table_resources(app, name)
+
+        for klass, path in resources:
+            api.add_resource(klass, path)
+
+        app.config['ENDPOINTS'][name] = [klass.endpoint for klass, _ in resources]
 
     return app
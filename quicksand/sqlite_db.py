@@ -1,17 +1,116 @@
 import sqlite3
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.request import pathname2url
+from collections import deque
+from contextlib import contextmanager
+from .schema import TableStatements
+from .search import hidden_tables
+
+
+# Stay below SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds (999)
+MAX_IN_PARAMETERS = 500
+
+# Pragmas that may be set per connection through the pragmas argument
+CONNECTION_PRAGMAS = ('journal_mode', 'synchronous', 'cache_size',
+                      'mmap_size', 'busy_timeout', 'temp_store', 'foreign_keys')
+
+PRAGMA_VALUE = re.compile(r'^-?[A-Za-z0-9_]+$')
+
+
+def check_pragmas(pragmas):
+    for name, value in pragmas.items():
+        if name not in CONNECTION_PRAGMAS:
+            raise ValueError(f'Unsupported pragma "{name}"')
+        if not PRAGMA_VALUE.match(str(value)):
+            raise ValueError(f'Invalid value "{value}" for pragma "{name}"')
 
 
 class SqliteDb:
-    def __init__(self, path):
-        self.conn = sqlite3.connect(path)
-        self.conn.row_factory = sqlite3.Row
+    def __init__(self, path, check_same_thread=True, schema=None,
+                 row_factory=sqlite3.Row, versions=None, read_only=False,
+                 pragmas=None):
+        self.path = path
+        self.schema = schema
+        self.versions = versions
+        self.read_only = read_only
+        self.seen_data_version = None
+        self.in_batch = False
+        self.pending_changes = set()
+        # RequestProfile of a sampled request using this connection
+        self.profile = None
+        # Serializers of the request using this connection, whose statements
+        # take precedence over the schema's
+        self.serializers = None
+
+        if read_only:
+            uri = f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+            self.conn = sqlite3.connect(uri, uri=True,
+                                        check_same_thread=check_same_thread)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=check_same_thread)
+
+        self.conn.row_factory = row_factory
         self.cursor = self.conn.cursor()
 
+        if pragmas is not None:
+            self.set_pragmas(pragmas)
+
+    def set_pragmas(self, pragmas):
+        check_pragmas(pragmas)
+
+        for name, value in pragmas.items():
+            # The journal mode is stored in the database file by its writers
+            if name == 'journal_mode' and self.read_only:
+                continue
+            self.conn.execute(f'PRAGMA {name}={value}').fetchall()
+
     def info(self):
         print(f'SQLite version: {sqlite3.sqlite_version}')
 
     def commit(self):
-        self.conn.commit()
+        # Inside transaction() the whole batch commits once at the end
+        if not self.in_batch:
+            self.conn.commit()
+
+    def changed(self, table):
+        if self.in_batch:
+            self.pending_changes.add(table)
+        elif self.versions is not None:
+            self.versions.bump(table)
+
+    @contextmanager
+    def transaction(self):
+        """ Runs the enclosed writes as one transaction, rolled back on error """
+        if self.in_batch:
+            raise RuntimeError('Transactions cannot be nested')
+
+        if self.conn.in_transaction:
+            self.conn.commit()
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.in_batch = True
+
+        try:
+            yield self
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+            self.in_batch = False
+            for table in self.pending_changes:
+                self.changed(table)
+        finally:
+            self.in_batch = False
+            self.pending_changes = set()
+
+    def data_version(self):
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
 
     def close(self):
         self.commit()
@@ -21,65 +120,562 @@ class SqliteDb:
         if parameters is None:
             parameters = []
 
-        return self.cursor.execute(sql, parameters)
+        if self.profile is None:
+            return self.cursor.execute(sql, parameters)
+
+        started = time.perf_counter()
+        cursor = self.cursor.execute(sql, parameters)
+        self.profile.query(sql, time.perf_counter() - started, max(cursor.rowcount, 0))
+        return cursor
+
+    def execute_many(self, sql, rows):
+        if self.profile is None:
+            return self.cursor.executemany(sql, rows)
+
+        started = time.perf_counter()
+        cursor = self.cursor.executemany(sql, rows)
+        self.profile.query(sql, time.perf_counter() - started, max(cursor.rowcount, 0))
+        return cursor
+
+    def fetch_all(self, sql, parameters=None):
+        """ Rows of a query, timed along with their fetch when profiling """
+        if parameters is None:
+            parameters = []
+
+        if self.profile is None:
+            return self.cursor.execute(sql, parameters).fetchall()
+
+        started = time.perf_counter()
+        records = self.cursor.execute(sql, parameters).fetchall()
+        self.profile.query(sql, time.perf_counter() - started, len(records))
+        return records
+
+    def fetch_one(self, sql, parameters=None):
+        if parameters is None:
+            parameters = []
+
+        if self.profile is None:
+            return self.cursor.execute(sql, parameters).fetchone()
+
+        started = time.perf_counter()
+        record = self.cursor.execute(sql, parameters).fetchone()
+        self.profile.query(sql, time.perf_counter() - started, int(record is not None))
+        return record
+
+    def statements(self, table):
+        if self.serializers is not None and table in self.serializers:
+            return self.serializers[table].statements
+
+        if self.schema is not None:
+            return self.schema[table].statements
+
+        return TableStatements(table, self.table_columns(table))
 
     def execute_script(self, filename):
         with open(filename) as script_file:
             self.cursor.executescript(script_file.read())
 
     def insert_into(self, table, attributes):
-        columns = ','.join(attributes.keys())
         values = tuple(attributes.values())
-        templates = ','.join('?' * len(values))
 
         # todo Most queries, including this one, are not fully sanitized
-        sql = f'INSERT INTO {table} ({columns}) VALUES ({templates});'
+        sql = self.statements(table).insert(attributes.keys())
         self.execute(sql, values)
         self.commit()
+        self.changed(table)
 
         # lastrowid is the id of the last row inserted into for that cursor
         # only. Another cursor will have a different lastrowid.
         return self.cursor.lastrowid
 
     def update_by_id(self, table, id, attributes):
-        columns = ','.join([key + '=?' for key in attributes.keys()])
         values = list(attributes.values())
-        templates = ','.join('?' * len(values))
 
-        sql = f'UPDATE {table} SET {columns} WHERE id=?;'
-        print(sql)
+        sql = self.statements(table).update(attributes.keys())
         self.execute(sql, values + [id])
         self.commit()
+        self.changed(table)
 
-    def find_all(self, table):
-        sql = f'SELECT * FROM {table}'
-        records = self.execute(sql).fetchall()
-        return records
+    def insert_many(self, table, columns, rows):
+        """ Inserts rows of values for the same columns, returning their ids """
+        sql = self.statements(table).insert(columns)
+        ids = []
+
+        for values in rows:
+            self.execute(sql, values)
+            ids.append(self.cursor.lastrowid)
+
+        self.commit()
+        self.changed(table)
+        return ids
+
+    def update_many(self, table, columns, rows):
+        """ Updates the same columns for many ids, each row being values + [id] """
+        sql = self.statements(table).update(columns)
+        self.execute_many(sql, rows)
+        self.commit()
+        self.changed(table)
+
+    def delete_many(self, table, ids):
+        sql = self.statements(table).delete_by_id
+        self.execute_many(sql, [(id,) for id in ids])
+        self.commit()
+        self.changed(table)
+
+    def existing_ids(self, table, ids):
+        ids = list(dict.fromkeys(ids))
+        found = set()
+
+        for start in range(0, len(ids), MAX_IN_PARAMETERS):
+            chunk = ids[start:start + MAX_IN_PARAMETERS]
+            templates = ','.join('?' * len(chunk))
+            sql = f'SELECT id FROM {table} WHERE id IN ({templates})'
+            found.update(row[0] for row in self.fetch_all(sql, chunk))
+
+        return found
+
+    def find_all(self, table, query=None):
+        if query is None or query.is_empty:
+            sql = self.statements(table).find_all
+            return self.fetch_all(sql)
+
+        columns = self.statements(table).columns
+        return self.fetch_all(query.select(table, columns), query.parameters)
+
+    def find_page(self, table, size, after=None, before=None, query=None):
+        """ Keyset page of at most size records ordered by id
+
+        Returns the records and whether more records follow in the paging
+        direction. Paging with before walks backwards from that id. query
+        may filter the records but not sort them.
+        """
+        if query is not None and not query.is_empty:
+            return self._find_filtered_page(table, size, after, before, query)
+
+        statements = self.statements(table)
+
+        if before is not None:
+            sql = statements.find_page_before
+            records = self.fetch_all(sql, [before, size + 1])
+            has_more = len(records) > size
+            return records[:size][::-1], has_more
+
+        if after is None:
+            sql = statements.find_first_page
+            records = self.fetch_all(sql, [size + 1])
+        else:
+            sql = statements.find_page_after
+            records = self.fetch_all(sql, [after, size + 1])
+
+        has_more = len(records) > size
+        return records[:size], has_more
+
+    def _find_filtered_page(self, table, size, after, before, query):
+        parameters = list(query.parameters)
+        columns = self.statements(table).columns
+
+        if before is not None:
+            condition, seek_parameters, order_by = query.seek('<', before)
+            sql = query.select(table, columns, condition, order_by, limit=True)
+            records = self.fetch_all(sql, parameters + seek_parameters + [size + 1])
+            has_more = len(records) > size
+            return records[:size][::-1], has_more
+
+        if after is None:
+            # Pages are never sorted, so this is id order, or rank for searches
+            sql = query.select(table, columns, limit=True)
+            records = self.fetch_all(sql, parameters + [size + 1])
+        else:
+            condition, seek_parameters, order_by = query.seek('>', after)
+            sql = query.select(table, columns, condition, order_by, limit=True)
+            records = self.fetch_all(sql, parameters + seek_parameters + [size + 1])
+
+        has_more = len(records) > size
+        return records[:size], has_more
+
+    def has_id_before(self, table, id, query=None):
+        if query is None or query.is_empty:
+            sql = self.statements(table).has_id_before
+            return self.fetch_one(sql, [id]) is not None
+
+        condition, seek_parameters, order_by = query.seek('<', id)
+        sql = query.select(table, f'{table}.id', condition, order_by, limit=True)
+        return self.fetch_one(sql, query.parameters + seek_parameters + [1]) is not None
+
+    def has_id_after(self, table, id, query=None):
+        if query is None or query.is_empty:
+            sql = self.statements(table).has_id_after
+            return self.fetch_one(sql, [id]) is not None
+
+        condition, seek_parameters, order_by = query.seek('>', id)
+        sql = query.select(table, f'{table}.id', condition, order_by, limit=True)
+        return self.fetch_one(sql, query.parameters + seek_parameters + [1]) is not None
+
+    def iter_all(self, table, batch_size=500, query=None):
+        """ Yields every record of table, fetching batch_size rows at a time """
+        for records in self.iter_batches(table, batch_size, query):
+            yield from records
+
+    def iter_batches(self, table, batch_size=500, query=None):
+        """ Yields the records of table in lists of at most batch_size
+
+        Only one batch of rows is held at a time, so memory stays bounded by
+        batch_size however large the table is.
+        """
+        statements = self.statements(table)
+
+        if query is None or query.is_empty:
+            sql, parameters = statements.find_all_ordered, []
+        else:
+            sql, parameters = query.select(table, statements.columns), query.parameters
+
+        profile = self.profile
+        started = time.perf_counter()
+        cursor = self.conn.execute(sql, parameters)
+        elapsed = time.perf_counter() - started
+        rows = 0
+
+        try:
+            while True:
+                if profile is None:
+                    records = cursor.fetchmany(batch_size)
+                else:
+                    started = time.perf_counter()
+                    records = cursor.fetchmany(batch_size)
+                    elapsed += time.perf_counter() - started
+                    rows += len(records)
+
+                if len(records) == 0:
+                    break
+                yield records
+        finally:
+            cursor.close()
+
+            if profile is not None:
+                profile.query(sql, elapsed, rows)
+
+    def aggregate(self, table, expressions, group_by, query, limit=None):
+        """ Rows of group_by values then expression values, one per group
+
+        Without group_by there is a single row over all matching records.
+        """
+        sql = query.aggregate(table, expressions, group_by, limit is not None)
+        parameters = query.parameters + ([] if limit is None else [limit])
+        return self.fetch_all(sql, parameters)
 
     def find_by_id(self, table, id):
-        sql = f'SELECT * FROM {table} WHERE id=?'
-        record = self.execute(sql, [id]).fetchone()
-        return record
+        sql = self.statements(table).find_by_id
+        return self.fetch_one(sql, [id])
 
     def find_by_field(self, table, field, id):
-        sql = f'SELECT * FROM {table} WHERE {field}=?'
-        print(sql)
-        records = self.execute(sql, [id]).fetchall()
+        sql = self.statements(table).find_by_field(field)
+        records = self.fetch_all(sql, [id])
         return records
 
+    def find_by_ids(self, table, ids, limit=None):
+        return self.find_by_field_in(table, 'id', ids, limit)
+
+    def find_by_field_in(self, table, field, values, limit=None):
+        """ Records whose field is any of values, in batches of IN (...)
+
+        With limit, stops after that many records.
+        """
+        values = list(dict.fromkeys(v for v in values if v is not None))
+        columns = self.statements(table).columns
+        records = []
+
+        for start in range(0, len(values), MAX_IN_PARAMETERS):
+            chunk = values[start:start + MAX_IN_PARAMETERS]
+            templates = ','.join('?' * len(chunk))
+            sql = f'SELECT {columns} FROM {table} WHERE {field} IN ({templates})'
+
+            if limit is None:
+                records.extend(self.fetch_all(sql, chunk))
+                continue
+
+            if len(records) >= limit:
+                break
+
+            records.extend(self.fetch_all(sql + ' LIMIT ?', chunk + [limit - len(records)]))
+
+        return records
+
+    def count_by_field_in(self, table, field, values):
+        """ {value: number of records whose field is value}, one grouped query per batch """
+        values = list(dict.fromkeys(v for v in values if v is not None))
+        counts = {}
+
+        for start in range(0, len(values), MAX_IN_PARAMETERS):
+            chunk = values[start:start + MAX_IN_PARAMETERS]
+            templates = ','.join('?' * len(chunk))
+            sql = (f'SELECT {field}, count(*) FROM {table} '
+                   f'WHERE {field} IN ({templates}) GROUP BY {field}')
+            counts.update(self.fetch_all(sql, chunk))
+
+        return counts
+
+    def ids_by_field_in(self, table, field, values):
+        """ {value: ids of the records whose field is value}, one grouped query per batch """
+        values = list(dict.fromkeys(v for v in values if v is not None))
+        ids = {}
+
+        for start in range(0, len(values), MAX_IN_PARAMETERS):
+            chunk = values[start:start + MAX_IN_PARAMETERS]
+            templates = ','.join('?' * len(chunk))
+            sql = (f'SELECT {field}, json_group_array(id) FROM {table} '
+                   f'WHERE {field} IN ({templates}) GROUP BY {field}')
+            ids.update((value, sorted(json.loads(group)))
+                       for value, group in self.fetch_all(sql, chunk))
+
+        return ids
+
     def delete_by_id(self, table, id):
-        sql = f'DELETE from {table} WHERE id=?;'
+        sql = self.statements(table).delete_by_id
         self.execute(sql, [id])
         self.commit()
+        self.changed(table)
 
     @property
     def table_names(self):
-        sql = "SELECT name FROM sqlite_master WHERE type='table';"
-        return [result[0] for result in self.cursor.execute(sql).fetchall()]
+        if self.schema is not None:
+            return self.schema.table_names
+
+        sql = "SELECT name, sql FROM sqlite_master WHERE type='table';"
+        rows = [tuple(row) for row in self.fetch_all(sql)]
+        hidden = hidden_tables(rows)
+        return [name for name, _ in rows if name not in hidden]
 
     def get_table_info(self, name):
         return self.cursor.execute(f'PRAGMA table_info({name})').fetchall()
 
     def table_columns(self, name):
+        if self.schema is not None:
+            return list(self.schema[name].columns)
+
         rows = self.cursor.execute(f'PRAGMA table_info({name})').fetchall()
-        return [row['name'] for row in rows]
+        return [row[1] for row in rows]
+
+
+class ConnectionPool:
+    """ Bounded pool of SqliteDb connections shared by worker threads
+
+    A thread that releases a connection gets the same one back on its next
+    acquire if it is still idle, so a worker keeps reusing one connection.
+    Pooled connections return plain tuple rows in catalog column order.
+    """
+    def __init__(self, path, size=5, timeout=None, schema=None, versions=None,
+                 read_only=False, pragmas=None):
+        self.path = path
+        self.schema = schema
+        self.versions = versions
+        self.read_only = read_only
+        self.pragmas = pragmas
+        self.size = size
+        self.timeout = timeout
+        self._idle = deque()
+        self._owners = {}
+        self._open = 0
+        self._closed = False
+        # Connections opened before the last reset are closed on release
+        self.generation = 0
+        self._lock = threading.Condition()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+        }
+
+    def acquire(self, wait=True):
+        """ A connection for the calling thread
+
+        Waits up to timeout for one to be released, or with wait=False
+        returns None instead of waiting.
+        """
+        thread_id = threading.get_ident()
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Connection pool is closed')
+
+            started = time.perf_counter()
+            waited = False
+
+            if not wait and len(self._idle) == 0 and self._open >= self.size:
+                return None
+
+            while len(self._idle) == 0 and self._open >= self.size:
+                waited = True
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.perf_counter() - started)
+                    if remaining <= 0:
+                        raise TimeoutError(f'No connection available for "{self.path}"')
+                self._lock.wait(remaining)
+
+            if waited:
+                self.stats['waits'] += 1
+                self.stats['wait_time'] += time.perf_counter() - started
+
+            if len(self._idle) > 0:
+                self.stats['hits'] += 1
+                db = self._take_idle(thread_id)
+                self._owners[id(db)] = thread_id
+                return db
+
+            self.stats['misses'] += 1
+            self._open += 1
+            generation = self.generation
+
+        try:
+            db = SqliteDb(self.path, check_same_thread=False,
+                          schema=self.schema, row_factory=None,
+                          versions=self.versions, read_only=self.read_only,
+                          pragmas=self.pragmas)
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+
+        db.generation = generation
+
+        with self._lock:
+            self._owners[id(db)] = thread_id
+
+        return db
+
+    def _take_idle(self, thread_id):
+        # Prefer the connection this thread used last
+        for db in self._idle:
+            if self._owners.get(id(db)) == thread_id:
+                self._idle.remove(db)
+                return db
+
+        return self._idle.pop()
+
+    def release(self, db):
+        if db.conn.in_transaction:
+            db.conn.rollback()
+
+        with self._lock:
+            if self._closed or db.generation != self.generation:
+                self._open -= 1
+                self._owners.pop(id(db), None)
+                db.conn.close()
+                self._lock.notify()
+                return
+
+            self._idle.append(db)
+            self._lock.notify()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            while len(self._idle) > 0:
+                db = self._idle.pop()
+                self._owners.pop(id(db), None)
+                self._open -= 1
+                db.conn.close()
+            self._lock.notify_all()
+
+    def reset(self):
+        """ Reopens connections, e.g. after the database file was replaced
+
+        Idle connections are closed now and those in use when released.
+        """
+        with self._lock:
+            self.generation += 1
+            while len(self._idle) > 0:
+                db = self._idle.pop()
+                self._owners.pop(id(db), None)
+                self._open -= 1
+                db.conn.close()
+            self._lock.notify_all()
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, size=self.size, open=self._open,
+                        idle=len(self._idle))
+
+
+class TableVersions:
+    """ Per-table change counters used to build cheap ETags
+
+    Writes through SqliteDb bump the table they touched. Writes by other
+    connections or processes cannot be traced to a table, so they bump a
+    generation shared by every table instead. Set writer to the pool of the
+    connection writes go through, so that they can be told apart.
+    """
+    def __init__(self):
+        self.token = os.urandom(8).hex()
+        self.generation = 0
+        self.versions = {}
+        self.writer = None
+        self._writer_opened = False
+        self._lock = threading.Lock()
+
+    def reseed(self):
+        """ Takes a new token, e.g. in a forked worker
+
+        Counters are kept per process, so two processes sharing a token could
+        tag different data with the same ETag.
+        """
+        with self._lock:
+            self.token = os.urandom(8).hex()
+
+    def bump(self, table):
+        with self._lock:
+            self.versions[table] = self.versions.get(table, 0) + 1
+
+    def observe(self, db):
+        """ Catches writes made outside the writer before db is read
+
+        PRAGMA data_version of db moves when any other connection commits,
+        including the writer. The writer's own data_version only moves for
+        commits by others, so it is only asked when db has seen a change.
+        Reads never wait for the writer: while it is busy the change is
+        counted as an outside write, since a needless new ETag is cheaper
+        than a stalled read.
+        """
+        data_version = db.data_version()
+
+        if data_version == db.seen_data_version:
+            return
+
+        db.seen_data_version = data_version
+
+        if self.writer is None:
+            with self._lock:
+                self.generation += 1
+            return
+
+        writer = self.writer.acquire(wait=False)
+
+        if writer is None:
+            with self._lock:
+                self.generation += 1
+            return
+
+        try:
+            writer_version = writer.data_version()
+        finally:
+            self.writer.release(writer)
+
+        with self._lock:
+            if writer.seen_data_version is None:
+                # A new writer connection did not see what happened before it
+                changed = self._writer_opened
+                self._writer_opened = True
+            else:
+                changed = writer_version != writer.seen_data_version
+
+            if changed:
+                self.generation += 1
+
+            writer.seen_data_version = writer_version
+
+    def etag(self, tables, key=''):
+        versions = ','.join(str(self.versions.get(table, 0)) for table in tables)
+        value = f'{self.token}:{self.generation}:{versions}:{key}'
+        return hashlib.blake2b(value.encode('utf-8'), digest_size=12).hexdigest()
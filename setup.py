@@ -12,5 +12,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=["flask", "flask_restful", "inflect"],
-    extras_require={"test": ["pytest", "coverage"]},
+    extras_require={"test": ["pytest", "coverage"], "fast": ["orjson"],
+                    "compress": ["brotli", "zstandard"]},
+    entry_points={"console_scripts": ["quicksand=quicksand.cli:main"]},
 )
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import pytest
+from quicksand import create_app, Db
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.fixture
+def client(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    db = Db(db_path)
+    db.insert_into('articles', {'title': 'Article 3', 'body': 'Body 3', 'author_id': 1})
+    db.close()
+    return create_app(db_path).test_client()
+
+
+def test_count(client):
+    response = client.get('/api/articles/_aggregate')
+    assert response.status_code == 200
+    assert response.get_json() == {'meta': {'aggregates': {'count': 3}}}
+
+
+def test_functions(client):
+    response = client.get('/api/articles/_aggregate?'
+                          'aggregate=count,count:author_id,sum:id,min:title,max:id,avg:id')
+    assert response.get_json()['meta']['aggregates'] == {
+        'count': 3,
+        'count:author_id': 2,
+        'sum:id': 6,
+        'min:title': 'Article 1',
+        'max:id': 3,
+        'avg:id': 2.0,
+    }
+
+
+def test_group_by(client):
+    response = client.get('/api/articles/_aggregate?aggregate=count,max:id&group_by=author_id')
+    assert response.get_json()['meta']['groups'] == [
+        {'group': {'author_id': None}, 'aggregates': {'count': 1, 'max:id': 2}},
+        {'group': {'author_id': 1}, 'aggregates': {'count': 2, 'max:id': 3}},
+    ]
+
+
+def test_filtered(client):
+    response = client.get('/api/articles/_aggregate?aggregate=sum:id&filter[id][gt]=1')
+    assert response.get_json()['meta']['aggregates'] == {'sum:id': 5}
+
+    response = client.get('/api/articles/_aggregate?filter[id][gt]=9')
+    assert response.get_json()['meta']['aggregates'] == {'count': 0}
+
+
+def test_follows_writes(client):
+    etag = client.get('/api/authors/_aggregate').headers['ETag']
+    client.post('/api/authors', json={'data': {'type': 'authors',
+                                               'attributes': {'name': 'Author 2'}}})
+
+    response = client.get('/api/authors/_aggregate', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['meta']['aggregates'] == {'count': 2}
+
+
+@pytest.mark.parametrize('query', [
+    'aggregate=median:id',
+    'aggregate=sum',
+    'aggregate=sum:missing',
+    'aggregate=,',
+    'group_by=missing',
+    'sort=id',
+])
+def test_invalid(client, query):
+    response = client.get(f'/api/articles/_aggregate?{query}')
+    assert response.status_code == 400
+    assert len(response.get_json()['errors']) == 1
+
+
+def test_group_limit(db_path, client):
+    client.application.config['MAX_GROUPS'] = 2
+    assert client.get('/api/articles/_aggregate?group_by=author_id').status_code == 200
+    assert client.get('/api/articles/_aggregate?group_by=id').status_code == 400
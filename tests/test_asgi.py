@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+import tempfile
+import pytest
+from quicksand import create_asgi_app, Db
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def request(app, method, path, query=b'', body=b'', headers=()):
+    """ Runs one request through the ASGI app, returning status, headers, body """
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'query_string': query,
+        'root_path': '',
+        'headers': [(b'host', b'localhost')] + list(headers),
+        'client': ('127.0.0.1', 1234),
+        'server': ('localhost', 80),
+    }
+    messages = [{'type': 'http.request', 'body': body[:5], 'more_body': True},
+                {'type': 'http.request', 'body': body[5:], 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    assert sent[-1]['more_body'] is False
+    return sent[0]['status'], headers, body
+
+
+def test_get_resource(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_asgi_app(db_path)
+
+    status, headers, body = request(app, 'GET', '/api/articles/1')
+    assert status == 200
+    assert headers['content-type'] == 'application/vnd.api+json'
+    assert json.loads(body)['data']['links']['self'] == 'http://localhost/api/articles/1'
+
+
+def test_stream_and_query(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_asgi_app(db_path)
+
+    status, _, body = request(app, 'GET', '/api/articles', b'stream=1&sort=-id')
+    assert status == 200
+    assert [r['id'] for r in json.loads(body)['data']] == [2, 1]
+
+    info = app.app.config['POOL'].info()
+    assert info['open'] == info['idle']
+
+
+def test_create_resource(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_asgi_app(db_path)
+    body = json.dumps({'data': {'type': 'articles',
+                                'attributes': {'title': 'Article 3'}}}).encode()
+
+    status, _, response = request(app, 'POST', '/api/articles', body=body,
+                                  headers=[(b'content-type', b'application/json')])
+    assert status == 201
+    assert json.loads(response)['data']['id'] == 3
+
+    status, _, _ = request(app, 'GET', '/api/articles/3')
+    assert status == 200
+
+
+def test_body_too_large(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_asgi_app(db_path)
+    app.app.config['MAX_CONTENT_LENGTH'] = 100
+    body = json.dumps({'data': {'type': 'articles',
+                                'attributes': {'title': 'x' * 200}}}).encode()
+
+    status, _, response = request(app, 'POST', '/api/articles', body=body,
+                                  headers=[(b'content-type', b'application/json')])
+    assert status == 413
+    assert json.loads(response)['errors'][0]['title'] == 'Request too large'
+
+    status, _, body = request(app, 'GET', '/api/articles')
+    assert len(json.loads(body)['data']) == 2
+
+
+def test_lifespan_closes_pools(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_asgi_app(db_path)
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(app({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
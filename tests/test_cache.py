@@ -0,0 +1,69 @@
+import os
+import tempfile
+import pytest
+from quicksand import create_app, Db
+from quicksand.cache import ResponseCache, CachedResponse, ENTRY_OVERHEAD
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def test_lru_eviction_by_bytes():
+    cache = ResponseCache(3 * (ENTRY_OVERHEAD + 11))
+    for key in ['a', 'b', 'c']:
+        cache.put(key, CachedResponse('e', b'0123456789', 'text/plain', ['t']))
+
+    assert cache.get('a', 'e') is not None
+    cache.put('d', CachedResponse('e', b'0123456789', 'text/plain', ['t']))
+
+    assert cache.get('b', 'e') is None
+    assert cache.get('a', 'e') is not None
+    assert cache.info()['evictions'] == 1
+    assert cache.info()['entries'] == 3
+
+
+def test_stale_etag_is_a_miss():
+    cache = ResponseCache(10000)
+    cache.put('a', CachedResponse('old', b'{}', 'text/plain', ['t']))
+    assert cache.get('a', 'new') is None
+    assert cache.stats['misses'] == 1
+
+
+def test_cached_get(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, cache_size=1 << 20)
+    client = app.test_client()
+
+    first = client.get('/api/articles')
+    assert first.headers['X-Cache'] == 'MISS'
+
+    second = client.get('/api/articles')
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.headers['Content-Type'] == 'application/vnd.api+json'
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.get_data() == first.get_data()
+    assert app.config['RESPONSE_CACHE'].info()['hits'] == 1
+
+
+def test_write_invalidates_related(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, cache_size=1 << 20)
+    client = app.test_client()
+    cache = app.config['RESPONSE_CACHE']
+
+    client.get('/api/authors/1/articles')
+    client.get('/api/articles/1')
+    assert len(cache) == 2
+
+    client.patch('/api/authors/1', json={
+        'data': {'type': 'authors', 'id': 1, 'attributes': {'name': 'Renamed'}}
+    })
+    assert len(cache) == 0
+
+    response = client.get('/api/articles/1/author')
+    assert response.get_json()['data']['attributes']['name'] == 'Renamed'
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import pytest
+from quicksand import create_app, create_asgi_app, Db
+from quicksand.changes import ChangeFeed, ChangesExpired
+from quicksand.prefork import PreforkServer
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def test_feed_read_and_resume():
+    feed = ChangeFeed(4)
+    feed.publish('articles', 'create', [1, 2])
+    feed.publish('authors', 'update', [1])
+
+    changes, last = feed.read('articles', 0)
+    assert [(c.sequence, c.action, c.id) for c in changes] == [(1, 'create', 1), (2, 'create', 2)]
+    assert last == 3
+
+    assert feed.read('articles', last) == ([], 3)
+
+    feed.publish('articles', 'delete', [1, 2])
+    assert [c.sequence for c in feed.read('articles', 3)[0]] == [4, 5]
+
+    # Sequence 1 has been overwritten, so a client at 0 missed it
+    with pytest.raises(ChangesExpired):
+        feed.read('articles', 0)
+
+    with pytest.raises(ChangesExpired):
+        feed.read('articles', 99)
+
+
+def test_feed_wait():
+    feed = ChangeFeed()
+    assert feed.wait('articles', 0, 0.01) == ([], 0)
+
+    timer = threading.Timer(0.05, feed.publish, ['articles', 'create', [7]])
+    timer.start()
+    changes, last = feed.wait('articles', 0, 5)
+    timer.join()
+    assert [c.id for c in changes] == [7]
+    assert last == 1
+
+
+def test_feed_wait_async():
+    feed = ChangeFeed()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, feed.publish, 'authors', 'update', [3])
+        loop.call_later(0.1, feed.publish, 'articles', 'create', [4])
+        return await feed.wait_async('articles', 0, 5)
+
+    changes, last = asyncio.run(run())
+    assert [(c.resource, c.id) for c in changes] == [('articles', 4)]
+    assert last == 2
+    assert feed._waiters == set()
+
+
+def test_long_poll(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    client = create_app(db_path).test_client()
+
+    response = client.get('/api/articles/changes?timeout=0')
+    assert response.status_code == 200
+    assert response.get_json(force=True) == {'data': [], 'meta': {'last': 0}}
+
+    client.post('/api/articles', json={'data': {'type': 'articles',
+                                                'attributes': {'title': 'New'}}})
+    client.post('/api/authors', json={'data': {'type': 'authors', 'attributes': {'name': 'A'},
+        'relationships': {'articles': {'data': [{'type': 'articles', 'id': 2}]}}}})
+    client.patch('/api/articles/1', json={'data': {'type': 'articles', 'id': 1,
+                                                   'attributes': {'title': 'Changed'}}})
+    client.delete('/api/articles/3')
+    client.post('/api/_operations', json={'atomic:operations': [
+        {'op': 'remove', 'ref': {'type': 'articles', 'id': 2}}]})
+
+    obj = client.get('/api/articles/changes?after=0&timeout=0').get_json(force=True)
+    assert [(c['action'], c['data']['id']) for c in obj['data']] == [
+        ('create', 3), ('update', 2), ('update', 1), ('delete', 3), ('delete', 2)
+    ]
+    assert obj['data'][0]['data']['type'] == 'articles'
+    assert obj['meta']['last'] == 6
+
+    obj = client.get('/api/authors/changes',
+                     headers={'Last-Event-ID': '1'}, query_string={'timeout': 0}).get_json(force=True)
+    assert [(c['sequence'], c['action']) for c in obj['data']] == [(2, 'create')]
+
+
+def test_long_poll_errors(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    client = create_app(db_path, changes_buffer=2).test_client()
+
+    assert client.get('/api/articles/changes?after=x').status_code == 400
+
+    for i in range(3):
+        client.delete(f'/api/articles/{i}')
+
+    response = client.get('/api/articles/changes?after=0&timeout=0')
+    assert response.status_code == 410
+    assert response.get_json(force=True)['errors'][0]['title'] == 'Changes expired'
+
+
+def test_feed_off_for_workers(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, changes_buffer=0)
+    client = app.test_client()
+
+    assert client.delete('/api/articles/2').status_code == 204
+    assert client.get('/api/articles/changes').status_code == 404
+
+    with pytest.raises(ValueError):
+        PreforkServer(None, workers=2).check_app(create_app(db_path))
+    assert PreforkServer(None, workers=2).check_app(app) is app
+
+
+def test_event_stream(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path)
+    client = app.test_client()
+
+    client.delete('/api/articles/2')
+    response = client.get('/api/articles/changes?after=0',
+                          headers={'Accept': 'text/event-stream'})
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/event-stream')
+
+    chunks = iter(response.response)
+    assert next(chunks) == b'retry: 2000\n\n'
+    event = next(chunks).decode()
+    assert event.startswith('id: 1\nevent: delete\ndata: ')
+    assert json.loads(event.split('data: ')[1])['data'] == {'type': 'articles', 'id': 2}
+
+    # Closing the feed ends the stream, as on shutdown
+    app.config['CHANGES'].close()
+    assert list(chunks) == []
+    response.close()
+
+
+def test_asgi_changes(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_asgi_app(db_path)
+    feed = app.app.config['CHANGES']
+    feed.publish('articles', 'update', [1])
+
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': '/api/articles/changes',
+        'query_string': b'after=0&timeout=0',
+        'root_path': '',
+        'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 1234),
+        'server': ('localhost', 80),
+    }
+
+    async def run(scope, disconnect_after=None):
+        sent = []
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnect_after.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if disconnect_after is not None and b'event: create' in message.get('body', b''):
+                disconnect_after.set()
+
+        await app(scope, receive, send)
+        return sent
+
+    sent = asyncio.run(run(scope))
+    assert sent[0]['status'] == 200
+    assert json.loads(sent[1]['body'])['data'][0]['action'] == 'update'
+
+    async def stream():
+        disconnected = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.05, feed.publish, 'articles', 'create', [5])
+        return await run(dict(scope, query_string=b'after=1',
+                              headers=[(b'accept', b'text/event-stream')]), disconnected)
+
+    sent = asyncio.run(stream())
+    assert dict(sent[0]['headers'])[b'content-type'] == b'text/event-stream'
+    body = b''.join(message['body'] for message in sent[1:])
+    assert body.startswith(b'retry: 2000\n\nid: 2\nevent: create\n')
+    assert feed._waiters == set()
+    app.close()
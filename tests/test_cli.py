@@ -0,0 +1,80 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import pytest
+from quicksand import Db
+from quicksand.cli import build_parser, main
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def test_parse_serve():
+    args = build_parser().parse_args(['serve', 'my.db', '--workers', '4',
+                                      '--pragma', 'journal_mode=wal'])
+    assert args.database == 'my.db'
+    assert args.workers == 4
+    assert dict(args.pragma) == {'journal_mode': 'wal'}
+
+    args = build_parser().parse_args(['serve', '--search', 'articles=title,body'])
+    assert dict(args.search) == {'articles': ['title', 'body']}
+
+    args = build_parser().parse_args(['serve', '--no-compress'])
+    assert args.no_compress and args.compress_min_size == 1024
+    assert not args.debug_endpoints
+
+    args = build_parser().parse_args(['serve', '--debug-endpoints'])
+    assert args.debug_endpoints
+
+
+def test_snapshot_command(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    replica = db_path + '.replica'
+
+    try:
+        main(['snapshot', db_path, replica])
+        assert len(Db(replica).find_all('articles')) == 2
+    finally:
+        os.unlink(replica)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_serve_workers(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'quicksand.cli', 'serve', db_path,
+         '--workers', '2', '--port', '0'],
+        stderr=subprocess.PIPE, text=True)
+
+    try:
+        line = process.stderr.readline()
+        port = int(line.split('http://127.0.0.1:')[1].split()[0])
+
+        def get(path):
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}') as response:
+                return json.loads(response.read())
+
+        assert get('/api/articles/1')['data']['id'] == 1
+
+        # The change feed is per process, so it is off with several workers
+        with pytest.raises(urllib.error.HTTPError) as error:
+            get('/api/articles/changes?timeout=0')
+        assert error.value.code == 404
+
+        process.send_signal(signal.SIGHUP)
+        time.sleep(0.5)
+        assert len(get('/api/articles')['data']) == 2
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
@@ -0,0 +1,127 @@
+import gzip
+import json
+import os
+import tempfile
+import zlib
+import pytest
+from quicksand import create_app, Db
+from quicksand.compression import compress_stream, negotiate
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def make_app(db_path, **kwargs):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    db = Db(db_path)
+    for i in range(50):
+        db.insert_into('articles', {'title': f'Article {i}', 'body': 'Body'})
+    db.close()
+    return create_app(db_path, **kwargs)
+
+
+def test_gzip_negotiation(db_path):
+    client = make_app(db_path).test_client()
+    plain = client.get('/api/articles')
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.headers['Vary'] == 'Accept-Encoding'
+
+    response = client.get('/api/articles', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+    assert len(response.get_data()) * 5 < len(plain.get_data())
+    assert gzip.decompress(response.get_data()) == plain.get_data()
+
+    response = client.get('/api/articles', headers={'Accept-Encoding': 'gzip',
+                                                    'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+    response = client.get('/api/articles', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_min_size(db_path):
+    client = make_app(db_path).test_client()
+    assert 'Content-Encoding' not in client.get('/api/articles/1', headers={
+        'Accept-Encoding': 'gzip'}).headers
+
+    client = create_app(db_path, compress_min_size=None).test_client()
+    response = client.get('/api/articles', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert 'Vary' not in response.headers
+
+
+def test_streamed(db_path):
+    client = make_app(db_path).test_client()
+    response = client.get('/api/articles?stream=1', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.decompress(response.get_data()))['data']) == 52
+    response.close()
+
+
+def test_compress_stream_flushes_chunks():
+    closed = []
+
+    def chunks():
+        try:
+            yield b'{"data":['
+            yield b']}'
+        finally:
+            closed.append(True)
+
+    stream = compress_stream(chunks(), 'gzip')
+    decompressor = zlib.decompressobj(wbits=31)
+    assert decompressor.decompress(next(stream)) == b'{"data":['
+    stream.close()
+    assert closed == [True]
+
+
+def test_cache_keeps_compressed_bodies(db_path):
+    app = make_app(db_path, cache_size=1 << 20)
+    client = app.test_client()
+    cache = app.config['RESPONSE_CACHE']
+
+    first = client.get('/api/articles', headers={'Accept-Encoding': 'gzip'})
+    assert first.headers['X-Cache'] == 'MISS'
+    size = cache.bytes
+
+    second = client.get('/api/articles', headers={'Accept-Encoding': 'gzip'})
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.headers['Content-Encoding'] == 'gzip'
+    assert second.get_data() == first.get_data()
+    assert cache.bytes == size
+
+    plain = client.get('/api/articles')
+    assert plain.headers['X-Cache'] == 'HIT'
+    assert gzip.decompress(second.get_data()) == plain.get_data()
+
+
+def test_cache_adds_compressed_bodies(db_path):
+    app = make_app(db_path, cache_size=1 << 20)
+    client = app.test_client()
+    cache = app.config['RESPONSE_CACHE']
+
+    plain = client.get('/api/articles')
+    size = cache.bytes
+
+    response = client.get('/api/articles', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['X-Cache'] == 'HIT'
+    assert gzip.decompress(response.get_data()) == plain.get_data()
+    assert cache.bytes == size + len(response.get_data())
+
+
+def test_negotiate():
+    def accept(value):
+        return parse_accept_header(value, Accept)
+
+    assert negotiate(accept('gzip, br, zstd'), ['zstd', 'br', 'gzip']) == 'zstd'
+    assert negotiate(accept('gzip, br;q=0.5'), ['br', 'gzip']) == 'gzip'
+    assert negotiate(accept('*'), ['gzip']) == 'gzip'
+    assert negotiate(accept('identity'), ['gzip']) is None
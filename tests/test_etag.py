@@ -0,0 +1,200 @@
+import os
+import signal
+import tempfile
+import threading
+import pytest
+from quicksand import create_app, Db
+from quicksand.server import reset_after_fork
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.fixture
+def client(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    return create_app(db_path).test_client()
+
+
+@pytest.mark.parametrize('url', [
+    '/api/articles',
+    '/api/articles?stream=1',
+    '/api/articles/1',
+    '/api/articles/1/author',
+    '/api/authors/1/articles',
+])
+def test_not_modified(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    # Streamed responses hold their connection until closed
+    response.close()
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.get_data() == b''
+
+
+def test_stream_holds_connection_until_closed(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path)
+    pool = app.config['POOL']
+
+    response = app.test_client().get('/api/articles?stream=1')
+    assert pool.info()['idle'] == 0
+    response.get_data()
+    response.close()
+    assert pool.info()['idle'] == 1
+
+
+def test_write_changes_etag(client):
+    etag = client.get('/api/articles/1').headers['ETag']
+
+    client.patch('/api/articles/1', json={
+        'data': {'type': 'articles', 'id': 1, 'attributes': {'body': 'changed'}}
+    })
+
+    response = client.get('/api/articles/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_related_write_changes_relationship_etag(client):
+    etag = client.get('/api/articles/1/author').headers['ETag']
+    client.patch('/api/authors/1', json={
+        'data': {'type': 'authors', 'id': 1, 'attributes': {'name': 'Renamed'}}
+    })
+
+    response = client.get('/api/articles/1/author', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+def test_outside_write_changes_etag(client, db_path):
+    etag = client.get('/api/articles').headers['ETag']
+
+    db = Db(db_path)
+    db.execute("UPDATE articles SET title='Outside' WHERE id=1")
+    db.close()
+
+    response = client.get('/api/articles', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json(force=True)['data'][0]['attributes']['title'] == 'Outside'
+
+
+def test_write_keeps_other_tables_etags(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    db = Db(db_path)
+    db.execute('CREATE TABLE comments (id INTEGER PRIMARY KEY, text TEXT, article_id INTEGER)')
+    db.close()
+    app = create_app(db_path)
+    client = app.test_client()
+    etag = client.get('/api/articles').headers['ETag']
+
+    # New connections and connections that see the write both leave it be
+    versions = app.config['VERSIONS']
+    pool = app.config['POOL']
+    held = [pool.acquire() for _ in range(pool.size)]
+    for db in held:
+        versions.observe(db)
+
+    client.post('/api/comments', json={'data': {
+        'type': 'comments', 'attributes': {'text': 'First', 'article_id': 1}}})
+
+    for db in held:
+        versions.observe(db)
+        pool.release(db)
+
+    response = client.get('/api/articles', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert app.config['VERSIONS'].generation == 0
+
+
+def test_read_does_not_wait_for_writer(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, pragmas={'journal_mode': 'wal'})
+    client = app.test_client()
+    etag = client.get('/api/articles').headers['ETag']
+
+    db = Db(db_path)
+    db.execute("UPDATE articles SET title='Outside' WHERE id=1")
+    db.close()
+
+    # A write in progress holds the writer
+    writer = app.config['WRITER'].acquire()
+    writer.conn.execute("UPDATE authors SET name='Pending' WHERE id=1")
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(
+        client.get('/api/articles', headers={'If-None-Match': etag})))
+    thread.start()
+    thread.join(5)
+
+    try:
+        assert not thread.is_alive()
+        assert responses[0].status_code == 200
+        assert responses[0].get_json()['data'][0]['attributes']['title'] == 'Outside'
+    finally:
+        app.config['WRITER'].release(writer)
+        thread.join()
+
+
+def fork(work):
+    """ Runs work(send, receive) in a child process; returns its pid and pipe ends """
+    from_parent, to_child = os.pipe()
+    from_child, to_parent = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        status = 1
+        # Don't outlive a parent that failed before answering
+        signal.alarm(10)
+        try:
+            work(lambda text: os.write(to_parent, text.encode() + b'\n'),
+                 lambda: os.read(from_parent, 1024).decode().strip())
+            status = 0
+        finally:
+            os._exit(status)
+
+    return pid, (lambda text: os.write(to_child, text.encode() + b'\n'),
+                 lambda: os.read(from_child, 1024).decode().strip())
+
+
+def test_forked_workers_do_not_share_etags(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path)
+
+    def worker_a(send, receive):
+        reset_after_fork(app)
+        client = app.test_client()
+        send(client.get('/api/authors/1').headers['ETag'])
+        receive()
+        client.patch('/api/authors/1', json={'data': {
+            'type': 'authors', 'id': '1', 'attributes': {'name': 'Renamed'}}})
+        send('written')
+
+    def worker_b(send, receive):
+        reset_after_fork(app)
+        client = app.test_client()
+        send(client.get('/api/authors/1').headers['ETag'])
+        response = client.get('/api/authors/1', headers={'If-None-Match': receive()})
+        send(f'{response.status_code} {response.headers["ETag"]}')
+
+    pid_a, (send_a, receive_a) = fork(worker_a)
+    pid_b, (send_b, receive_b) = fork(worker_b)
+    etag_a, etag_b = receive_a(), receive_b()
+    assert etag_a != etag_b
+
+    send_a('write')
+    assert receive_a() == 'written'
+    send_b(etag_a)
+    status, etag = receive_b().split()
+    assert status == '200'
+    assert etag not in (etag_a, etag_b)
+
+    for pid in (pid_a, pid_b):
+        assert os.waitpid(pid, 0)[1] == 0
@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+import pytest
+from quicksand import create_app, Db
+from quicksand.jsonapi import load_json_encoder, encode_stdlib
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.mark.parametrize('encoder', ['auto', 'json'])
+def test_encoders_produce_same_document(db_path, encoder):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    client = create_app(db_path, json_encoder=encoder).test_client()
+
+    response = client.get('/api/articles/1')
+    assert response.headers['Content-Type'] == 'application/vnd.api+json'
+    assert response.get_json()['data']['attributes'] == {
+        'title': 'Article 1',
+        'body': 'Body 1',
+    }
+
+
+def test_custom_encoder(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    calls = []
+
+    def encoder(obj):
+        calls.append(obj)
+        return json.dumps(obj).encode('utf-8')
+
+    client = create_app(db_path, json_encoder=encoder).test_client()
+    client.get('/api/articles?stream=1').get_data()
+    # One call per batch of rows
+    assert len(calls) == 1
+    assert len(calls[0]) == 2
+
+    client.get('/api/articles').get_data()
+    assert len(calls) == 2
+
+
+def test_unknown_encoder():
+    with pytest.raises(ValueError):
+        load_json_encoder('yaml')
+
+
+def test_stdlib_encoder_is_compact():
+    assert encode_stdlib({'a': [1, 'é']}) == '{"a":[1,"é"]}'.encode('utf-8')
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import pytest
+from quicksand import create_app, Db
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.fixture
+def client(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    return create_app(db_path).test_client()
+
+
+def test_bulk_create(client):
+    response = client.post('/api/articles', json={
+        'data': [
+            {'type': 'articles', 'attributes': {'title': 'Article 3', 'body': 'Body 3'}},
+            {'type': 'articles', 'attributes': {'title': 'Article 4', 'body': 'Body 4'},
+             'relationships': {'author': {'data': {'type': 'authors', 'id': 1}}}},
+        ]
+    })
+
+    assert response.status_code == 201
+    assert response.headers['Content-Type'] == 'application/vnd.api+json'
+    data = response.get_json(force=True)['data']
+    assert [(r['id'], r['attributes']['title']) for r in data] == [
+        (3, 'Article 3'), (4, 'Article 4')
+    ]
+
+    response = client.get('/api/authors/1/articles')
+    assert [r['id'] for r in response.get_json(force=True)['data']] == [1, 4]
+
+
+def test_atomic_operations(client):
+    response = client.post('/api/_operations', json={
+        'atomic:operations': [
+            {'op': 'add', 'data': {
+                'type': 'authors',
+                'attributes': {'name': 'Author 2'},
+                'relationships': {'articles': {'data': [{'type': 'articles', 'id': 2}]}},
+            }},
+            {'op': 'update', 'data': {'type': 'articles', 'id': '1',
+                                      'attributes': {'body': 'changed'}}},
+            {'op': 'remove', 'ref': {'type': 'articles', 'id': '1'}},
+        ]
+    })
+
+    assert response.status_code == 200
+    results = response.get_json(force=True)['atomic:results']
+    assert results[0]['data']['id'] == 2
+    assert results[0]['data']['attributes'] == {'name': 'Author 2'}
+    assert results[1] == {}
+    assert results[2] == {}
+
+    assert client.get('/api/articles/1').status_code == 404
+    response = client.get('/api/authors/2/articles')
+    assert [r['id'] for r in response.get_json(force=True)['data']] == [2]
+
+
+def test_failed_operation_rolls_back_batch(client):
+    response = client.post('/api/_operations', json={
+        'atomic:operations': [
+            {'op': 'add', 'data': {'type': 'articles', 'attributes': {'title': 'New'}}},
+            {'op': 'remove', 'ref': {'type': 'articles', 'id': '1'}},
+            {'op': 'update', 'data': {'type': 'articles', 'id': '99',
+                                      'attributes': {'title': 'Missing'}}},
+        ]
+    })
+
+    assert response.status_code == 404
+    error = response.get_json(force=True)['errors'][0]
+    assert error['source'] == {'pointer': '/atomic:operations/2'}
+
+    response = client.get('/api/articles')
+    assert [r['id'] for r in response.get_json(force=True)['data']] == [1, 2]
+
+
+def test_invalid_column_rolls_back_bulk_create(client):
+    response = client.post('/api/articles', json={
+        'data': [
+            {'type': 'articles', 'attributes': {'title': 'Article 3'}},
+            {'type': 'articles', 'attributes': {'color': 'red'}},
+        ]
+    })
+
+    assert response.status_code == 400
+    assert response.get_json(force=True)['errors'][0]['source'] == {'pointer': '/data/1'}
+    response = client.get('/api/articles')
+    assert len(response.get_json(force=True)['data']) == 2
+
+
+@pytest.mark.parametrize('item', ['articles', 3, None, ['title']])
+def test_bulk_create_rejects_non_objects(client, item):
+    response = client.post('/api/articles', json={
+        'data': [{'type': 'articles', 'attributes': {'title': 'Article 3'}}, item]
+    })
+
+    assert response.status_code == 400
+    error = response.get_json(force=True)['errors'][0]
+    assert error['source'] == {'pointer': '/data/1'}
+    assert len(client.get('/api/articles').get_json(force=True)['data']) == 2
+
+
+def test_unknown_type(client):
+    response = client.post('/api/_operations', json={
+        'atomic:operations': [{'op': 'remove', 'ref': {'type': 'editors', 'id': '1'}}]
+    })
+    assert response.status_code == 400
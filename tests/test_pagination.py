@@ -0,0 +1,85 @@
+import os
+import tempfile
+import pytest
+from urllib.parse import urlparse, parse_qs
+from quicksand import create_app, Db
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.fixture
+def client(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/basic.sql')
+    for i in range(3, 11):
+        db.insert_into('articles', {'title': f'Article {i}', 'body': f'Body {i}'})
+    db.close()
+    return create_app(db_path).test_client()
+
+
+def page_query(url):
+    return parse_qs(urlparse(url).query)
+
+
+def test_first_page(client):
+    response = client.get('/api/articles?page[size]=3')
+    assert response.status_code == 200
+    obj = response.get_json(force=True)
+    assert [r['id'] for r in obj['data']] == [1, 2, 3]
+    assert page_query(obj['links']['next'])['page[after]'] == ['3']
+    assert 'prev' not in obj['links']
+
+
+def test_follow_next_and_prev(client):
+    obj = client.get('/api/articles?page[size]=4&page[after]=4').get_json(force=True)
+    assert [r['id'] for r in obj['data']] == [5, 6, 7, 8]
+    assert page_query(obj['links']['prev'])['page[before]'] == ['5']
+
+    obj = client.get(obj['links']['prev']).get_json(force=True)
+    assert [r['id'] for r in obj['data']] == [1, 2, 3, 4]
+    assert 'prev' not in obj['links']
+    assert page_query(obj['links']['next'])['page[after]'] == ['4']
+
+
+def test_last_page(client):
+    obj = client.get('/api/articles?page[size]=4&page[after]=8').get_json(force=True)
+    assert [r['id'] for r in obj['data']] == [9, 10]
+    assert 'next' not in obj['links']
+    assert 'prev' in obj['links']
+
+
+def test_invalid_page(client):
+    response = client.get('/api/articles?page[size]=abc')
+    assert response.status_code == 400
+    assert response.headers['Content-Type'] == 'application/vnd.api+json'
+
+    response = client.get('/api/articles?page[size]=0')
+    assert response.status_code == 400
+
+
+def test_stream_all(client):
+    response = client.get('/api/articles?stream=1')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/vnd.api+json'
+    data = response.get_json(force=True)['data']
+    assert [r['id'] for r in data] == list(range(1, 11))
+    assert data[0]['attributes'] == {'title': 'Article 1', 'body': 'Body 1'}
+
+
+def test_unpaged_list_is_built_in_batches(client):
+    client.application.config['STREAM_BATCH_SIZE'] = 3
+
+    buffered = client.get('/api/articles')
+    assert buffered.status_code == 200
+    assert buffered.headers['Content-Type'] == 'application/vnd.api+json'
+    assert buffered.get_json(force=True) == client.get('/api/articles?stream=1').get_json(force=True)
+    assert [r['id'] for r in buffered.get_json(force=True)['data']] == list(range(1, 11))
+
+    filtered = client.get('/api/articles?filter[id][gt]=8&sort=-id').get_json(force=True)
+    assert [r['id'] for r in filtered['data']] == [10, 9]
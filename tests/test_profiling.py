@@ -0,0 +1,128 @@
+import os
+import tempfile
+import pytest
+from quicksand import create_app, Db
+from quicksand.profiling import Profiler, RequestProfile
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def test_sampled_request_breakdown(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, profile_sample_rate=1.0, slow_query_ms=0,
+                     slow_request_ms=0, debug_endpoints=True)
+    client = app.test_client()
+
+    assert client.get('/api/articles?include=author').status_code == 200
+
+    report = client.get('/_debug/profile').get_json()['meta']
+    route = report['routes']['/api/articles']
+    assert route['count'] == 1
+    assert route['status'] == {'200': 1}
+    assert route['sampled']['count'] == 1
+    assert route['sampled']['avg_queries'] == 2
+    assert route['sampled']['avg_rows'] == 3
+
+    sqls = [query['sql'] for query in report['slow_queries']]
+    assert ('SELECT articles.id,articles.title,articles.body,articles.author_id '
+            'FROM articles') in sqls
+    assert report['slow_requests'][0]['route'] == '/api/articles'
+    assert report['pools']['read']['open'] == 1
+    assert report['cache'] is None
+    assert report['unindexed'][0]['column'] == 'author_id'
+
+
+def test_stream_is_profiled(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, profile_sample_rate=1.0)
+    client = app.test_client()
+
+    response = client.get('/api/articles?stream=1')
+    assert len(response.get_json()['data']) == 2
+    response.close()
+
+    route = app.config['PROFILER'].report()['routes']['/api/articles']
+    assert route['count'] == 1
+    assert route['sampled']['avg_rows'] == 2
+    assert route['sampled']['avg_serialize_ms'] > 0
+
+    # The stream's connection went back to the pool when it closed
+    assert app.config['POOL'].info()['idle'] == 1
+
+
+def test_unsampled_requests_are_counted(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path)
+    client = app.test_client()
+
+    client.get('/api/articles/1')
+    client.get('/api/articles/9')
+    client.get('/nowhere')
+
+    report = app.config['PROFILER'].report()
+    assert report['routes']['/api/articles/<int:id>']['status'] == {'200': 1, '404': 1}
+    assert 'sampled' not in report['routes']['/api/articles/<int:id>']
+    assert report['routes']['unmatched']['count'] == 1
+    assert report['slow_queries'] == []
+
+
+def test_metrics(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    client = create_app(db_path, cache_size=1 << 20, profile_sample_rate=1.0,
+                        debug_endpoints=True).test_client()
+    client.get('/api/authors')
+    client.patch('/api/authors/1', json={'data': {'type': 'authors', 'id': '1',
+                                                  'attributes': {'name': 'New'}}})
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+
+    text = response.get_data(as_text=True)
+    assert 'quicksand_requests_total{method="GET",route="/api/authors",status="200"} 1' in text
+    assert 'quicksand_request_duration_seconds_bucket{method="GET",route="/api/authors",' \
+           'status="200",le="+Inf"} 1' in text
+    assert 'quicksand_db_queries_total{route="/api/authors/<int:id>"} 1' in text
+    assert 'quicksand_pool_open_connections{pool="write"} 1' in text
+    assert 'quicksand_cache_invalidations_total 1' in text
+    assert 'quicksand_unindexed_columns 1' in text
+
+
+def test_debug_endpoints_are_off_by_default(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    client = create_app(db_path, profile_sample_rate=1.0, slow_query_ms=0).test_client()
+    client.get('/api/articles')
+
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/_debug/profile').status_code == 404
+
+
+def test_profiler_sample_rate():
+    assert Profiler(0.0).start() is None
+    assert isinstance(Profiler(1.0).start(), RequestProfile)
+
+    with pytest.raises(ValueError):
+        Profiler(1.5)
+
+
+def test_slow_query_threshold():
+    profile = RequestProfile(slow_query_time=0.05)
+    profile.query('SELECT 1', 0.01, 1)
+    profile.query('SELECT 2', 0.06, 3)
+
+    assert profile.queries == 2
+    assert profile.rows == 4
+    assert profile.slow_queries == [('SELECT 2', 0.06, 3)]
+
+
+def test_label_escaping():
+    profiler = Profiler()
+    profiler.record('GET', '/a"b', 200, 0.001)
+
+    assert 'route="/a\\"b"' in profiler.render_metrics()
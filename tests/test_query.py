@@ -0,0 +1,100 @@
+import os
+import tempfile
+import pytest
+from quicksand import create_app, Db
+from quicksand.server import index_report
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.fixture
+def app(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/relationships.sql')
+    db.insert_into('authors', {'name': 'Author 2'})
+    for i in range(3, 7):
+        db.insert_into('articles', {'title': f'Article {i}', 'body': f'Body {i % 2}',
+                                    'author_id': 2})
+    db.close()
+    return create_app(db_path)
+
+
+def ids(response):
+    return [r['id'] for r in response.get_json(force=True)['data']]
+
+
+def test_filter_equal(app):
+    client = app.test_client()
+    assert ids(client.get('/api/articles?filter[body]=Body 1')) == [1, 3, 5]
+    assert ids(client.get('/api/articles?filter[author_id]=2&filter[body]=Body 0')) == [4, 6]
+
+
+def test_filter_operators(app):
+    client = app.test_client()
+    assert ids(client.get('/api/articles?filter[id][gt]=2&filter[id][lte]=4')) == [3, 4]
+    assert ids(client.get('/api/articles?filter[id][in]=1,5,9')) == [1, 5]
+    assert ids(client.get('/api/articles?filter[author_id][null]=true')) == [2]
+    assert ids(client.get('/api/articles?filter[title][ne]=Article 1&filter[id][lt]=4')) == [2, 3]
+
+
+def test_filter_with_page(app):
+    client = app.test_client()
+    obj = client.get('/api/articles?filter[author_id]=2&page[size]=3').get_json(force=True)
+    assert [r['id'] for r in obj['data']] == [3, 4, 5]
+
+    obj = client.get(obj['links']['next']).get_json(force=True)
+    assert [r['id'] for r in obj['data']] == [6]
+    assert 'next' not in obj['links']
+
+
+def test_sort(app):
+    client = app.test_client()
+    assert ids(client.get('/api/articles?sort=-id')) == [6, 5, 4, 3, 2, 1]
+    assert ids(client.get('/api/articles?sort=body,-title')) == [6, 4, 5, 3, 1, 2]
+
+
+def test_sparse_fieldsets(app):
+    client = app.test_client()
+    obj = client.get('/api/articles/3?fields[articles]=title&include=author'
+                     '&fields[authors]=name').get_json(force=True)
+    assert obj['data']['attributes'] == {'title': 'Article 3'}
+    assert 'relationships' not in obj['data']
+    assert obj['included'][0]['attributes'] == {'name': 'Author 2'}
+    assert 'relationships' not in obj['included'][0]
+
+
+@pytest.mark.parametrize('query', [
+    'filter[color]=red',
+    'filter[id][between]=1',
+    'filter[id);DROP TABLE articles;--]=1',
+    'sort=color',
+    'fields[articles]=color',
+    'sort=title&page[size]=2',
+])
+def test_invalid_query(app, query):
+    response = app.test_client().get('/api/articles?' + query)
+    assert response.status_code == 400
+
+
+def test_index_report(app, db_path):
+    client = app.test_client()
+    client.get('/api/articles?filter[title]=Article 1&sort=id')
+
+    report = index_report(app)
+    assert [(r['table'], r['column'], r['usage']) for r in report] == [
+        ('articles', 'author_id', ['relationship']),
+        ('articles', 'title', ['filter']),
+    ]
+    assert report[0]['suggestion'] == \
+        'CREATE INDEX articles_author_id_idx ON articles (author_id);'
+
+    db = Db(db_path)
+    db.execute(report[0]['suggestion'])
+    db.close()
+    assert index_report(create_app(db_path)) == []
@@ -1,7 +1,9 @@
+import json
 import os
 import tempfile
 import pytest
 from quicksand import create_app, Db, BelongsTo, HasMany
+from quicksand.relationships import load_relationships, schema_hash, CACHE_FORMAT
 
 
 @pytest.fixture
@@ -234,3 +236,208 @@ def test_create_resource_with_relationship_has_many(db_path):
     assert response.headers['Content-Type'] == 'application/vnd.api+json'
     assert response.status_code == 200
     assert len(response.get_json(force=True)['data']) == 2
+
+
+def test_include_belongs_to(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    client = create_app(db_path).test_client()
+
+    response = client.get('/api/articles?include=author')
+    assert response.status_code == 200
+    obj = response.get_json(force=True)
+    assert obj['data'][0]['relationships']['author']['data'] == {
+        'type': 'authors', 'id': 1
+    }
+    assert obj['data'][1]['relationships']['author']['data'] is None
+    assert obj['included'] == [
+        {
+            'type': 'authors',
+            'id': 1,
+            'attributes': {
+                'name': 'Author 1',
+            },
+            'links': {
+                'self': 'http://localhost/api/authors/1'
+            },
+            'relationships': {
+                'articles': {
+                    'links': {
+                        'related': 'http://localhost/api/authors/1/articles'
+                    }
+                }
+            }
+        }
+    ]
+
+
+def test_include_has_many(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    client = create_app(db_path).test_client()
+
+    response = client.get('/api/authors/1?include=articles')
+    assert response.status_code == 200
+    obj = response.get_json(force=True)
+    assert obj['data']['relationships']['articles']['data'] == [
+        {'type': 'articles', 'id': 1}
+    ]
+    assert [(r['type'], r['id']) for r in obj['included']] == [('articles', 1)]
+
+
+def test_include_is_one_query_per_relationship(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/relationships.sql')
+    for i in range(2, 6):
+        author_id = db.insert_into('authors', {'name': f'Author {i}'})
+        db.insert_into('articles', {'title': 'Article', 'author_id': author_id})
+    db.close()
+
+    app = create_app(db_path)
+    client = app.test_client()
+    client.get('/api/articles')
+
+    statements = []
+    pooled = app.config['POOL'].acquire()
+    pooled.conn.set_trace_callback(statements.append)
+    app.config['POOL'].release(pooled)
+
+    response = client.get('/api/articles?include=author')
+    assert len(response.get_json(force=True)['included']) == 5
+    assert len([sql for sql in statements if 'FROM authors' in sql]) == 1
+
+
+def test_include_unknown_relationship(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    client = create_app(db_path).test_client()
+
+    response = client.get('/api/articles?include=editor')
+    assert response.status_code == 400
+    assert response.headers['Content-Type'] == 'application/vnd.api+json'
+
+
+def test_relationship_of_unknown_resource(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/relationships.sql')
+    db.insert_into('authors', {'name': 'Author 2'})
+    db.close()
+    client = create_app(db_path).test_client()
+
+    for url in ['/api/articles/99/author', '/api/authors/99/articles']:
+        response = client.get(url)
+        assert response.status_code == 404
+        assert response.get_json(force=True)['errors'][0]['title'] == 'Resource not found'
+
+    # Known records without related ones are not errors
+    assert client.get('/api/articles/2/author').get_json(force=True) == {'data': None}
+    assert client.get('/api/authors/2/articles').get_json(force=True) == {'data': []}
+
+
+def test_linkage_data(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/relationships.sql')
+    db.insert_into('articles', {'title': 'Article 3', 'author_id': 1})
+    db.insert_into('authors', {'name': 'Author 2'})
+    db.close()
+
+    client = create_app(db_path).test_client()
+
+    obj = client.get('/api/authors?linkage=data').get_json(force=True)
+    assert [data['relationships']['articles'] for data in obj['data']] == [{
+        'links': {'related': 'http://localhost/api/authors/1/articles'},
+        'data': [{'type': 'articles', 'id': 1}, {'type': 'articles', 'id': 3}],
+        'meta': {'count': 2},
+    }, {
+        'links': {'related': 'http://localhost/api/authors/2/articles'},
+        'data': [],
+        'meta': {'count': 0},
+    }]
+
+    obj = client.get('/api/articles?linkage=data').get_json(force=True)
+    assert [data['relationships']['author']['data'] for data in obj['data']] == [
+        {'type': 'authors', 'id': 1}, None, {'type': 'authors', 'id': 1}
+    ]
+
+    obj = client.get('/api/authors/1?linkage=count').get_json(force=True)
+    assert obj['data']['relationships']['articles'] == {
+        'links': {'related': 'http://localhost/api/authors/1/articles'},
+        'meta': {'count': 2},
+    }
+
+
+def test_linkage_with_include_and_fields(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    client = create_app(db_path).test_client()
+
+    obj = client.get('/api/authors?linkage=count&include=articles').get_json(force=True)
+    assert obj['data'][0]['relationships']['articles']['data'] == [{'type': 'articles', 'id': 1}]
+    assert obj['data'][0]['relationships']['articles']['meta'] == {'count': 1}
+
+    obj = client.get('/api/authors?linkage=data&fields[authors]=name').get_json(force=True)
+    assert 'relationships' not in obj['data'][0]
+
+    assert client.get('/api/authors?linkage=all').status_code == 400
+    assert client.get('/api/authors?linkage=data&stream=1').status_code == 400
+
+
+def test_linkage_is_one_query_per_relationship(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/relationships.sql')
+    for i in range(2, 6):
+        author_id = db.insert_into('authors', {'name': f'Author {i}'})
+        db.insert_into('articles', {'title': 'Article', 'author_id': author_id})
+    db.close()
+
+    app = create_app(db_path)
+    client = app.test_client()
+    client.get('/api/authors')
+
+    statements = []
+    pooled = app.config['POOL'].acquire()
+    pooled.conn.set_trace_callback(statements.append)
+    app.config['POOL'].release(pooled)
+
+    for mode in ('data', 'count'):
+        response = client.get(f'/api/authors?linkage={mode}')
+        counts = [data['relationships']['articles']['meta']['count']
+                  for data in response.get_json(force=True)['data']]
+        assert counts == [1] * 5
+
+    assert len([sql for sql in statements if 'FROM articles' in sql]) == 2
+
+
+def test_relationship_cache(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    cache_fd, cache_path = tempfile.mkstemp()
+    os.close(cache_fd)
+
+    try:
+        inferred = create_app(db_path, relationship_cache=cache_path).config['RELATIONSHIPS']
+
+        with open(cache_path) as cache_file:
+            assert json.load(cache_file)['schema_hash'] == schema_hash(Db(db_path))
+
+        cached = load_relationships(cache_path, schema_hash(Db(db_path)))
+        assert cached == inferred
+        assert cached['authors'][0].related_resource == 'articles'
+
+        # So does a cache written by another version of quicksand or inflect
+        digest = schema_hash(Db(db_path))
+        with open(cache_path) as cache_file:
+            written = json.load(cache_file)
+
+        for field, value in [('format', CACHE_FORMAT + 1), ('inflect', '0.0.1')]:
+            with open(cache_path, 'w') as cache_file:
+                json.dump(dict(written, **{field: value}), cache_file)
+            assert load_relationships(cache_path, digest) is None
+
+        with open(cache_path, 'w') as cache_file:
+            json.dump(written, cache_file)
+
+        # A schema change invalidates the cached map
+        Db(db_path).execute('CREATE TABLE comments (id INTEGER PRIMARY KEY, article_id INTEGER)')
+        assert load_relationships(cache_path, schema_hash(Db(db_path))) is None
+
+        relationships = create_app(db_path, relationship_cache=cache_path).config['RELATIONSHIPS']
+        assert relationships['comments'] == [BelongsTo('comments', 'article')]
+        assert HasMany('articles', 'comments') in relationships['articles']
+    finally:
+        os.unlink(cache_path)
@@ -0,0 +1,181 @@
+import os
+import sqlite3
+import signal
+import tempfile
+import time
+import pytest
+from quicksand import create_app, Db
+from quicksand.replicas import snapshot
+from quicksand.server import reload_schema, reset_after_fork
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.fixture
+def replica_paths():
+    work_dir = tempfile.mkdtemp()
+    yield [os.path.join(work_dir, 'replica1.db'), os.path.join(work_dir, 'replica2.db')]
+    for name in os.listdir(work_dir):
+        os.unlink(os.path.join(work_dir, name))
+    os.rmdir(work_dir)
+
+
+def rename_author(db_path, name):
+    db = Db(db_path)
+    db.update_by_id('authors', 1, {'name': name})
+    db.close()
+
+
+def author_name(client):
+    return client.get('/api/authors/1').get_json()['data']['attributes']['name']
+
+
+def test_snapshot(db_path, replica_paths):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    before = time.time_ns()
+    started = snapshot(db_path, replica_paths[0])
+
+    conn = sqlite3.connect(replica_paths[0])
+    assert conn.execute('SELECT count(*) FROM articles').fetchone()[0] == 2
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    conn.close()
+
+    assert before <= started <= time.time_ns()
+    assert os.stat(replica_paths[0]).st_mtime_ns == started
+    assert sorted(os.listdir(os.path.dirname(replica_paths[0]))) == ['replica1.db']
+
+
+def test_reads_go_to_replicas(db_path, replica_paths):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, replicas=replica_paths)
+    client = app.test_client()
+
+    # Until a snapshot exists, reads go to the primary
+    assert author_name(client) == 'Author 1'
+    app.config['REPLICAS'].refresh()
+    rename_author(db_path, 'Renamed')
+
+    for _ in range(2):
+        assert author_name(client) == 'Author 1'
+
+    app.config['REPLICAS'].refresh()
+    assert author_name(client) == 'Renamed'
+
+    info = app.config['REPLICAS'].info()
+    assert info['primary_reads'] == 1
+    assert info['replica_reads'] == 3
+    assert all(pool['misses'] >= 1 for pool in info['pools'].values())
+
+
+def test_read_your_writes(db_path, replica_paths):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, replicas=replica_paths, replica_interval=3600)
+    writer = app.test_client()
+    reader = app.test_client()
+
+    response = writer.patch('/api/authors/1', json={'data': {
+        'type': 'authors', 'id': '1', 'attributes': {'name': 'Renamed'}}})
+    assert response.status_code == 204
+    assert 'quicksand_written=' in response.headers['Set-Cookie']
+
+    assert author_name(writer) == 'Renamed'
+    assert author_name(reader) == 'Author 1'
+
+    app.config['REPLICAS'].refresh()
+    assert author_name(reader) == 'Renamed'
+    assert author_name(writer) == 'Renamed'
+    assert app.config['REPLICAS'].stats['primary_reads'] == 1
+
+    app.config['REPLICAS'].close()
+
+
+def test_refresh_changes_etag(db_path, replica_paths):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, replicas=replica_paths[:1])
+    writer = app.test_client()
+    reader = app.test_client()
+    app.config['REPLICAS'].refresh()
+
+    writer.patch('/api/authors/1', json={'data': {
+        'type': 'authors', 'id': '1', 'attributes': {'name': 'Renamed'}}})
+    response = reader.get('/api/authors/1')
+    assert response.get_json()['data']['attributes']['name'] == 'Author 1'
+
+    # Same table versions, newer snapshot
+    app.config['REPLICAS'].refresh()
+    response = reader.get('/api/authors/1', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 200
+    assert response.get_json()['data']['attributes']['name'] == 'Renamed'
+
+
+def test_replica_etags_differ(db_path, replica_paths):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, cache_size=1 << 20, replicas=replica_paths[:1],
+                     replica_interval=3600)
+    writer = app.test_client()
+    reader = app.test_client()
+
+    assert reader.get('/api/authors/1').headers['X-Cache'] == 'MISS'
+    writer.patch('/api/authors/1', json={'data': {
+        'type': 'authors', 'id': '1', 'attributes': {'name': 'Renamed'}}})
+
+    # The primary's response is not served from the replica's cache entry
+    assert author_name(writer) == 'Renamed'
+    assert author_name(reader) == 'Author 1'
+
+    app.config['REPLICAS'].close()
+
+
+def test_background_refresh(db_path, replica_paths):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, replicas=replica_paths, replica_interval=0.05,
+                     debug_endpoints=True)
+    client = app.test_client()
+    rename_author(db_path, 'Renamed')
+
+    deadline = time.monotonic() + 5
+    while author_name(client) != 'Renamed' and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert author_name(client) == 'Renamed'
+    assert 'quicksand_replica_lag_seconds{pool="replica0"}' in \
+        client.get('/metrics').get_data(as_text=True)
+
+    app.config['REPLICAS'].close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_forked_worker_leaves_refreshes_to_parent(db_path, replica_paths):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path, replicas=replica_paths[:1], replica_interval=3600)
+    replicas = app.config['REPLICAS']
+    synced_at = os.stat(replica_paths[0]).st_mtime_ns
+
+    # Fork while the refresh thread is in the middle of a snapshot
+    with replicas._refresh_lock:
+        pid = os.fork()
+
+        if pid == 0:
+            status = 1
+            try:
+                signal.alarm(10)
+                reset_after_fork(app)
+                db = Db(db_path)
+                db.execute('ALTER TABLE authors ADD COLUMN born TEXT')
+                db.close()
+                reload_schema(app)
+                if not replicas.refreshing and \
+                        os.stat(replica_paths[0]).st_mtime_ns == synced_at:
+                    status = 0
+            finally:
+                os._exit(status)
+
+    assert os.waitpid(pid, 0)[1] == 0
+    assert replicas.refreshing
+    replicas.close()
@@ -0,0 +1,186 @@
+import logging
+import os
+import tempfile
+import threading
+import pytest
+from quicksand import create_app, Db
+from quicksand.schema import SchemaWatcher
+from quicksand.server import reload_schema
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def alter(db_path, sql):
+    db = Db(db_path)
+    db.execute(sql)
+    db.close()
+
+
+def test_new_table_is_served(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path)
+    client = app.test_client()
+    assert client.get('/api/comments').status_code == 404
+
+    alter(db_path, 'CREATE TABLE comments (id INTEGER PRIMARY KEY, text TEXT, '
+                   'article_id INTEGER)')
+    assert app.config['SCHEMA_WATCHER'].poll(force=True)
+
+    client.post('/api/comments', json={'data': {
+        'type': 'comments', 'attributes': {'text': 'First', 'article_id': 1}}})
+    assert client.get('/api/comments').get_json()['data'][0]['attributes']['text'] == 'First'
+    assert client.get('/api/articles/1/comments').status_code == 200
+    assert 'comments' in client.get('/api/articles/1').get_json()['data']['relationships']
+
+
+def test_only_changed_tables_are_rebuilt(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path)
+    client = app.test_client()
+    articles = app.config['SERIALIZERS']['articles']
+    statements = app.config['SCHEMA']['articles'].statements
+    view = app.view_functions['handlersinglearticles']
+
+    alter(db_path, 'ALTER TABLE authors ADD COLUMN born TEXT')
+    assert reload_schema(app) == {'authors'}
+
+    assert app.config['SERIALIZERS']['articles'] is articles
+    assert app.config['SCHEMA']['articles'].statements is statements
+    assert app.view_functions['handlersinglearticles'] is view
+    assert client.get('/api/authors/1').get_json()['data']['attributes'] == {
+        'name': 'Author 1', 'born': None}
+
+    # An index alone changes no handlers
+    alter(db_path, 'CREATE INDEX articles_author_id_idx ON articles (author_id)')
+    assert reload_schema(app) == set()
+    assert app.config['INDEX_ADVISOR'].report() == []
+
+
+def test_rows_match_serializer_columns(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_app(db_path, schema_poll_interval=0)
+    client = app.test_client()
+
+    alter(db_path, 'ALTER TABLE articles DROP COLUMN title')
+    alter(db_path, "ALTER TABLE articles ADD COLUMN secret TEXT DEFAULT 'S'")
+
+    # Until the reload, the stale column list fails rather than mislabels
+    response = client.get('/api/articles/1')
+    assert response.status_code == 500
+    assert b'"S"' not in response.get_data()
+
+    reload_schema(app)
+    assert client.get('/api/articles/1').get_json()['data']['attributes'] == {
+        'body': 'Body 1', 'secret': 'S'}
+
+
+def test_request_keeps_its_serializer_across_reload(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_app(db_path, schema_poll_interval=0)
+    pool = app.config['POOL']
+    acquire = pool.acquire
+
+    def acquire_after_reload(*args, **kwargs):
+        # The request was dispatched with the old serializer; now the columns move
+        pool.acquire = acquire
+        db = Db(db_path)
+        db.conn.executescript("""
+            CREATE TABLE articles_new (id INTEGER PRIMARY KEY, body TEXT, title TEXT);
+            INSERT INTO articles_new SELECT id, body, title FROM articles;
+            DROP TABLE articles;
+            ALTER TABLE articles_new RENAME TO articles;
+        """)
+        db.close()
+        assert reload_schema(app) == {'articles'}
+        return acquire(*args, **kwargs)
+
+    pool.acquire = acquire_after_reload
+    client = app.test_client()
+    assert client.get('/api/articles/1').get_json()['data']['attributes'] == {
+        'title': 'Article 1', 'body': 'Body 1'}
+    # Later requests use the new column order
+    attributes = client.get('/api/articles/1').get_json()['data']['attributes']
+    assert list(attributes.items()) == [('body', 'Body 1'), ('title', 'Article 1')]
+
+
+def test_dropped_table(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    alter(db_path, 'CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT)')
+    app = create_app(db_path)
+    client = app.test_client()
+    assert client.get('/api/tags').status_code == 200
+
+    alter(db_path, 'DROP TABLE tags')
+    assert reload_schema(app) == {'tags'}
+
+    assert client.get('/api/tags').status_code == 404
+    assert client.get('/api/articles/1').status_code == 200
+    assert 'tags' not in app.config['SERIALIZERS']
+
+
+def test_failed_reload_keeps_serving(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path)
+    client = app.test_client()
+
+    # No gadgets table for gadget_id to belong to
+    alter(db_path, 'CREATE TABLE widgets (id INTEGER PRIMARY KEY, gadget_id INTEGER)')
+    assert app.config['SCHEMA_WATCHER'].poll(force=True)
+
+    assert client.get('/api/articles/1').status_code == 200
+    assert client.get('/api/widgets').status_code == 404
+
+    # Retried on every poll until it succeeds
+    alter(db_path, 'CREATE TABLE gadgets (id INTEGER PRIMARY KEY)')
+    assert app.config['SCHEMA_WATCHER'].poll(force=True)
+    assert client.get('/api/widgets').status_code == 200
+    assert not app.config['SCHEMA_WATCHER'].poll(force=True)
+
+
+def test_failed_reload_is_retried(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    calls = []
+
+    def on_change():
+        calls.append(True)
+        if len(calls) == 1:
+            raise RuntimeError('database is locked')
+
+    watcher = SchemaWatcher(db_path, on_change, logger=logging.getLogger(__name__))
+    alter(db_path, 'ALTER TABLE authors ADD COLUMN born TEXT')
+
+    assert watcher.poll(force=True)
+    assert watcher.poll(force=True)
+    assert not watcher.poll(force=True)
+    assert len(calls) == 2
+
+
+def test_reload_under_traffic(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    app = create_app(db_path)
+    statuses = []
+
+    def read():
+        client = app.test_client()
+        for _ in range(100):
+            statuses.append(client.get('/api/articles/1').status_code)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    for i in range(10):
+        alter(db_path, f'ALTER TABLE articles ADD COLUMN extra{i} TEXT')
+        reload_schema(app)
+
+    for thread in threads:
+        thread.join()
+
+    assert set(statuses) == {200}
+    assert 'extra9' in app.config['SERIALIZERS']['articles'].columns
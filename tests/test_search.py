@@ -0,0 +1,141 @@
+import os
+import tempfile
+import pytest
+from quicksand import create_app, Db
+from quicksand.search import create_search_index, parse_search
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+def make_client(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    db = Db(db_path)
+    for title, body in [('Pickling vegetables', 'Brine and patience'),
+                        ('Vegetable soup', 'Vegetables, stock and more vegetables'),
+                        ('Bread', 'Flour, water, salt')]:
+        db.insert_into('articles', {'title': title, 'body': body})
+    db.close()
+    return create_app(db_path, search={'articles': ['title', 'body']}).test_client()
+
+
+def titles(response):
+    return [data['attributes']['title'] for data in response.get_json()['data']]
+
+
+def test_search_is_ranked(db_path):
+    client = make_client(db_path)
+
+    response = client.get('/api/articles?filter[search]=vegetables')
+    assert response.status_code == 200
+    assert titles(response) == ['Vegetable soup', 'Pickling vegetables']
+
+    assert titles(client.get('/api/articles?filter[search]=veg*')) == [
+        'Vegetable soup', 'Pickling vegetables']
+    assert titles(client.get('/api/articles?filter[search]=flour salt')) == ['Bread']
+    assert titles(client.get('/api/articles?filter[search]=flour vegetables')) == []
+
+
+def test_search_is_paged(db_path):
+    client = make_client(db_path)
+
+    response = client.get('/api/articles?filter[search]=vegetables&page[size]=1')
+    assert titles(response) == ['Vegetable soup']
+    assert 'prev' not in response.get_json()['links']
+
+    response = client.get(response.get_json()['links']['next'])
+    assert titles(response) == ['Pickling vegetables']
+    assert 'next' not in response.get_json()['links']
+
+    response = client.get(response.get_json()['links']['prev'])
+    assert titles(response) == ['Vegetable soup']
+
+
+def test_search_with_filters_and_stream(db_path):
+    client = make_client(db_path)
+
+    assert titles(client.get('/api/articles?filter[search]=vegetables&'
+                             'filter[id][gt]=4')) == []
+    assert titles(client.get('/api/articles?filter[search]=vegetables&'
+                             'filter[id][lt]=4')) == ['Pickling vegetables']
+    assert titles(client.get('/api/articles?filter[search]=vegetables&sort=id')) == [
+        'Pickling vegetables', 'Vegetable soup']
+
+    response = client.get('/api/articles?filter[search]=vegetables&stream=1')
+    assert titles(response) == ['Vegetable soup', 'Pickling vegetables']
+    response.close()
+
+
+def test_index_follows_writes(db_path):
+    client = make_client(db_path)
+
+    client.post('/api/articles', json={'data': {
+        'type': 'articles', 'attributes': {'title': 'Rye bread', 'body': 'Sourdough'}}})
+    client.patch('/api/articles/5', json={'data': {
+        'type': 'articles', 'id': '5', 'attributes': {'title': 'Flatbread'}}})
+    client.delete('/api/articles/3')
+
+    assert titles(client.get('/api/articles?filter[search]=bread*')) == ['Rye bread']
+    assert titles(client.get('/api/articles?filter[search]=flatbread')) == ['Flatbread']
+    assert titles(client.get('/api/articles?filter[search]=brine')) == []
+
+
+def test_search_errors(db_path):
+    client = make_client(db_path)
+
+    assert client.get('/api/authors?filter[search]=x').status_code == 400
+    assert client.get('/api/articles?filter[search]=%20').status_code == 400
+    assert client.get('/api/articles?filter[search][eq]=x').status_code == 400
+    # Operators and quotes are searched for literally
+    assert client.get('/api/articles?filter[search]=NOT "soup').status_code == 200
+
+
+def test_search_index_is_hidden_and_reused(db_path):
+    client = make_client(db_path)
+    assert client.get('/api/articles_search').status_code == 404
+    assert client.get('/api/articles_search_data').status_code == 404
+
+    db = Db(db_path)
+    version = db.fetch_one('PRAGMA schema_version')[0]
+    create_search_index(db, 'articles', ['title', 'body'])
+    assert db.fetch_one('PRAGMA schema_version')[0] == version
+    assert 'articles_search' not in db.table_names
+
+    create_search_index(db, 'articles', ['title'])
+    assert len(db.fetch_all("SELECT rowid FROM articles_search "
+                            "WHERE articles_search MATCH 'soup'")) == 1
+
+    with pytest.raises(ValueError):
+        create_search_index(db, 'articles', ['missing'])
+
+
+def test_other_virtual_tables_are_served(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/basic.sql')
+    db.execute('CREATE VIRTUAL TABLE notes USING fts5(id UNINDEXED, text)')
+    db.execute("INSERT INTO notes (id, text) VALUES (1, 'Buy flour')")
+    # Looks like a search index, but not one create_search_index made
+    db.execute("CREATE VIRTUAL TABLE drafts_search USING fts5(id UNINDEXED, text)")
+    db.commit()
+    db.close()
+    client = create_app(db_path, search={'articles': ['title']}).test_client()
+
+    response = client.get('/api/notes')
+    assert response.status_code == 200
+    assert response.get_json()['data'][0]['attributes']['text'] == 'Buy flour'
+    assert client.get('/api/drafts_search').status_code == 200
+    assert client.get('/api/notes_data').status_code == 404
+    assert client.get('/api/articles_search').status_code == 404
+
+
+def test_parse_search():
+    assert parse_search('soup  veg*') == '"soup" "veg"*'
+    assert parse_search('say "hi"') == '"say" """hi"""'
+
+    with pytest.raises(ValueError):
+        parse_search(' * ')
@@ -0,0 +1,34 @@
+from quicksand import BelongsTo
+from quicksand.serializers import ResourceSerializer
+
+
+def test_serialize_tuple_row():
+    serializer = ResourceSerializer('articles', ['id', 'title', 'author_id'],
+                                    [BelongsTo('articles', 'author')])
+
+    assert serializer.serialize((3, 'Article 3', 1), 'http://localhost/') == {
+        'type': 'articles',
+        'id': 3,
+        'attributes': {
+            'title': 'Article 3',
+        },
+        'links': {
+            'self': 'http://localhost/api/articles/3'
+        },
+        'relationships': {
+            'author': {
+                'links': {
+                    'related': 'http://localhost/api/articles/3/author'
+                }
+            }
+        }
+    }
+
+
+def test_serialize_many_without_relationships():
+    serializer = ResourceSerializer('articles', ['title', 'id'], [])
+    data = serializer.serialize_many([('A', 1), ('B', 2)], 'http://localhost/')
+
+    assert [d['id'] for d in data] == [1, 2]
+    assert data[1]['attributes'] == {'title': 'B'}
+    assert 'relationships' not in data[0]
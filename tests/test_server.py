@@ -139,6 +139,25 @@ def test_create_resource(db_path):
     assert len(response.get_json(force=True)['data']) == 3
 
 
+def test_unknown_attribute(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    client = create_app(db_path).test_client()
+
+    response = client.post('/api/articles', json={
+        'data': {'type': 'articles', 'attributes': {'title': 'A', 'rating': 5}}
+    })
+    assert response.status_code == 400
+    assert 'rating' in response.get_json(force=True)['errors'][0]['detail']
+
+    response = client.patch('/api/articles/1', json={
+        'data': {'type': 'articles', 'id': 1, 'attributes': {'body=1 --': 'x'}}
+    })
+    assert response.status_code == 400
+
+    response = client.get('/api/articles')
+    assert len(response.get_json(force=True)['data']) == 2
+
+
 def test_delete_resource(db_path):
     Db(db_path).execute_script('tests/sql/basic.sql')
     client = create_app(db_path).test_client()
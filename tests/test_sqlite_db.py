@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import pytest
+from quicksand import create_app, Db
+from quicksand.sqlite_db import ConnectionPool
+from quicksand.schema import SchemaCatalog, MAX_CACHED_STATEMENTS
+from quicksand.server import reload_schema
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+    for suffix in ['-wal', '-shm']:
+        if os.path.exists(db_path + suffix):
+            os.unlink(db_path + suffix)
+
+
+def test_pool_reuses_connection(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    pool = ConnectionPool(db_path, size=2)
+
+    db = pool.acquire()
+    pool.release(db)
+    assert pool.acquire() is db
+    assert pool.stats['misses'] == 1
+    assert pool.stats['hits'] == 1
+
+
+def test_pool_waits_when_exhausted(db_path):
+    pool = ConnectionPool(db_path, size=1)
+    db = pool.acquire()
+
+    timer = threading.Timer(0.05, pool.release, [db])
+    timer.start()
+    assert pool.acquire() is db
+    timer.join()
+
+    assert pool.stats['waits'] == 1
+    assert pool.stats['wait_time'] > 0
+
+
+def test_pool_timeout(db_path):
+    pool = ConnectionPool(db_path, size=1, timeout=0.01)
+    pool.acquire()
+
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+
+
+def test_requests_share_pooled_connection(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_app(db_path, pool_size=2)
+    client = app.test_client()
+
+    for _ in range(5):
+        assert client.get('/api/articles').status_code == 200
+
+    info = app.config['POOL'].info()
+    assert info['open'] == 1
+    assert info['idle'] == 1
+    assert info['misses'] == 1
+    assert info['hits'] == 4
+
+
+def test_schema_catalog(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/relationships.sql')
+    catalog = SchemaCatalog(db)
+
+    assert sorted(catalog.table_names) == ['articles', 'authors']
+    articles = catalog['articles']
+    assert articles.columns == ['id', 'title', 'body', 'author_id']
+    assert articles.types['author_id'] == 'INTEGER'
+    assert articles.primary_key == ['id']
+    assert articles.foreign_keys == [
+        {'column': 'author_id', 'table': 'authors', 'to': 'id'}
+    ]
+
+    statements = articles.statements
+    assert statements.find_by_id == ('SELECT articles.id,articles.title,articles.body,'
+                                    'articles.author_id FROM articles WHERE id=?')
+    assert statements.insert(['title']) is statements.insert(['title'])
+
+
+def test_statements_reject_unknown_columns(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    statements = SchemaCatalog(Db(db_path))['articles'].statements
+
+    with pytest.raises(ValueError):
+        statements.insert(['title', 'title) VALUES (1); DROP TABLE articles; --'])
+    with pytest.raises(ValueError):
+        statements.update(['nope'])
+    assert len(statements._insert) == 0 and len(statements._update) == 0
+
+    for i in range(MAX_CACHED_STATEMENTS + 10):
+        statements.update(['title', 'body'] if i % 2 else ['body', 'title'])
+        statements.insert(['title'] * (i + 1))
+    assert len(statements._insert) == MAX_CACHED_STATEMENTS
+    assert len(statements._update) == 2
+
+
+def test_reload_schema(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_app(db_path)
+    assert 'comments' not in app.config['SCHEMA']
+
+    db = Db(db_path)
+    db.execute('CREATE TABLE comments (id INTEGER PRIMARY KEY, text TEXT)')
+    db.close()
+
+    reload_schema(app)
+    assert app.config['SCHEMA']['comments'].columns == ['id', 'text']
+
+
+def test_read_only_connection(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    db = Db(db_path, read_only=True)
+
+    assert len(db.find_all('articles')) == 2
+    with pytest.raises(sqlite3.OperationalError):
+        db.insert_into('articles', {'title': 'Article 3'})
+
+
+def test_pragmas(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_app(db_path, pragmas={'journal_mode': 'wal', 'synchronous': 'normal'})
+
+    db = app.config['POOL'].acquire()
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+    assert db.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+
+    with pytest.raises(ValueError):
+        create_app(db_path, pragmas={'journal_mode': 'wal; DROP TABLE articles'})
+
+    with pytest.raises(ValueError):
+        create_app(db_path, pragmas={'writable_schema': 1})
+
+
+def test_reads_and_writes_use_separate_pools(db_path):
+    Db(db_path).execute_script('tests/sql/basic.sql')
+    app = create_app(db_path, pragmas={'journal_mode': 'wal'})
+    client = app.test_client()
+
+    client.get('/api/articles')
+    client.patch('/api/articles/1', json={
+        'data': {'type': 'articles', 'id': 1, 'attributes': {'body': 'changed'}}
+    })
+    response = client.get('/api/articles/1')
+    assert response.get_json()['data']['attributes']['body'] == 'changed'
+
+    assert app.config['POOL'].info()['open'] == 1
+    assert app.config['POOL'].acquire().read_only
+    assert app.config['WRITER'].info()['open'] == 1
+    assert app.config['WRITER'].size == 1
+
+
+def test_iter_batches(db_path):
+    db = Db(db_path)
+    db.execute_script('tests/sql/basic.sql')
+    for i in range(3, 8):
+        db.insert_into('articles', {'title': f'Article {i}'})
+
+    batches = list(db.iter_batches('articles', 3))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [row['id'] for batch in batches for row in batch] == list(range(1, 8))
+    assert [row['id'] for row in db.iter_all('articles', 2)] == list(range(1, 8))
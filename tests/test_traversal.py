@@ -0,0 +1,102 @@
+import os
+import tempfile
+import pytest
+from quicksand import create_app, Db
+
+
+@pytest.fixture
+def db_path():
+    db_fd, db_path = tempfile.mkstemp()
+    yield db_path
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.fixture
+def app(db_path):
+    Db(db_path).execute_script('tests/sql/relationships.sql')
+    db = Db(db_path)
+    db.execute('CREATE TABLE comments (id INTEGER PRIMARY KEY, text TEXT, article_id INTEGER)')
+    db.insert_into('articles', {'title': 'Article 3', 'author_id': 1})
+    for text, article_id in [('On 1', 1), ('On 3', 3), ('Also on 1', 1), ('On 2', 2)]:
+        db.insert_into('comments', {'text': text, 'article_id': article_id})
+    db.close()
+    return create_app(db_path)
+
+
+def ids(response):
+    return [data['id'] for data in response.get_json()['data']]
+
+
+def test_nested_path(app):
+    client = app.test_client()
+
+    response = client.get('/api/authors/1/articles/comments')
+    assert response.status_code == 200
+    assert ids(response) == [1, 2, 3]
+    assert client.get('/api/authors/1/articles/comments/article/author').status_code == 400
+
+    response = client.get('/api/comments/2/article/author')
+    assert response.get_json()['data']['attributes'] == {'name': 'Author 1'}
+    assert client.get('/api/comments/4/article/author').get_json() == {'data': None}
+    assert client.get('/api/comments/4/article/comments').get_json()['data'][0]['id'] == 4
+
+
+def test_path_errors(app):
+    client = app.test_client()
+
+    assert client.get('/api/authors/1/articles/editors').status_code == 404
+    assert client.get('/api/authors/9/articles/comments').status_code == 404
+
+    app.config['MAX_RELATED_ROWS'] = 2
+    response = client.get('/api/authors/1/articles/comments')
+    assert response.status_code == 400
+    assert len(response.get_json()['errors']) == 1
+
+
+def test_one_query_per_hop(app):
+    client = app.test_client()
+    statements = []
+    pooled = app.config['POOL'].acquire()
+    pooled.conn.set_trace_callback(statements.append)
+    app.config['POOL'].release(pooled)
+
+    client.get('/api/authors/1/articles/comments')
+    assert len([sql for sql in statements if 'FROM articles' in sql]) == 1
+    assert len([sql for sql in statements if 'FROM comments' in sql]) == 1
+
+    statements.clear()
+    response = client.get('/api/authors?include=articles.comments')
+    assert len([sql for sql in statements if 'FROM comments' in sql]) == 1
+
+    included = {(data['type'], data['id']) for data in response.get_json()['included']}
+    assert included == {('articles', 1), ('articles', 3),
+                        ('comments', 1), ('comments', 2), ('comments', 3)}
+
+
+def test_nested_include_linkage(app):
+    client = app.test_client()
+
+    response = client.get('/api/comments/2?include=article.author,article.comments')
+    document = response.get_json()
+    assert document['data']['relationships']['article']['data'] == {'type': 'articles', 'id': 3}
+
+    article = next(data for data in document['included'] if data['type'] == 'articles')
+    assert article['relationships']['author']['data'] == {'type': 'authors', 'id': 1}
+    assert article['relationships']['comments']['data'] == [{'type': 'comments', 'id': 2}]
+    # The primary resource is not repeated in included
+    assert ('comments', 2) not in {(data['type'], data['id']) for data in document['included']}
+
+
+def test_include_limits(app):
+    client = app.test_client()
+
+    assert client.get('/api/articles?include=author.editors').status_code == 400
+    assert client.get('/api/comments?include=article.author.articles.comments').status_code == 400
+
+    app.config['MAX_RELATIONSHIP_DEPTH'] = 4
+    assert client.get('/api/comments?include=article.author.articles.comments').status_code == 200
+
+    app.config['MAX_RELATED_ROWS'] = 3
+    assert client.get('/api/authors?include=articles').status_code == 200
+    assert client.get('/api/authors?include=articles.comments').status_code == 400